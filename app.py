@@ -6,7 +6,7 @@ import time
 import zipfile
 
 from sqlalchemy import text
-from config import app, db, clean_old_backups, start_backup_scheduler
+from config import app, db, clean_old_backups, start_backup_scheduler, start_maintenance_scheduler
 from flask import request, jsonify
 import jwt
 import datetime
@@ -22,6 +22,15 @@ from routes.projectplan import projectplan_bp
 from routes.training import training_bp
 from utils.activity_tracking import create_user_session, log_user_activity, track_activity
 from utils.network_utils import get_real_ip
+from utils.kb_tree import ensure_kb_tree_columns
+from utils.kb_search import ensure_kb_search_index
+from utils.search_snippets import sync_file_contents_fts
+from utils.entity_search import ensure_entity_search_index
+from utils.activity_rollups import backfill_activity_rollups
+from utils.activity_log_store import ensure_activity_log_indexes
+from utils.session_store import ensure_session_indexes
+from utils.user_deletion import ensure_user_deletion_columns
+from utils.announcement_reads import ensure_announcement_read_columns, init_read_watermark
 from routes.file_merge_router import merge_bp  # 导入文件合并蓝图
 
 app.register_blueprint(leader_bp, url_prefix='/api/leader')
@@ -50,6 +59,10 @@ def login():
     user = User.query.filter_by(username=username).first()
 
     if user and user.check_password(password):
+        # 停用（正在删除）的用户不能登录
+        if user.is_disabled:
+            return jsonify({'message': '用户已停用'}), 403
+
         # 创建会话并记录活动
         session_id = create_user_session(user.id)
         log_user_activity(
@@ -94,6 +107,8 @@ def register():
     new_user.set_password(password)
 
     db.session.add(new_user)
+    db.session.flush()
+    init_read_watermark(new_user.id)
     db.session.commit()
 
     return jsonify({'message': '用户注册成功'}), 201
@@ -191,6 +206,8 @@ def register():
     new_user.set_password(password)
 
     db.session.add(new_user)
+    db.session.flush()
+    init_read_watermark(new_user.id)
     db.session.commit()
 
     return jsonify({'message': '用户注册成功'}), 201
@@ -199,6 +216,7 @@ def register():
 if __name__ == '__main__':
     # 启动定时任务
     start_backup_scheduler()
+    start_maintenance_scheduler()
     with app.app_context():
         db.create_all()
 
@@ -218,6 +236,33 @@ if __name__ == '__main__':
         except Exception as e:
             print(f"用户活动日志表已存在或创建失败: {str(e)}")
 
+        # 用户停用标记（旧数据库补列）
+        try:
+            ensure_user_deletion_columns()
+        except Exception as e:
+            db.session.rollback()
+            print(f"用户停用标记列添加失败: {str(e)}")
+
+        # 公告阅读状态改为稀疏存储（旧数据库补列，并为已有用户补写已读水位）
+        try:
+            ensure_announcement_read_columns()
+        except Exception as e:
+            db.session.rollback()
+            print(f"公告阅读状态迁移失败: {str(e)}")
+
+        # 知识库节点的物化路径列（旧数据库补列并回填）
+        try:
+            ensure_kb_tree_columns()
+        except Exception as e:
+            print(f"知识库节点路径初始化失败: {str(e)}")
+
+        # 知识库文件全文索引及同步触发器
+        try:
+            tokenizer = ensure_kb_search_index()
+            print(f"知识库全文索引: {tokenizer or '不可用，使用 LIKE 查询'}")
+        except Exception as e:
+            print(f"知识库全文索引初始化失败: {str(e)}")
+
         print("永不宕机！程序开启时间：", time.strftime('%Y-%m-%d %H:%M:%S', time.localtime()))
         print(f"数据库在: {app.config['SQLALCHEMY_DATABASE_URI']}")
         # print("环境变量:", os.environ)
@@ -255,4 +300,38 @@ if __name__ == '__main__':
                 print(f"警告: 全文搜索表创建失败 - {str(e2)}")
                 print("将使用基础的LIKE查询作为备选方案")
 
+        # 补齐全文索引中缺失的文件内容
+        try:
+            rebuilt = sync_file_contents_fts()
+            if rebuilt:
+                print(f"已重建文件内容全文索引: {rebuilt} 条")
+        except Exception as e:
+            db.session.rollback()
+            print(f"文件内容全文索引同步失败: {str(e)}")
+
+        # 项目/子项目/阶段/任务/文件的统一检索索引
+        try:
+            tokenizer = ensure_entity_search_index()
+            print(f"统一检索索引: {tokenizer or '不可用，使用逐表查询'}")
+        except Exception as e:
+            db.session.rollback()
+            print(f"统一检索索引初始化失败: {str(e)}")
+
+        # 活动汇总表（首次启动时从已有日志生成）
+        try:
+            rollups = backfill_activity_rollups()
+            if rollups:
+                print(f"已从活动日志生成汇总: {rollups} 行")
+        except Exception as e:
+            db.session.rollback()
+            print(f"活动汇总生成失败: {str(e)}")
+
+        # 活动日志（热表和月分区）和会话的索引（按时间范围查询和游标分页）
+        try:
+            ensure_activity_log_indexes()
+            ensure_session_indexes()
+        except Exception as e:
+            db.session.rollback()
+            print(f"活动日志/会话索引创建失败: {str(e)}")
+
     app.run(host='0.0.0.0', port=6543, debug=False)
\ No newline at end of file
@@ -14,6 +14,7 @@ from models import db
 # APScheduler 配置
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 
 # === 电子邮件和API配置 ===
 MAIL_CONFIG = {
@@ -104,6 +105,41 @@ def start_backup_scheduler():
     print("定时备份任务已启动（每天凌晨 2 点）")
 
 
+# === 维护类定时任务（会话清理、缓存清理等） ===
+# 各模块在导入时通过 register_maintenance_job 登记任务，由 app.py 启动时统一调度
+MAINTENANCE_JOBS = {}
+
+
+def register_maintenance_job(job_id, func, **interval):
+    """
+    登记一个周期执行的维护任务
+    :param job_id: 任务ID（重复登记会覆盖）
+    :param func: 无参函数，执行时已处于应用上下文中
+    :param interval: IntervalTrigger 参数，例如 minutes=10
+    """
+    MAINTENANCE_JOBS[job_id] = (func, interval)
+    return func
+
+
+def _run_maintenance_job(job_id, func):
+    with app.app_context():
+        try:
+            func()
+        except Exception as e:
+            print(f"维护任务 {job_id} 执行出错: {e}")
+
+
+def start_maintenance_scheduler():
+    """启动所有已登记的维护任务"""
+    scheduler = BackgroundScheduler()
+    for job_id, (func, interval) in MAINTENANCE_JOBS.items():
+        scheduler.add_job(_run_maintenance_job, IntervalTrigger(**interval), args=[job_id, func],
+                          id=job_id, replace_existing=True)
+    scheduler.start()
+    print(f"维护任务已启动: {', '.join(MAINTENANCE_JOBS) or '无'}")
+    return scheduler
+
+
 # === Flask 应用初始化 (原有的) ===
 def create_app():
     app = Flask(__name__)
@@ -117,6 +153,59 @@ def create_app():
     # 这里设置的是上传的根目录，具体的子目录 将在路由中处理
     app.config['UPLOAD_FOLDER'] = '/volume1/web/FileManagementFolder/uploads'
 
+    # 文件合并会话存储：'sqlite' 在多个 worker 间共享；'memory' 仅适用于单进程开发环境
+    app.config['MERGE_SESSION_BACKEND'] = 'sqlite'
+    app.config['MERGE_SESSION_TTL'] = 60 * 60  # 会话及其临时目录的存活时间（秒）
+    # 合并进度 SSE：每个进程的最大连接数、心跳间隔、跨 worker 重新读取间隔、无进度超时（秒）
+    app.config['MERGE_SSE_MAX_STREAMS'] = 50
+    app.config['MERGE_SSE_HEARTBEAT_INTERVAL'] = 15
+    app.config['MERGE_SSE_RECHECK_INTERVAL'] = 2
+    app.config['MERGE_SSE_IDLE_TIMEOUT'] = 300
+    # 封面/目录页渲染缓存目录（None 表示系统临时目录下的 merge_page_cache）及最多缓存的页面数
+    app.config['MERGE_PAGE_CACHE_DIR'] = None
+    app.config['MERGE_PAGE_CACHE_MAX_ENTRIES'] = 256
+    # 合并过程中临时 PDF 的根目录，建议指向较快的本地磁盘或 tmpfs（None 表示系统临时目录）
+    app.config['MERGE_SCRATCH_DIR'] = None
+
+    # 文件下载方式：'direct' 由 Flask 发送（开发环境）；'x-accel' 由 nginx 通过 X-Accel-Redirect 发送；
+    # 'x-sendfile' 由 Apache/lighttpd 通过 X-Sendfile 发送
+    app.config['FILE_SERVING_MODE'] = 'direct'
+    # x-accel 模式下本地目录前缀到 nginx internal location 的映射，不在映射中的文件仍由 Flask 发送
+    app.config['X_ACCEL_LOCATIONS'] = {
+        '/volume1/web/FileManagementFolder': '/protected-files',
+    }
+
+    # 知识库批量上传/复制/zip 导入时并发写文件和提取文本的线程数，以及 zip 解压后的最大总大小
+    app.config['KB_BULK_WORKERS'] = 4
+    app.config['KB_IMPORT_MAX_BYTES'] = 2 * 1024 * 1024 * 1024
+
+    # 搜索结果缓存的存活时间（秒）和最大条目数；自动补全名称索引的整体重新加载间隔（秒）
+    app.config['SEARCH_CACHE_TTL'] = 60
+    app.config['SEARCH_CACHE_MAX_ENTRIES'] = 512
+    app.config['SEARCH_SUGGEST_REFRESH'] = 300
+
+    # 活动日志按月分区：分区文件目录（None 表示数据库目录下的 activity_logs）、
+    # 分区保留月数（更早的分区压缩归档，不再参与查询）、归档文件保留月数（None 表示永久保留）
+    app.config['ACTIVITY_LOG_PARTITION_DIR'] = None
+    app.config['ACTIVITY_LOG_RETENTION_MONTHS'] = 12
+    app.config['ACTIVITY_LOG_ARCHIVE_MONTHS'] = None
+
+    # 会话无活动超时时间（秒），超时会话由后台任务定期结束
+    app.config['SESSION_IDLE_TIMEOUT'] = 60 * 60
+
+    # 管理员批量删除文件时并发删除物理文件的线程数
+    app.config['FILE_DELETE_WORKERS'] = 8
+
+    # 后台删除用户时每个事务处理的行数，以及两个事务之间的间隔（秒），让其他请求有机会写入
+    app.config['USER_DELETION_CHUNK_SIZE'] = 1000
+    app.config['USER_DELETION_CHUNK_PAUSE'] = 0.05
+
+    # 未读公告数缓存的存活时间（秒），限制其他 worker 进程中的修改最长多久后可见；
+    # 推送连接的心跳间隔（秒）和单个连接的最长保持时间（秒，之后客户端自动重连）
+    app.config['ANNOUNCEMENT_UNREAD_CACHE_TTL'] = 300
+    app.config['ANNOUNCEMENT_STREAM_HEARTBEAT'] = 25
+    app.config['ANNOUNCEMENT_STREAM_MAX_AGE'] = 600
+
     migrate = Migrate(app, db)
 
     system_platform = platform.system()
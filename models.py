@@ -20,6 +20,8 @@ class User(db.Model):
 
     # Add new field for team leader relationship
     team_leader_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='SET NULL'), nullable=True)
+    # 已停用（正在后台删除）的用户不能登录，也不能继续使用已签发的令牌
+    is_disabled = db.Column(db.Boolean, nullable=False, default=False, server_default='0')
 
     def set_password(self, password):
         self.password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
@@ -355,6 +357,22 @@ class FileContent(db.Model):
                 pass
 
 
+# 让 file_contents_fts 随 FileContent 的增删改同步（全文索引不可用时各方法内部会忽略错误）
+@event.listens_for(FileContent, 'after_insert')
+def _file_content_after_insert(mapper, connection, target):
+    target.after_insert(connection)
+
+
+@event.listens_for(FileContent, 'after_update')
+def _file_content_after_update(mapper, connection, target):
+    target.after_update(connection)
+
+
+@event.listens_for(FileContent, 'after_delete')
+def _file_content_after_delete(mapper, connection, target):
+    target.after_delete(connection)
+
+
 # --------------------------------------------
 
 
@@ -453,6 +471,71 @@ class UserActivityLog(db.Model):
             print(f"错误记录活动： {str(e)}")
 
 
+# 用户活动汇总表：按天、用户、端点、操作类型、状态码预聚合的活动次数
+# 写入活动日志时在同一事务中增量更新（见 utils/activity_rollups.py），统计接口只读本表
+class UserActivityRollup(db.Model):
+    __tablename__ = 'user_activity_rollups'
+    __table_args__ = (
+        db.UniqueConstraint('bucket_type', 'bucket_start', 'user_id', 'endpoint', 'action_type', 'status_code',
+                            name='uq_activity_rollup_bucket'),
+        db.Index('ix_activity_rollup_user', 'user_id', 'bucket_type', 'bucket_start'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    bucket_type = db.Column(db.String(10), nullable=False)  # day
+    bucket_start = db.Column(db.DateTime, nullable=False)  # 当天的起始时间
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    endpoint = db.Column(db.String(255), nullable=False, default='')  # 空字符串表示无端点
+    action_type = db.Column(db.String(50), nullable=False)
+    status_code = db.Column(db.Integer, nullable=False, default=0)  # 0 表示无状态码
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+
+# 系统指标：后台任务写入的计数（例如会话清理），管理接口直接读取，不在请求中重新计算
+class SystemMetric(db.Model):
+    __tablename__ = 'system_metrics'
+
+    name = db.Column(db.String(100), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+
+
+# 用户删除任务：停用用户后由后台线程分块删除/解除其关联数据，最后删除用户本身（见 utils/user_deletion.py）
+class UserDeletionJob(db.Model):
+    __tablename__ = 'user_deletion_jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False, index=True)  # 用户删除后仍保留任务记录，不设外键
+    username = db.Column(db.String(80))
+    requested_by = db.Column(db.Integer)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, running, completed, failed
+    current_step = db.Column(db.String(100))
+    step_index = db.Column(db.Integer, nullable=False, default=0)  # 已完成的步骤数
+    total_steps = db.Column(db.Integer, nullable=False, default=0)
+    processed_rows = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+    finished_at = db.Column(db.DateTime)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'username': self.username,
+            'status': self.status,
+            'current_step': self.current_step,
+            'step_index': self.step_index,
+            'total_steps': self.total_steps,
+            'progress': int(self.step_index * 100 / self.total_steps) if self.total_steps else 0,
+            'processed_rows': self.processed_rows,
+            'error': self.error,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S') if self.created_at else None,
+            'updated_at': self.updated_at.strftime('%Y-%m-%d %H:%M:%S') if self.updated_at else None,
+            'finished_at': self.finished_at.strftime('%Y-%m-%d %H:%M:%S') if self.finished_at else None,
+        }
+
+
 # ----------------公告板模型----------------
 class Announcement(db.Model):
     __tablename__ = 'announcements'
@@ -465,13 +548,15 @@ class Announcement(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
     is_active = db.Column(db.Boolean, default=True)  # 用于软删除
     priority = db.Column(db.Integer, default=0)  # 优先级：0=普通，1=重要，2=紧急
+    # 最近一次内容变更的时间，早于它的已读记录视为未读（见 utils/announcement_reads.py）
+    revised_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
 
     # 关系
     creator = db.relationship('User', backref=db.backref('announcements', lazy='dynamic'))
     read_status = db.relationship('AnnouncementReadStatus', back_populates='announcement', cascade='all, delete-orphan')
 
 
-# 公告阅读状态表
+# 公告阅读状态表：只保存已读回执和用户手动标记的未读，没有记录即按水位判断
 class AnnouncementReadStatus(db.Model):
     __tablename__ = 'announcement_read_status'
 
@@ -491,6 +576,16 @@ class AnnouncementReadStatus(db.Model):
     )
 
 
+# 公告已读水位：seen_until 之前（按 revised_at）的公告对该用户都视为已读（“全部标为已读”）
+class AnnouncementReadWatermark(db.Model):
+    __tablename__ = 'announcement_read_watermarks'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    seen_until = db.Column(db.DateTime, nullable=False)
+    # 用户开始接收公告的时间（创建用户时写入），更早发布的公告不计入该用户的未读数和阅读统计
+    joined_at = db.Column(db.DateTime, nullable=True)
+
+
 # 公告附件表
 class AnnouncementAttachment(db.Model):
     __tablename__ = 'announcement_attachments'
@@ -683,6 +778,9 @@ class KnowledgeBase(db.Model):
 # [修改] 知识库节点模型
 class KnowledgeBaseNode(db.Model):
     __tablename__ = 'knowledge_base_nodes'
+    __table_args__ = (
+        db.Index('ix_kb_nodes_kb_path', 'kb_id', 'path'),  # 子树范围查询
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(255), nullable=False)
@@ -694,6 +792,10 @@ class KnowledgeBaseNode(db.Model):
     # --- 新增外键，关联到知识库主表 ---
     kb_id = db.Column(db.Integer, db.ForeignKey('knowledge_bases.id'), nullable=False)
 
+    # --- 物化路径：从根到自身的节点ID，如 '/1/5/9/'，用于子树的范围查询、移动和删除 ---
+    path = db.Column(db.String(1024))
+    depth = db.Column(db.Integer, nullable=False, default=0)  # 根节点为 0
+
     created_at = db.Column(db.DateTime, default=datetime.now)
     updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
 
@@ -737,6 +839,8 @@ class KnowledgeBaseFile(db.Model):
     upload_date = db.Column(db.DateTime, default=datetime.now)
     node = db.relationship('KnowledgeBaseNode', back_populates='files')
     upload_user = db.relationship('User', backref='knowledge_base_files')
+    content = db.relationship('KnowledgeBaseFileContent', backref='file', uselist=False,
+                              cascade='all, delete-orphan', passive_deletes=True)
 
     def to_dict(self):
         return {
@@ -748,3 +852,46 @@ class KnowledgeBaseFile(db.Model):
             'upload_user_id': self.upload_user_id,
             'upload_date': self.upload_date.isoformat()
         }
+
+
+# 知识库文件提取出的文本（全文索引 kb_file_contents_fts 以此表为外部内容表，由触发器同步，见 utils/kb_search.py）
+class KnowledgeBaseFileContent(db.Model):
+    __tablename__ = 'kb_file_contents'
+
+    file_id = db.Column(db.Integer, db.ForeignKey('knowledge_base_files.id', ondelete='CASCADE'), primary_key=True)
+    title = db.Column(db.String(255))  # 文件名，参与检索
+    content = db.Column(db.Text)
+    extracted_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+
+
+# 文件合并会话表（多 worker 共享合并进度与临时目录信息）
+class MergeSession(db.Model):
+    __tablename__ = 'merge_sessions'
+
+    session_id = db.Column(db.String(64), primary_key=True)
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    status_message = db.Column(db.String(255))
+    status = db.Column(db.String(20), nullable=False, default='running')  # running, completed, error
+    completed = db.Column(db.Boolean, nullable=False, default=False)
+    error = db.Column(db.Text)
+    version = db.Column(db.Integer, nullable=False, default=1)  # 每次更新递增，作为 SSE 事件 ID
+    pdf_temp_dir = db.Column(db.String(512))  # PDF 生成临时目录
+    image_temp_dir = db.Column(db.String(512))  # 预览图片临时目录
+    start_time = db.Column(db.Float, nullable=False)  # time.time()
+    updated_at = db.Column(db.Float, nullable=False)
+    expires_at = db.Column(db.Float, nullable=False, index=True)
+
+    def to_dict(self):
+        return {
+            'progress': self.progress,
+            'status_message': self.status_message,
+            'status': self.status,
+            'completed': self.completed,
+            'error': self.error,
+            'version': self.version,
+            'pdf_temp_dir': self.pdf_temp_dir,
+            'image_temp_dir': self.image_temp_dir,
+            'start_time': self.start_time,
+            'updated_at': self.updated_at,
+            'expires_at': self.expires_at
+        }
@@ -12,6 +12,7 @@ from sqlalchemy.exc import SQLAlchemyError
 from models import db, User, AIApi, AIConversation, AIMessage, AITag, AIConversationTag, AIMessageFeedback
 from routes.employees import token_required
 from utils.activity_tracking import track_activity
+from utils.bulk_write import bulk_insert
 
 ai_bp = Blueprint('ai', __name__)
 CORS(ai_bp)  # 为此蓝图启用 CORS
@@ -60,6 +61,23 @@ def call_deepseek_api(messages, user_id, model="deepseek-chat"):
         return {"error": str(e)}, 500
 
 
+def set_conversation_tags(conversation_id, tag_names, replace=False):
+    """
+    批量设置对话标签：缺少的标签和关联行各用一次批量插入写入，已存在的行跳过（调用方负责 commit）
+    :param replace: 是否先移除对话现有的全部标签
+    """
+    if replace:
+        AIConversationTag.query.filter_by(conversation_id=conversation_id).delete(synchronize_session=False)
+    names = list(dict.fromkeys(name for name in tag_names if name))
+    if not names:
+        return
+
+    bulk_insert(AITag, [{'name': name} for name in names], on_conflict_do_nothing=True)
+    tag_ids = [tag_id for (tag_id,) in db.session.query(AITag.id).filter(AITag.name.in_(names))]
+    bulk_insert(AIConversationTag, [{'conversation_id': conversation_id, 'tag_id': tag_id} for tag_id in tag_ids],
+                on_conflict_do_nothing=True)
+
+
 @ai_bp.route('/api-keys', methods=['GET'])
 @track_activity
 @token_required
@@ -272,17 +290,7 @@ def create_conversation(current_user):
             db.session.add(message)
 
         # 添加标签（如果提供）
-        tags = data.get('tags', [])
-        for tag_name in tags:
-            # 查找或创建标签
-            tag = AITag.query.filter_by(name=tag_name).first()
-            if not tag:
-                tag = AITag(name=tag_name)
-                db.session.add(tag)
-                db.session.flush()  # 获取新标签的ID
-
-            # 将标签和对话关联起来
-            conversation.tags.append(tag)
+        set_conversation_tags(conversation.id, data.get('tags', []))
 
         db.session.commit()
 
@@ -367,18 +375,8 @@ def update_conversation(current_user, conv_id):
             conversation.is_archived = data['is_archived']
 
         if 'tags' in data:
-            # 移除所有现有标签
-            conversation.tags.clear()
-
-            # 添加新标签
-            for tag_name in data['tags']:
-                tag = AITag.query.filter_by(name=tag_name).first()
-                if not tag:
-                    tag = AITag(name=tag_name)
-                    db.session.add(tag)
-                    db.session.flush()
-
-                conversation.tags.append(tag)
+            # 替换为新标签（批量写入，提交后 conversation.tags 重新加载）
+            set_conversation_tags(conversation.id, data['tags'], replace=True)
 
         conversation.updated_at = datetime.now()
         db.session.commit()
@@ -2,8 +2,14 @@
 import os
 
 from flask import Blueprint, request, jsonify, current_app
-from models import User, UserSession, UserActivityLog, Project, ProjectFile
+from sqlalchemy import func
+from models import User, UserSession, UserActivityRollup, Project, ProjectFile
 from utils.activity_tracking import track_activity, log_user_activity
+from utils.activity_rollups import count_activities, count_today, daily_trend, breakdown
+from utils.activity_log_store import query_activity_logs
+from utils.session_store import query_sessions, reap_idle_sessions, METRIC_REAPED_LAST
+from utils.system_metrics import get_metrics
+from utils.file_deletion import find_files, find_files_by_ids, delete_files, STATUS_DELETED
 import jwt
 import datetime
 from config import app, db
@@ -20,82 +26,105 @@ def check_admin_auth():
     return data
 
 
+def parse_date_range():
+    """
+    读取 start_date / end_date（YYYY-MM-DD，均包含当天）
+    :return: (起点, 终点（次日零点，不含）)，未指定的为 None
+    :raises ValueError: 日期格式错误
+    """
+    start_date = request.args.get('start_date')
+    end_date = request.args.get('end_date')
+    start = datetime.datetime.strptime(start_date, '%Y-%m-%d') if start_date else None
+    end = datetime.datetime.strptime(end_date, '%Y-%m-%d') + datetime.timedelta(days=1) if end_date else None
+    return start, end
+
+
+def get_page_size(default=20, maximum=200):
+    return max(1, min(request.args.get('per_page', default, type=int), maximum))
+
+
+def format_duration(seconds):
+    """把秒数转换为“1小时”“30分钟”“90秒”之类的说明"""
+    if seconds % 3600 == 0:
+        return f'{seconds // 3600}小时'
+    if seconds % 60 == 0:
+        return f'{seconds // 60}分钟'
+    return f'{seconds}秒'
+
+
 # 活动日志接口
+# 游标分页：第一页不传 cursor，之后传上一页返回的 next_cursor；with_total=1 时按活动汇总表返回总数
 @admin_bp.route('/activity-logs', methods=['GET'])
 @track_activity
 def get_activity_logs():
     try:
         check_admin_auth()
 
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 20, type=int)
+        per_page = get_page_size()
         user_id = request.args.get('user_id', type=int)
-
-        query = UserActivityLog.query
-        if user_id:
-            query = query.filter_by(user_id=user_id)
-
-        logs = query.order_by(UserActivityLog.id.desc()).paginate(
-            page=page, per_page=per_page, error_out=False
-        )
+        action_type = request.args.get('action_type') or None
+        cursor = request.args.get('cursor') or None
+        with_total = request.args.get('with_total', '').lower() in ('1', 'true')
+        try:
+            # 只读取与日期范围有交集的月分区
+            start, end = parse_date_range()
+            logs, next_cursor = query_activity_logs(per_page=per_page, user_id=user_id, action_type=action_type,
+                                                    start=start, end=end, cursor=cursor)
+        except ValueError as e:
+            return jsonify({'message': str(e) if cursor else '日期格式应为 YYYY-MM-DD'}), 400
 
         return jsonify({
             'logs': [{
-                'id': log.id,
-                'user_id': log.user_id,
-                'username': log.user.username,
-                'action_type': log.action_type,
-                'action_detail': log.action_detail,
-                'ip_address': log.ip_address,
-                'timestamp': log.timestamp,
-                'resource_type': log.resource_type,
-                'resource_id': log.resource_id
-            } for log in logs.items],
-            'total': logs.total,
-            'pages': logs.pages,
-            'current_page': page
+                'id': log['id'],
+                'user_id': log['user_id'],
+                'username': log['username'],
+                'action_type': log['action_type'],
+                'action_detail': log['action_detail'],
+                'ip_address': log['ip_address'],
+                'timestamp': log['timestamp'],
+                'resource_type': log['resource_type'],
+                'resource_id': log['resource_id']
+            } for log in logs],
+            'per_page': per_page,
+            'next_cursor': next_cursor,
+            'has_more': next_cursor is not None,
+            # 近似值：来自按天汇总（含已归档的日志）
+            'total': count_activities(user_id=user_id, start=start, end=end,
+                                      action_type=action_type) if with_total else None
         })
 
     except Exception as e:
         return jsonify({'message': str(e)}), 500
 
 
+# 会话列表：按会话 ID 倒序游标分页，cursor 为上一页返回的 next_cursor
+# 总数（summary.total_sessions）每页都返回：无用户/状态过滤时按 ID 范围估算，否则为索引上的 COUNT
 @admin_bp.route('/sessions', methods=['GET'])
 @track_activity
 def get_sessions():
     try:
         check_admin_auth()
 
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 20, type=int)
+        per_page = get_page_size()
         user_id = request.args.get('user_id', type=int)
-        start_date = request.args.get('start_date')
-        end_date = request.args.get('end_date')
-        is_active = request.args.get('is_active', type=bool)
-
-        query = UserSession.query
-
-        if user_id:
-            query = query.filter_by(user_id=user_id)
-        if is_active is not None:
-            query = query.filter_by(is_active=is_active)
-        if start_date:
-            query = query.filter(UserSession.login_time >= start_date)
-        if end_date:
-            query = query.filter(UserSession.login_time <= end_date)
-
-        sessions = query.order_by(UserSession.id.desc()).paginate(
-            page=page, per_page=per_page, error_out=False
-        )
+        cursor = request.args.get('cursor', type=int)
+        is_active = request.args.get('is_active')
+        is_active = None if is_active in (None, '') else is_active.lower() in ('1', 'true')
+        try:
+            start, end = parse_date_range()
+        except ValueError:
+            return jsonify({'message': '日期格式应为 YYYY-MM-DD'}), 400
 
+        rows, next_cursor, total = query_sessions(per_page=per_page, user_id=user_id, is_active=is_active,
+                                                  start=start, end=end, cursor=cursor, with_total=True)
+
+        current_time = datetime.datetime.now()
         sessions_data = []
-        for session in sessions.items:
-            user = session.user
-            current_time = datetime.datetime.now()
+        for session, username in rows:
             session_data = {
                 'id': session.id,
                 'user_id': session.user_id,
-                'username': user.username if user else None,
+                'username': username,
                 'login_time': session.login_time,
                 'logout_time': session.logout_time,
                 'is_active': session.is_active,
@@ -112,12 +141,12 @@ def get_sessions():
 
         return jsonify({
             'sessions': sessions_data,
-            'total': sessions.total,
-            'pages': sessions.pages,
-            'current_page': page,
             'per_page': per_page,
+            'next_cursor': next_cursor,
+            'has_more': next_cursor is not None,
+            'total': total,
             'summary': {
-                'total_sessions': sessions.total,
+                'total_sessions': total,
                 'active_sessions': sum(1 for s in sessions_data if s['is_active']),
                 'average_duration': sum(s['session_duration'] or 0 for s in sessions_data) / len(
                     sessions_data) if sessions_data else 0
@@ -150,18 +179,13 @@ def get_system_alerts():
                 'time': current_time.strftime('%Y-%m-%d %H:%M:%S')
             })
 
-        # 检查长时间未活动的会话
-        inactive_sessions = UserSession.query.filter_by(is_active=True).all()
-        inactive_count = 0
-        for session in inactive_sessions:
-            if (current_time - session.last_activity_time).total_seconds() > 3600:
-                inactive_count += 1
-
-        if inactive_count > 0:
+        # 长时间未活动的会话由后台任务定期结束（utils/session_store.py），这里只读取最近一次的结果
+        reaped = get_metrics(METRIC_REAPED_LAST).get(METRIC_REAPED_LAST)
+        if reaped and reaped[0] > 0:
             alerts.append({
                 'type': '系统告警',
-                'content': f'有 {inactive_count} 个会话超过1小时未活动',
-                'time': current_time.strftime('%Y-%m-%d %H:%M:%S')
+                'content': f'有 {reaped[0]} 个会话超过{format_duration(current_app.config["SESSION_IDLE_TIMEOUT"])}未活动，已自动结束',
+                'time': reaped[1].strftime('%Y-%m-%d %H:%M:%S')
             })
 
         return jsonify({
@@ -209,10 +233,8 @@ def get_dashboard_stats():
         # 获取基础统计数据
         total_users = User.query.count()
         active_users = UserSession.query.filter_by(is_active=True).count()
-        today = datetime.datetime.now().date()
-        today_activities = UserActivityLog.query.filter(
-            db.func.date(UserActivityLog.timestamp) == today
-        ).count()
+        # 活动次数读取按天预聚合的汇总表（utils/activity_rollups.py）
+        today_activities = count_today()
 
         # 获取项目统计
         projects = Project.query.all()
@@ -225,14 +247,7 @@ def get_dashboard_stats():
         }
 
         # 获取最近活动趋势
-        activity_trends = db.session.query(
-            db.func.date(UserActivityLog.timestamp).label('date'),
-            db.func.count(UserActivityLog.id).label('count')
-        ).group_by(
-            db.func.date(UserActivityLog.timestamp)
-        ).order_by(
-            db.func.date(UserActivityLog.timestamp).desc()
-        ).limit(30).all()
+        activity_trends = daily_trend(30)
 
         return jsonify({
             'user_stats': {
@@ -328,23 +343,11 @@ def get_user_stats():
 
         user_id = request.args.get('user_id', type=int)
 
-        # 基础查询
-        base_query = UserActivityLog.query
-        if user_id:
-            base_query = base_query.filter_by(user_id=user_id)
-
-        # 获取今天的日期
-        today = datetime.datetime.now().strftime('%Y-%m-%d')
-
-        # 获取各种统计数据
+        # 获取各种统计数据（来自活动汇总表）
         stats = {
-            'total_activities': base_query.count(),
-            'today_activities': base_query.filter(
-                UserActivityLog.timestamp.like(f'{today}%')
-            ).count(),
-            'login_count': base_query.filter_by(
-                action_type='login'
-            ).count(),
+            'total_activities': count_activities(user_id=user_id),
+            'today_activities': count_today(user_id=user_id),
+            'login_count': count_activities(user_id=user_id, action_type='login'),
             'total_sessions': UserSession.query.filter_by(
                 user_id=user_id
             ).count() if user_id else UserSession.query.count()
@@ -375,18 +378,8 @@ def clear_expired_sessions():
         if data.get('role') != 0:
             return jsonify({'message': '权限不足'}), 403
 
-        # 获取所有活动会话
-        active_sessions = UserSession.query.filter_by(is_active=True).all()
-        cleared_count = 0
-
-        for session in active_sessions:
-            # last_activity = datetime.datetime.strptime(session.last_activity_time, '%Y-%m-%d %H:%M:%S')
-            last_activity = session.last_activity_time
-            if (datetime.datetime.now() - last_activity) > datetime.timedelta(hours=1):
-                session.end_session()
-                cleared_count += 1
-
-        db.session.commit()
+        # 与后台定时任务相同：一条 UPDATE 结束所有超时会话
+        cleared_count = reap_idle_sessions()
 
         return jsonify({
             'message': f'已清理 {cleared_count} 个过期会话',
@@ -411,23 +404,9 @@ def get_user_activity_summary():
             user_id=user_id
         ).order_by(UserSession.id.desc()).first()
 
-        # 获取今天的活动数量
-        today = datetime.datetime.now().strftime('%Y-%m-%d')
-        today_activities = UserActivityLog.query.filter_by(
-            user_id=user_id
-        ).filter(
-            UserActivityLog.timestamp.like(f'{today}%')
-        ).count()
-
-        # 获取用户的总活动统计
-        activity_stats = db.session.query(
-            UserActivityLog.action_type,
-            db.func.count(UserActivityLog.id)
-        ).filter_by(
-            user_id=user_id
-        ).group_by(
-            UserActivityLog.action_type
-        ).all()
+        # 获取今天的活动数量和按操作类型的总活动统计（来自活动汇总表）
+        today_activities = count_today(user_id=user_id)
+        activity_stats = breakdown(UserActivityRollup.action_type, user_id=user_id)
 
         return jsonify({
             'last_session': {
@@ -537,56 +516,24 @@ def admin_batch_delete_files():
         if not file_ids:
             return jsonify({'error': '未提供文件ID列表'}), 400
 
-        deleted_files = []
-        error_files = []
-
-        for file_id in file_ids:
-            try:
-                # 获取文件记录
-                file = ProjectFile.query.get(file_id)
-                if not file:
-                    error_files.append({'id': file_id, 'error': '文件不存在'})
-                    continue
-
-                # 记录被删除的文件信息
-                file_info = {
-                    'id': file.id,
-                    'name': file.original_name,
-                    'project': file.project.name if file.project else "Unknown",
-                    'subproject': file.subproject.name if file.subproject else "Unknown",
-                    'stage': file.stage.name if file.stage else "Unknown",
-                    'task': file.task.name if file.task else "Unknown"
-                }
-
-                # 获取物理文件路径
-                file_path = os.path.join(app.root_path, file.file_path)
-
-                # 先删除文件内容记录（如果存在）
-                if file.content:
-                    db.session.delete(file.content)
-
-                # 删除文件数据库记录
-                db.session.delete(file)
-
-                # 删除物理文件
-                if os.path.exists(file_path):
-                    try:
-                        os.remove(file_path)
-                    except OSError:
-                        # 记录错误但继续执行
-                        pass
+        files = find_files_by_ids(file_ids)
+        found_ids = {file['id'] for file in files}
+        results = delete_files(files)
 
+        deleted_files = []
+        error_files = [{'id': file_id, 'error': '文件不存在'} for file_id in dict.fromkeys(file_ids)
+                       if file_id not in found_ids]
+        for result in results:
+            file_info = {key: result[key] for key in ('id', 'name', 'project', 'subproject', 'stage', 'task')}
+            if result['status'] == STATUS_DELETED:
+                file_info['file_removed'] = result['file_removed']
+                if result['error']:
+                    file_info['file_error'] = result['error']
                 deleted_files.append(file_info)
+            else:
+                error_files.append({'id': result['id'], 'error': result['error']})
 
-            except Exception as e:
-                error_files.append({'id': file_id, 'error': str(e)})
-                # 回滚当前文件的删除操作
-                db.session.rollback()
-
-        # 提交所有成功的删除
         if deleted_files:
-            db.session.commit()
-
             # 记录操作日志
             log_user_activity(
                 user_id=admin_id,
@@ -627,28 +574,27 @@ def admin_delete_files_by_filter():
         date_after = data.get('date_after')  # 格式: "YYYY-MM-DD"
         file_type = data.get('file_type')  # 文件类型
 
-        # 构建查询
-        query = ProjectFile.query
-
+        # 构建筛选条件
+        criteria = []
         if project_id:
-            query = query.filter(ProjectFile.project_id == project_id)
+            criteria.append(ProjectFile.project_id == project_id)
         if subproject_id:
-            query = query.filter(ProjectFile.subproject_id == subproject_id)
+            criteria.append(ProjectFile.subproject_id == subproject_id)
         if stage_id:
-            query = query.filter(ProjectFile.stage_id == stage_id)
+            criteria.append(ProjectFile.stage_id == stage_id)
         if task_id:
-            query = query.filter(ProjectFile.task_id == task_id)
+            criteria.append(ProjectFile.task_id == task_id)
         if upload_user_id:
-            query = query.filter(ProjectFile.upload_user_id == upload_user_id)
+            criteria.append(ProjectFile.upload_user_id == upload_user_id)
         if date_before:
-            query = query.filter(ProjectFile.upload_date <= datetime.strptime(date_before, "%Y-%m-%d"))
+            criteria.append(ProjectFile.upload_date <= datetime.datetime.strptime(date_before, "%Y-%m-%d"))
         if date_after:
-            query = query.filter(ProjectFile.upload_date >= datetime.strptime(date_after, "%Y-%m-%d"))
+            criteria.append(ProjectFile.upload_date >= datetime.datetime.strptime(date_after, "%Y-%m-%d"))
         if file_type:
-            query = query.filter(ProjectFile.file_type.like(f"%{file_type}%"))
+            criteria.append(ProjectFile.file_type.like(f"%{file_type}%"))
 
         # 获取符合条件的文件数量
-        matching_count = query.count()
+        matching_count = db.session.query(func.count(ProjectFile.id)).filter(*criteria).scalar()
 
         # 安全检查：如果匹配的文件太多，需要确认
         if matching_count > 100 and not data.get('confirmed'):
@@ -658,45 +604,12 @@ def admin_delete_files_by_filter():
                 'matching_count': matching_count
             }), 200
 
-        # 获取所有匹配的文件
-        matching_files = query.all()
-
-        deleted_count = 0
-        error_count = 0
-
-        # 删除所有匹配的文件
-        for file in matching_files:
-            try:
-                # 获取物理文件路径
-                file_path = os.path.join(app.root_path, file.file_path)
-
-                # 先删除文件内容记录（如果存在）
-                if file.content:
-                    db.session.delete(file.content)
-
-                # 删除文件数据库记录
-                db.session.delete(file)
+        # 一条查询取出所有匹配的文件，分块批量删除记录，提交后并发删除物理文件
+        results = delete_files(find_files(*criteria))
+        deleted_count = sum(1 for result in results if result['status'] == STATUS_DELETED)
+        error_count = len(results) - deleted_count
 
-                # 删除物理文件
-                if os.path.exists(file_path):
-                    try:
-                        os.remove(file_path)
-                    except OSError:
-                        # 记录错误但继续执行
-                        pass
-
-                deleted_count += 1
-
-            except Exception as e:
-                error_count += 1
-                print(f"删除文件 {file.id} 时出错: {str(e)}")
-                # 单个文件删除失败不影响其他文件
-                db.session.rollback()
-
-        # 提交所有成功的删除
         if deleted_count > 0:
-            db.session.commit()
-
             # 记录操作日志
             filter_description = ', '.join(f"{k}:{v}" for k, v in data.items() if k != 'confirmed' and v)
             log_user_activity(
@@ -710,7 +623,9 @@ def admin_delete_files_by_filter():
             'message': f'批量删除完成: {deleted_count} 个文件删除成功, {error_count} 个文件删除失败',
             'deleted_count': deleted_count,
             'error_count': error_count,
-            'total_matched': matching_count
+            'total_matched': matching_count,
+            'errors': [{'id': result['id'], 'name': result['name'], 'error': result['error']}
+                       for result in results if result['status'] != STATUS_DELETED]
         })
 
     except Exception as e:
@@ -3,15 +3,20 @@ import os
 from pipes import quote
 
 import jwt
-from flask import Blueprint, request, jsonify, send_from_directory
+from flask import Blueprint, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 from datetime import datetime
 
 from werkzeug.utils import secure_filename
 
-from models import db, Announcement, AnnouncementReadStatus, User, AnnouncementAttachment
-from routes.employees import token_required
+from models import db, Announcement, User, AnnouncementAttachment
+from routes.employees import token_required, get_user_from_query_token
 from utils.activity_tracking import track_activity
+from utils.file_serving import serve_file_from_directory
+from utils.announcement_reads import read_states, set_read_state, mark_all_read, read_statistics
+from utils.bulk_write import bulk_insert
+from utils.announcement_unread import get_unread_count as cached_unread_count, invalidate_unread_counts, \
+    unread_count_events
 
 announcement_bp = Blueprint('announcement', __name__)
 CORS(announcement_bp)
@@ -74,6 +79,7 @@ def create_announcement(current_user):
         # 处理文件上传
         files = request.files.getlist('attachments')
         attachments = []
+        attachment_rows = []
 
         for file in files:
             if file and file.filename and allowed_file(file.filename):
@@ -89,32 +95,26 @@ def create_announcement(current_user):
                 # 保存文件
                 file.save(file_path)
 
-                # 创建附件记录 - 使用原始文件名
-                attachment = AnnouncementAttachment(
-                    announcement_id=announcement.id,
-                    original_filename=original_filename,  # 安全处理后的原始文件名
-                    stored_filename=stored_filename,  # 存储用的唯一文件名
-                    file_size=os.path.getsize(file_path),
-                    file_type=file.content_type if hasattr(file, 'content_type') else None
-                )
-                db.session.add(attachment)
+                # 附件记录 - 使用原始文件名，循环结束后批量写入
+                attachment_rows.append({
+                    'announcement_id': announcement.id,
+                    'original_filename': original_filename,  # 安全处理后的原始文件名
+                    'stored_filename': stored_filename,  # 存储用的唯一文件名
+                    'file_size': os.path.getsize(file_path),
+                    'file_type': file.content_type if hasattr(file, 'content_type') else None
+                })
 
                 # 在响应中使用原始文件名，保持与数据库一致
                 attachments.append({
                     'filename': original_filename,  # 使用安全处理后的原始文件名
-                    'size': attachment.file_size
+                    'size': attachment_rows[-1]['file_size']
                 })
 
-        # 为所有用户创建读取状态
-        users = User.query.all()
-        for user in users:
-            read_status = AnnouncementReadStatus(
-                announcement_id=announcement.id,
-                user_id=user.id
-            )
-            db.session.add(read_status)
+        bulk_insert(AnnouncementAttachment, attachment_rows)
 
+        # 阅读状态按需记录（utils/announcement_reads.py），发布时不再为每个用户写入状态
         db.session.commit()
+        invalidate_unread_counts()
 
         return jsonify({
             'message': '公告创建成功',
@@ -174,16 +174,10 @@ def preview_attachment(announcement_id, attachment_id):
         if not attachment.original_filename.lower().endswith('.pdf'):
             return jsonify({'error': '不是PDF文件，无法预览'}), 400
 
-        # 将公告标记为已读（如果尚未）
-        read_status = AnnouncementReadStatus.query.filter_by(
-            announcement_id=announcement_id,
-            user_id=current_user.id
-        ).first()
-
-        if read_status and not read_status.is_read:
-            read_status.is_read = True
-            read_status.read_at = datetime.now()
-            db.session.commit()
+        # 将公告标记为已读
+        set_read_state(current_user.id, announcement_id)
+        db.session.commit()
+        invalidate_unread_counts(current_user.id)
 
         # 返回文件信息和直接访问URL
         return jsonify({
@@ -235,18 +229,16 @@ def view_pdf_attachment(announcement_id, attachment_id):
             announcement_id=announcement_id
         ).first_or_404()
 
-        # 为PDF预览设置正确的Content-Type
-        response = send_from_directory(
+        # 为PDF预览设置正确的Content-Type，内容处置为inline以在浏览器中预览
+        return serve_file_from_directory(
             UPLOAD_FOLDER,
             attachment.stored_filename,
-            mimetype='application/pdf'
+            mimetype='application/pdf',
+            download_name=attachment.original_filename
         )
 
-        # 设置内容处置为inline以在浏览器中预览
-        from urllib.parse import quote
-        response.headers['Content-Disposition'] = f'inline; filename="{quote(attachment.original_filename)}"'
-        return response
-
+    except FileNotFoundError:
+        return jsonify({'error': '附件文件不存在'}), 404
     except Exception as e:
         import traceback
         print(traceback.format_exc())
@@ -298,34 +290,21 @@ def download_attachment(announcement_id, attachment_id):
             announcement_id=announcement_id
         ).first_or_404()
 
-        # 将公告标记为已读（如果尚未）
-        read_status = AnnouncementReadStatus.query.filter_by(
-            announcement_id=announcement_id,
-            user_id=current_user.id
-        ).first()
-
-        if read_status and not read_status.is_read:
-            read_status.is_read = True
-            read_status.read_at = datetime.now()
-            db.session.commit()
-
-        # 从urllib.parse导入quote函数用于URL编码文件名
-        from urllib.parse import quote
-        encoded_filename = quote(attachment.original_filename)
+        # 将公告标记为已读
+        set_read_state(current_user.id, announcement_id)
+        db.session.commit()
+        invalidate_unread_counts(current_user.id)
 
-        # 发送文件
-        response = send_from_directory(
+        # 发送文件（Content-Disposition 中的中文文件名由 serve_file 按 RFC 5987 编码）
+        return serve_file_from_directory(
             UPLOAD_FOLDER,
             attachment.stored_filename,
             as_attachment=True,
             download_name=attachment.original_filename
         )
 
-        # 设置Content-Disposition标头
-        response.headers['Content-Disposition'] = f"attachment; filename={encoded_filename}"
-
-        return response
-
+    except FileNotFoundError:
+        return jsonify({'error': '附件文件不存在'}), 404
     except Exception as e:
         import traceback
         print(traceback.format_exc())
@@ -353,11 +332,8 @@ def get_announcements(current_user):
             Announcement.created_at.desc()
         ).paginate(page=page, per_page=per_page)
 
-        # 获取当前用户的阅读状态
-        read_status = {
-            status.announcement_id: status.is_read
-            for status in AnnouncementReadStatus.query.filter_by(user_id=current_user.id).all()
-        }
+        # 当前页公告的阅读状态（一条查询）
+        read_status = read_states(current_user.id, [ann.id for ann in announcements.items])
 
         result = []
         for ann in announcements.items:
@@ -407,10 +383,7 @@ def get_announcement(current_user, announcement_id):
             return jsonify({'error': '公告不存在或已下线'}), 404
 
         # 获取当前用户的读取状态
-        read_status = AnnouncementReadStatus.query.filter_by(
-            announcement_id=announcement_id,
-            user_id=current_user.id
-        ).first()
+        is_read = read_states(current_user.id, [announcement_id]).get(announcement_id, False)
 
         # 获取附件
         attachments = [{
@@ -429,7 +402,7 @@ def get_announcement(current_user, announcement_id):
                 'created_at': announcement.created_at.isoformat(),
                 'updated_at': announcement.updated_at.isoformat() if announcement.updated_at else None,
                 'priority': announcement.priority,
-                'is_read': read_status.is_read if read_status else False,
+                'is_read': is_read,
                 'is_active': announcement.is_active,
                 'attachments': attachments
             }
@@ -448,23 +421,11 @@ def update_read_status(current_user, announcement_id):
         data = request.get_json()
         is_read = data.get('is_read', True)
 
-        read_status = AnnouncementReadStatus.query.filter_by(
-            announcement_id=announcement_id,
-            user_id=current_user.id
-        ).first()
-
-        if not read_status:
-            read_status = AnnouncementReadStatus(
-                announcement_id=announcement_id,
-                user_id=current_user.id
-            )
-            db.session.add(read_status)
-
-        read_status.is_read = is_read
-        if is_read:
-            read_status.read_at = datetime.now()
-
+        if not Announcement.query.get(announcement_id):
+            return jsonify({'error': '公告不存在'}), 404
+        set_read_state(current_user.id, announcement_id, bool(is_read))
         db.session.commit()
+        invalidate_unread_counts(current_user.id)
 
         return jsonify({
             'message': '阅读状态更新成功',
@@ -487,26 +448,9 @@ def get_read_statistics(current_user, announcement_id):
     try:
         announcement = Announcement.query.get_or_404(announcement_id)
 
-        # 获取所有非管理员用户的阅读状态，排除role为0的用户
-        read_status = (AnnouncementReadStatus.query
-                       .join(User)
-                       .filter(AnnouncementReadStatus.announcement_id == announcement_id,
-                               User.role != 0)  # 排除role为0的用户
-                       .all())
-
-        # 统计非管理员用户的数量和已读数量
-        user_status = [{
-            'user_id': status.user_id,
-            'username': status.user.username,
-            'is_read': status.is_read,
-            'read_at': status.read_at.isoformat() if status.read_at else None,
-            'role': status.user.role  # 添加用户角色信息
-        } for status in read_status]
-
-        # 计算总数（所有用户，包括管理员）
-        total_users = len(read_status)
-        # 计算已读数（所有用户，包括管理员）
-        read_users = sum(1 for status in read_status if status.is_read)
+        # 非管理员用户（排除role为0的用户）的阅读状态：计数为一条 COUNT 查询，明细为一条关联查询
+        with_users = request.args.get('with_users', 'true').lower() != 'false'
+        total_users, read_users, user_status = read_statistics(announcement, with_users=with_users)
 
         return jsonify({
             'announcement_id': announcement_id,
@@ -559,7 +503,7 @@ def update_announcement(current_user, announcement_id):
 
             # 处理文件上传
             files = request.files.getlist('attachments')
-            attachments = []
+            attachment_rows = []
 
             for file in files:
                 if file and file.filename and allowed_file(file.filename):
@@ -575,20 +519,17 @@ def update_announcement(current_user, announcement_id):
                     # 保存文件
                     file.save(file_path)
 
-                    # 创建附件记录
-                    attachment = AnnouncementAttachment(
-                        announcement_id=announcement.id,
-                        original_filename=original_filename,  # 安全处理后的原始文件名
-                        stored_filename=stored_filename,
-                        file_size=os.path.getsize(file_path),
-                        file_type=file.content_type if hasattr(file, 'content_type') else None
-                    )
-                    db.session.add(attachment)
-                    attachments.append({
-                        'filename': original_filename,  # 使用安全处理后的原始文件名
-                        'size': attachment.file_size
+                    # 附件记录，循环结束后批量写入
+                    attachment_rows.append({
+                        'announcement_id': announcement.id,
+                        'original_filename': original_filename,  # 安全处理后的原始文件名
+                        'stored_filename': stored_filename,
+                        'file_size': os.path.getsize(file_path),
+                        'file_type': file.content_type if hasattr(file, 'content_type') else None
                     })
                     content_changed = True
+
+            bulk_insert(AnnouncementAttachment, attachment_rows)
         else:
             # 处理 JSON 数据
             data = request.get_json()
@@ -611,15 +552,13 @@ def update_announcement(current_user, announcement_id):
             if 'is_active' in data:
                 announcement.is_active = bool(data['is_active'])
 
-        # 如果内容已更改，则重置所有用户的读取状态
+        # 如果内容已更改，则所有用户的阅读状态重置为未读（早于 revised_at 的已读记录不再有效）
         if content_changed:
-            read_statuses = AnnouncementReadStatus.query.filter_by(announcement_id=announcement_id).all()
-            for status in read_statuses:
-                status.is_read = False
-                status.read_at = None
+            announcement.revised_at = datetime.now()
 
         # 提交更改
         db.session.commit()
+        invalidate_unread_counts()
         db.session.refresh(announcement)
 
         # 获取当前附件以进行响应
@@ -685,11 +624,7 @@ def delete_attachment(current_user, announcement_id, attachment_id):
 @token_required
 def get_unread_count(current_user):
     try:
-        unread_count = AnnouncementReadStatus.query.join(Announcement).filter(
-            AnnouncementReadStatus.user_id == current_user.id,
-            AnnouncementReadStatus.is_read == False,
-            Announcement.is_active == True
-        ).count()
+        unread_count = cached_unread_count(current_user.id)
 
         return jsonify({
             'unread_count': unread_count
@@ -699,26 +634,56 @@ def get_unread_count(current_user):
         return jsonify({'error': str(e)}), 500
 
 
+# 未读公告数推送（SSE）：数值变化时推送 unread-count 事件，客户端无需轮询
+# EventSource 不能设置请求头，令牌也可通过 ?token= 传入（get_user_from_query_token）
+@announcement_bp.route('/announcements/unread-count/stream', methods=['GET'])
+def stream_unread_count():
+    user, error_response = get_user_from_query_token()
+    if error_response:
+        return error_response
+    user_id = user.id
+    db.session.remove()
+
+    return Response(stream_with_context(unread_count_events(user_id)), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # 反向代理（nginx）不缓冲事件流
+    })
+
+
 # 重置公告阅读状态
 @announcement_bp.route('/announcements/<int:announcement_id>/reset-read-status', methods=['PUT'])
 @track_activity
 @token_required
 def reset_read_status(current_user, announcement_id):
     try:
-        # 检索特定公告和用户的读取状态
-        read_status = AnnouncementReadStatus.query.filter_by(
-            user_id=current_user.id,
-            announcement_id=announcement_id
-        ).first()
+        if not Announcement.query.get(announcement_id):
+            return jsonify({'error': '公告不存在'}), 404
+        set_read_state(current_user.id, announcement_id, False)
+        db.session.commit()
+        invalidate_unread_counts(current_user.id)
+
+        return jsonify({'message': '公告阅读状态重置为未读成功'})
+
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
 
-        if read_status:
-            read_status.is_read = False
-            read_status.read_at = None
-            db.session.commit()
 
-            return jsonify({'message': '公告阅读状态重置为未读成功'})
+# 全部标为已读
+@announcement_bp.route('/announcements/mark-all-read', methods=['PUT'])
+@track_activity
+@token_required
+def mark_all_announcements_read(current_user):
+    try:
+        seen_until = mark_all_read(current_user.id)
+        db.session.commit()
+        invalidate_unread_counts(current_user.id)
 
-        return jsonify({'error': '未找到阅读状态'}), 404
+        return jsonify({
+            'message': '已将全部公告标为已读',
+            'seen_until': seen_until.isoformat(),
+            'unread_count': 0
+        })
 
     except Exception as e:
         db.session.rollback()
@@ -14,6 +14,10 @@ from models import db, Project, Subproject, ProjectFile, ProjectUpdate, ProjectS
 from auth import get_employee_id
 from routes.filemanagement import allowed_file, MAX_FILE_SIZE, generate_unique_filename, create_upload_path
 from utils.activity_tracking import track_activity, log_user_activity
+from utils.session_store import has_active_session
+from utils.search_cache import search_result_cache, normalize_query
+from utils.entity_search import search_entities, ENTITY_TYPES
+from utils.bulk_write import bulk_insert
 
 employee_bp = Blueprint('employee', __name__)
 CORS(employee_bp)  # 为此蓝图启用 CORS
@@ -519,6 +523,8 @@ def token_required(f):
 
             if not current_user:
                 return jsonify({'message': '用户不存在'}), 401
+            if current_user.is_disabled:
+                return jsonify({'message': '用户已停用'}), 401
 
             # 检查函数参数中是否已经有 current_user
             if 'current_user' in kwargs:
@@ -535,6 +541,37 @@ def token_required(f):
     return decorated
 
 
+def get_user_from_query_token():
+    """
+    从请求头 Authorization 或 URL 参数 token 验证用户
+    （用于 <img>、<iframe>、EventSource 等无法携带请求头的访问），并检查用户未停用、会话未超时；
+    只检查会话，不刷新活动时间
+    返回：(用户, None) 或 (None, 错误响应)
+    """
+    auth_header = request.headers.get('Authorization', '')
+    token = auth_header.split(" ")[1] if auth_header.startswith('Bearer ') else request.args.get('token')
+    if not token:
+        return None, (jsonify({'code': 401, 'message': '未授权访问'}), 401)
+
+    try:
+        data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
+        current_user = User.query.filter_by(id=data['user_id']).first()
+    except jwt.ExpiredSignatureError:
+        return None, (jsonify({'code': 401, 'message': 'token已过期'}), 401)
+    except jwt.InvalidTokenError:
+        return None, (jsonify({'code': 401, 'message': '无效的token'}), 401)
+    except Exception as e:
+        return None, (jsonify({'code': 401, 'message': f'token验证失败: {str(e)}'}), 401)
+
+    if not current_user:
+        return None, (jsonify({'code': 401, 'message': '用户不存在'}), 401)
+    if current_user.is_disabled:
+        return None, (jsonify({'code': 401, 'message': '用户已停用'}), 401)
+    if not has_active_session(current_user.id):
+        return None, (jsonify({'code': 'SESSION_EXPIRED', 'message': '会话已过期，请重新登录'}), 401)
+    return current_user, None
+
+
 # 获取用户个人信息接口 - 保持不变
 @employee_bp.route('/profile', methods=['GET'])
 @track_activity
@@ -586,8 +623,9 @@ def report_clock_in(current_user):
         db.session.add(report)
         db.session.flush()
 
-        # 添加补卡明细
+        # 添加补卡明细（校验完所有日期后批量写入）
         reported_dates = []
+        detail_rows = []
         for date_item in dates_data:
             try:
                 date_str = date_item['date']
@@ -595,13 +633,12 @@ def report_clock_in(current_user):
                 date_obj = datetime.strptime(date_str, '%Y-%m-%d')
                 weekday = date_obj.strftime('%A')
 
-                detail = ReportClockinDetail(
-                    report_id=report.id,
-                    clockin_date=date_obj.date(),
-                    weekday=weekday,
-                    remarks=remarks
-                )
-                db.session.add(detail)
+                detail_rows.append({
+                    'report_id': report.id,
+                    'clockin_date': date_obj.date(),
+                    'weekday': weekday,
+                    'remarks': remarks
+                })
 
                 reported_dates.append({
                     'date': date_str,
@@ -612,6 +649,7 @@ def report_clock_in(current_user):
                 db.session.rollback()
                 return jsonify({'error': f'无效的日期格式: {date_str}'}), 400
 
+        bulk_insert(ReportClockinDetail, detail_rows)
         db.session.commit()
         return jsonify({
             'message': '补卡提交成功',
@@ -961,10 +999,126 @@ def calculate_edit_stats(records):
 @track_activity
 @token_required
 def search_resources(current_user):
-    query = request.args.get('q', '')
+    query = ' '.join(request.args.get('q', '').split())
     resource_type = request.args.get('type', 'all')
     status = request.args.get('status', '')
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 500)  # 每种类型最多返回的条数
+
+    # 结果只与检索条件和当前员工有关，在相关数据变化前直接复用
+    cache_key = ('employee', normalize_query(query), resource_type, status, limit, current_user.id)
+    results = search_result_cache.get_or_compute(
+        cache_key, lambda: search_indexed_resources(current_user, query, resource_type, status, limit))
+    return jsonify(results)
 
+
+# 结果分组名 -> 索引中的实体类型
+SEARCH_RESULT_GROUPS = {
+    'projects': 'project',
+    'subprojects': 'subproject',
+    'stages': 'stage',
+    'tasks': 'task',
+    'files': 'file',
+}
+
+
+def search_indexed_resources(current_user, query, resource_type, status, limit=100):
+    """
+    通过统一检索索引一次查询所有类型（见 utils/entity_search.py），再按类型各用一条 IN 查询取出详情
+    索引不可用时退回到逐表查询
+    """
+    groups = [group for group in SEARCH_RESULT_GROUPS if resource_type in ('all', group)]
+    # 与原有行为一致：阶段、任务和文件只在有检索词时搜索
+    if not query:
+        groups = [group for group in groups if group in ('projects', 'subprojects')]
+    results = {group: [] for group in SEARCH_RESULT_GROUPS}
+    results['facets'] = {group: 0 for group in SEARCH_RESULT_GROUPS}
+    if not groups:
+        return results
+
+    try:
+        hits, facets = search_entities(current_user.id, query, [SEARCH_RESULT_GROUPS[group] for group in groups],
+                                       status=status, per_type_limit=limit)
+    except Exception as e:
+        db.session.rollback()
+        print(f"统一检索索引查询失败，改用逐表查询: {str(e)}")
+        results = collect_search_results(current_user, query, resource_type, status)
+        results['facets'] = {group: len(items) for group, items in results.items()}
+        return results
+
+    ids_by_type = {}
+    for entity_type, entity_id in hits:
+        ids_by_type.setdefault(entity_type, []).append(entity_id)
+    objects = {}
+    for entity_type, ids in ids_by_type.items():
+        model = ENTITY_TYPES[entity_type][1]
+        objects.update(((entity_type, item.id), item) for item in model.query.filter(model.id.in_(ids)).all())
+
+    for group, entity_type in SEARCH_RESULT_GROUPS.items():
+        results['facets'][group] = facets.get(entity_type, 0)
+    for entity_type, entity_id in hits:
+        item = objects.get((entity_type, entity_id))
+        if item is not None:
+            group = next(group for group, value in SEARCH_RESULT_GROUPS.items() if value == entity_type)
+            results[group].append(SEARCH_RESULT_SERIALIZERS[entity_type](item))
+    return results
+
+
+SEARCH_RESULT_SERIALIZERS = {
+    'project': lambda p: {
+        'id': p.id,
+        'name': p.name,
+        'description': p.description,
+        'status': p.status,
+        'progress': p.progress,
+        'deadline': p.deadline.strftime('%Y-%m-%d'),
+        'type': 'project'
+    },
+    'subproject': lambda sp: {
+        'id': sp.id,
+        'name': sp.name,
+        'description': sp.description,
+        'status': sp.status,
+        'progress': sp.progress,
+        'deadline': sp.deadline.strftime('%Y-%m-%d'),
+        'project_id': sp.project_id,
+        'type': 'subproject'
+    },
+    'stage': lambda s: {
+        'id': s.id,
+        'name': s.name,
+        'description': s.description,
+        'status': s.status,
+        'progress': s.progress,
+        'subproject_id': s.subproject_id,
+        'project_id': s.project_id,
+        'type': 'stage'
+    },
+    'task': lambda t: {
+        'id': t.id,
+        'name': t.name,
+        'description': t.description,
+        'status': t.status,
+        'progress': t.progress,
+        'due_date': t.due_date.strftime('%Y-%m-%d'),
+        'stage_id': t.stage_id,
+        'type': 'task'
+    },
+    'file': lambda f: {
+        'id': f.id,
+        'name': f.original_name,
+        'file_type': f.file_type,
+        'upload_date': f.upload_date.strftime('%Y-%m-%d'),
+        'project_id': f.project_id,
+        'subproject_id': f.subproject_id,
+        'stage_id': f.stage_id,
+        'task_id': f.task_id,
+        'type': 'file'
+    },
+}
+
+
+def collect_search_results(current_user, query, resource_type, status):
+    """按类型逐表搜索当前员工负责的项目、子项目、阶段、任务和文件（统一检索索引不可用时使用）"""
     results = {
         'projects': [],
         'subprojects': [],
@@ -1108,7 +1262,7 @@ def search_resources(current_user):
             'type': 'file'
         } for f in files]
 
-    return jsonify(results)
+    return results
 
 
 # 修改密码 - 保持不变
@@ -44,7 +44,7 @@ if False:
 
 
 
-from models import db, ProjectFile, FileContent
+from models import db, ProjectFile, FileContent, KnowledgeBaseFileContent
 
 def detect_file_encoding(file_path):
     """检测文件编码"""
@@ -180,6 +180,33 @@ def update_file_index(project_file_id, file_path, file_type):
         return False
 
 
+def update_kb_file_index(kb_file, file_path, file_type):
+    """
+    提取知识库文件的文本并写入 kb_file_contents（全文索引由触发器同步）
+    无法提取文本的文件也会写入一条只有文件名的记录，以便按文件名检索
+    :param kb_file: KnowledgeBaseFile 记录
+    :return: 是否提取到了文本
+    """
+    try:
+        extracted_text = create_file_index(file_path, file_type)
+
+        file_content = db.session.get(KnowledgeBaseFileContent, kb_file.id)
+        if not file_content:
+            file_content = KnowledgeBaseFileContent(file_id=kb_file.id)
+
+        file_content.title = kb_file.original_name
+        file_content.content = extracted_text
+
+        db.session.add(file_content)
+        db.session.commit()
+
+        return bool(extracted_text)
+    except Exception as e:
+        print(f"知识库索引更新错误： {str(e)}")
+        db.session.rollback()
+        return False
+
+
 # 文件类型映射
 MIME_TYPE_MAPPING = {
     'doc': 'application/msword',
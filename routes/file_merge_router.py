@@ -1,18 +1,17 @@
 # file_merge_router.py
+import json
 import os
+import threading
 import time
-import shutil
-import tempfile
-import uuid
-from urllib.parse import quote
 from flask import (
-    Blueprint, jsonify, send_file, Response,
-    stream_with_context, current_app, request,
-    send_from_directory  # 添加了用于在需要时提供静态文件的功能
+    Blueprint, jsonify, Response,
+    stream_with_context, current_app, request
 )
 from flask_cors import CORS
 
-from models import User, Project, ProjectFile  # type: ignore
+from models import db, User, Project, ProjectFile  # type: ignore
+from utils.file_serving import serve_file, serve_file_from_directory, is_offloaded
+from utils.merge_session_store import get_merge_session_store, remove_session_temp_dirs, session_events
 
 from .file_merger import (
     generate_paged_preview_data,
@@ -22,8 +21,10 @@ from .file_merger import (
 
 merge_bp = Blueprint('file_merge_refactored', __name__, url_prefix='/api/filles')
 CORS(merge_bp)
-# 合并会话的内存存储（考虑将 Redis/DB 用于生产）
-merge_sessions = {}
+
+# 当前进程中打开的进度 SSE 连接数（上限见 MERGE_SSE_MAX_STREAMS）
+_active_sse_streams = 0
+_sse_streams_lock = threading.Lock()
 
 
 # --- Helper 函数在应用程序上下文中调用函数 ---
@@ -37,40 +38,20 @@ def call_with_app_context(app, func, *args, **kwargs):
 
 
 # --- 会话管理助手 ---
+# 会话状态保存在共享存储中（见 utils/merge_session_store.py），
+# 预览、合并与进度请求落在不同 worker 上时也能看到同一个会话。
 def get_session_progress(session_id):
-    return merge_sessions.get(session_id, {}).get('progress', 0)
+    session_data = get_merge_session_store().get(session_id)
+    return session_data.get('progress', 0) if session_data else 0
 
 
 def update_session_progress(session_id, progress, status_message=None, completed=False, error=None):
-    if session_id in merge_sessions:
-        merge_sessions[session_id]['progress'] = progress
-        if status_message: merge_sessions[session_id]['status_message'] = status_message
-        merge_sessions[session_id]['completed'] = completed
-        if error: merge_sessions[session_id]['error'] = error
-        if completed or error:
-            merge_sessions[session_id]['status'] = 'error' if error else 'completed'
-    else:
-        # 如果 current_app 可能不可用，请使用直接 Logger（尽管此函数通常在上下文中调用）
-        app = current_app._get_current_object() if current_app else None
-        if app:
-            app.logger.warning(f"尝试更新不存在的会话 ID 的进度 {session_id}.")
-        else:
-            print(f"警告：尝试更新不存在的会话 ID 的进度{session_id} (无应用程序上下文).")
+    if not get_merge_session_store().update_progress(session_id, progress, status_message, completed, error):
+        current_app.logger.warning(f"尝试更新不存在的会话 ID 的进度 {session_id}.")
 
 
-def create_merge_session(custom_session_id=None):
-    session_id = custom_session_id if custom_session_id else str(uuid.uuid4())
-    merge_sessions[session_id] = {
-        'progress': 0,
-        'status_message': 'Initializing...',
-        'status': 'running',  # '正在运行'， '已完成'， '错误'
-        'completed': False,
-        'error': None,
-        'start_time': time.time(),
-        'pdf_temp_dir': None,  # 对于 PDF 生成临时文件
-        'image_temp_dir': None  # 用于预览图像临时文件
-    }
-    return session_id
+def create_merge_session(custom_session_id=None, **fields):
+    return get_merge_session_store().create(custom_session_id, **fields)
 
 
 def cleanup_session(session_id):
@@ -82,27 +63,9 @@ def cleanup_session(session_id):
     # current_app应该在这里可用，因为call_with_app_context建立了它。
     app_logger = current_app.logger
 
-    if session_id in merge_sessions:
-        session_data = merge_sessions.pop(session_id)  # 删除和获取数据
-
-        pdf_temp_dir_to_clean = session_data.get('pdf_temp_dir')
-        if pdf_temp_dir_to_clean and os.path.exists(pdf_temp_dir_to_clean):
-            try:
-                shutil.rmtree(pdf_temp_dir_to_clean)
-                app_logger.info(
-                    f"临时 PDF 目录 {pdf_temp_dir_to_clean} 已清理会话{session_id}.")
-            except Exception as e:
-                app_logger.error(f"无法清理临时 PDF 目录 {pdf_temp_dir_to_clean}: {e}")
-
-        image_temp_dir_to_clean = session_data.get('image_temp_dir')
-        if image_temp_dir_to_clean and os.path.exists(image_temp_dir_to_clean):
-            try:
-                shutil.rmtree(image_temp_dir_to_clean)  # 这是特定于会话的 image 文件夹
-                app_logger.info(
-                    f"临时镜像目录 {image_temp_dir_to_clean} 已清理会话{session_id}.")
-            except Exception as e:
-                app_logger.error(f"清理临时镜像目录失败 {image_temp_dir_to_clean}: {e}")
-
+    session_data = get_merge_session_store().pop(session_id)  # 删除和获取数据
+    if session_data is not None:
+        remove_session_temp_dirs(session_id, session_data, app_logger)
         app_logger.info(f"Session {session_id} data cleaned up.")
     else:
         app_logger.warning(f"尝试清理不存在的会话 ID {session_id}.")
@@ -157,12 +120,13 @@ def generate_paged_preview_route():
         if not preview_session_id or pages_image_info is None:
             return jsonify({'error': '生成分页预览时发生未知错误 (Unknown error during paged preview generation)'}), 500
 
-        create_merge_session(custom_session_id=preview_session_id)
-        if preview_session_id in merge_sessions:
-            merge_sessions[preview_session_id]['image_temp_dir'] = image_temp_dir
-            merge_sessions[preview_session_id]['status_message'] = '分页预览已生成 (Paged preview generated)'
-            merge_sessions[preview_session_id]['progress'] = 100
-            merge_sessions[preview_session_id]['completed'] = True
+        create_merge_session(
+            custom_session_id=preview_session_id,
+            image_temp_dir=image_temp_dir,
+            status_message='分页预览已生成 (Paged preview generated)',
+            progress=100,
+            completed=True
+        )
 
         return jsonify({
             'preview_session_id': preview_session_id,
@@ -184,7 +148,7 @@ def serve_temp_preview_image(session_id, image_filename):
         return jsonify({'error': '无效的文件名 (Invalid filename)'}), 400
 
     try:
-        return send_from_directory(session_image_dir_abs, image_filename)
+        return serve_file_from_directory(session_image_dir_abs, image_filename)
     except FileNotFoundError:
         return jsonify({'error': '图片未找到 (Image not found)'}), 404
     except Exception as e:
@@ -220,7 +184,7 @@ def finalize_merge_route():
     if not isinstance(pages_to_delete_indices, list):
         return jsonify({'error': 'pages_to_delete_indices 参数格式错误 （pages_to_delete_indices格式无效）'}), 400
 
-    if preview_session_id not in merge_sessions:
+    if get_merge_session_store().get(preview_session_id) is None:
         current_app.logger.warning(
             f"Finalize merge called with unknown preview_session_id: {preview_session_id}. Creating a new session entry.")
         create_merge_session(custom_session_id=preview_session_id)
@@ -253,32 +217,26 @@ def finalize_merge_route():
 
         update_session_progress(session_id_for_finalize, 90, "准备发送最终文件 (Preparing to send final file)...")
 
-        if session_id_for_finalize in merge_sessions:
-            merge_sessions[session_id_for_finalize]['pdf_temp_dir'] = pdf_temp_dir
-        else:
+        if not get_merge_session_store().update(session_id_for_finalize, pdf_temp_dir=pdf_temp_dir):
             current_app.logger.error(f"Session {session_id_for_finalize} vanished before storing pdf_temp_dir.")
 
-        def generate_file_stream_final():
-            try:
-                with open(final_pdf_path, "rb") as f:
-                    yield from f
-            finally:
-                pass  # 清理由 response.call_on_close 处理
-
-        base_filename_final = f"{project.name}_final_merged.pdf"
-        encoded_filename_final = quote(base_filename_final)
-
-        response = Response(stream_with_context(generate_file_stream_final()), mimetype='application/pdf')
-        response.headers["Content-Disposition"] = (
-            f"attachment; filename=\"{base_filename_final.encode('latin-1', 'replace').decode('latin-1')}\"; "
-            f"filename*=UTF-8''{encoded_filename_final}"
+        # 设置正确的 Content-Length，支持 Range/条件请求，并在服务器支持时使用 sendfile
+        response = serve_file(
+            final_pdf_path,
+            mimetype='application/pdf',
+            as_attachment=True,
+            download_name=f"{project.name}_final_merged.pdf"
         )
 
         update_session_progress(session_id_for_finalize, 100, "最终合并成功 (Final merge successful)", completed=True)
 
-        response.call_on_close(
-            lambda: call_with_app_context(actual_app, cleanup_session, session_id_for_finalize)
-        )
+        if is_offloaded(response):
+            # 文件由反向代理在响应返回后读取，不能立即删除；会话过期后由定时清理任务回收
+            current_app.logger.info(f"会话 {session_id_for_finalize} 的最终文件交由反向代理发送，延迟清理。")
+        else:
+            response.call_on_close(
+                lambda: call_with_app_context(actual_app, cleanup_session, session_id_for_finalize)
+            )
 
         return response
 
@@ -292,96 +250,134 @@ def finalize_merge_route():
             {'error': f"最终合并PDF时发生未预期的错误 (Unexpected error during final PDF merge): {str(e)}"}), 500
 
 
+def _sse_event(payload, event_id=None):
+    """构造一条 SSE 消息"""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"data: {json.dumps(payload, ensure_ascii=False)}")
+    return "\n".join(lines) + "\n\n"
+
+
+def _try_acquire_sse_slot(limit):
+    global _active_sse_streams
+    with _sse_streams_lock:
+        if _active_sse_streams >= limit:
+            return False
+        _active_sse_streams += 1
+        return True
+
+
+def _release_sse_slot():
+    global _active_sse_streams
+    with _sse_streams_lock:
+        _active_sse_streams -= 1
+
+
 @merge_bp.route('/progress/<session_id>')
 def merge_progress_sse(session_id):
-    if session_id not in merge_sessions:
-        def empty_stream():
-            yield f"data: {{ \"progress\": 100, \"status_message\": \"会话未找到或已过期 (Session not found or expired).\", \"completed\": true, \"error\": \"会话无效 (Invalid session)\" }}\n\n"
+    """
+    合并进度的 SSE 流。
+    处理线程阻塞在会话的事件通道上，由合并任务更新进度时唤醒，不再轮询；
+    空闲时定期发送心跳注释，事件 ID 为会话的 version，客户端重连时通过
+    Last-Event-ID 跳过已收到的状态。
+    """
+    store = get_merge_session_store()
+    if store.get(session_id) is None:
+        db.session.close()
+        return Response(_sse_event({
+            "progress": 100, "status_message": "会话未找到或已过期 (Session not found or expired).",
+            "completed": True, "error": "会话无效 (Invalid session)"
+        }), mimetype='text/event-stream')
+
+    config = current_app.config
+    if not _try_acquire_sse_slot(config.get('MERGE_SSE_MAX_STREAMS', 50)):
+        response = jsonify({'error': '进度连接数已达上限，请稍后重试 (Too many progress streams)'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '5'
+        return response
+
+    heartbeat_interval = config.get('MERGE_SSE_HEARTBEAT_INTERVAL', 15)
+    # 其他 worker 上的更新不会唤醒本进程的通道，共享存储时需定期重新读取
+    if config.get('MERGE_SESSION_BACKEND', 'sqlite') == 'memory':
+        wait_timeout = heartbeat_interval
+    else:
+        wait_timeout = min(heartbeat_interval, config.get('MERGE_SSE_RECHECK_INTERVAL', 2))
+    idle_timeout = config.get('MERGE_SSE_IDLE_TIMEOUT', 300)  # 如果没有进度变化，则 SSE 流超时 5 分钟
 
-        return Response(stream_with_context(empty_stream()), mimetype='text/event-stream')
+    try:
+        last_event_id = int(request.headers.get('Last-Event-ID', 0))
+    except ValueError:
+        last_event_id = 0
 
-    # 如果需要，获取用于在 SSE 流中进行日志记录的实际应用实例，
-    # 但如果流的生存期很长，则此处的直接日志记录也可能会遇到上下文问题。
-    # 对于 SSE，如果主应用程序将更新推送到 SSE 从中读取的队列，通常会更好。
-    # 或 SSE 本身会定期检查由主应用程序更新的状态。
-    # 但是，对于这种特定结构，我们假设 current_app 在直播开始时可用。
-    # actual_app_for_sse = current_app._get_current_object（） # 如果从这里记录，则可以使用
+    app_for_sse_logging = current_app._get_current_object()
 
     def generate_progress_stream():
-        last_progress = -1
-        last_status_message = ""
-        last_error = None
-        start_time = time.time()
-        timeout_seconds = 300  # 如果没有活动，则 SSE 流超时 5 分钟
-
-        # 如果可能，最好获取一次 app 对象，或者处理它的缺失。
-        app_for_sse_logging = current_app._get_current_object() if current_app else None
-
-        while True:
-            session_data = merge_sessions.get(session_id)
-            if not session_data:
-                yield f"data: {{ \"progress\": 100, \"status_message\": \"会话已结束或未找到 (Session ended or not found).\", \"completed\": true, \"error\": \"会话已结束 (Session ended)\" }}\n\n"
-                break
-
-            if time.time() - start_time > timeout_seconds and session_data.get(
-                    'status') == 'running' and session_data.get('progress', 0) < 100:
-                if app_for_sse_logging:
+        last_version = last_event_id
+        last_change = last_heartbeat = time.time()
+        sent_any = False
+
+        with session_events.subscribe(session_id) as subscription:
+            while True:
+                session_data = store.get(session_id)
+                # 等待期间不占用数据库连接
+                db.session.close()
+                now = time.time()
+
+                if not session_data:
+                    yield _sse_event({
+                        "progress": 100, "status_message": "会话已结束或未找到 (Session ended or not found).",
+                        "completed": True, "error": "会话已结束 (Session ended)"
+                    })
+                    break
+
+                version = session_data.get('version', 0)
+                progress = session_data.get('progress', 0)
+                status_message = session_data.get('status_message') or ''
+                current_error = session_data.get('error')
+                completed = session_data.get('completed', False)
+
+                if version > last_version:
+                    event_data = {"progress": progress, "status_message": status_message, "completed": completed}
+                    if current_error:
+                        event_data["error"] = current_error
+                    yield _sse_event(event_data, version)
+                    sent_any = True
+                    last_version = version
+                    last_change = last_heartbeat = now
+                elif now - last_change > idle_timeout and session_data.get('status') == 'running' \
+                        and progress < 100:
                     app_for_sse_logging.logger.warning(f"SSE stream for session {session_id} timed out.")
-                else:
-                    print(f"警告：会话的 SSE 流 {session_id} 超时（无 Logger 的应用程序上下文）.")
-
-                yield f"data: {{ \"progress\": {session_data.get('progress', 0)}, \"status_message\": \"操作超时 (Operation timed out).\", \"completed\": true, \"error\": \"超时 (Timeout)\" }}\n\n"
-                # 如果 SSE 超时，它也应该触发该会话的清理。
-                if app_for_sse_logging:
+                    yield _sse_event({
+                        "progress": progress, "status_message": "操作超时 (Operation timed out).",
+                        "completed": True, "error": "超时 (Timeout)"
+                    })
+                    # 如果 SSE 超时，它也应该触发该会话的清理。
                     call_with_app_context(app_for_sse_logging, cleanup_session, session_id)
-                else:  # 如果 app_for_sse_logging 为 None，则回退（理想情况下不应在请求中发生）
-                    print(f"错误：无法清理会话 {session_id}由于缺少应用程序上下文而导致 SSE 超时.")
-                break
-
-            progress = session_data.get('progress', 0)
-            status_message = session_data.get('status_message', '')
-            current_error = session_data.get('error')
-            completed = session_data.get('completed', False)
-
-            if progress != last_progress or status_message != last_status_message or (
-                    current_error and current_error != last_error):
-                event_data = {
-                    "progress": progress, "status_message": status_message, "completed": completed
-                }
-                if current_error: event_data["error"] = current_error
-
-                # jsonify 需要一个 app context。如果此流运行时间较长，则上下文可能是一个问题。
-                # 更安全的方法是手动构造 JSON 字符串或确保上下文。
-                try:
-                    json_data_string = jsonify(event_data).get_data(as_text=True)
-                    yield f"data: {json_data_string}\n\n"
-                except RuntimeError:  # 可能断章取义
-                    if app_for_sse_logging:
-                        app_for_sse_logging.logger.error(
-                            "由于缺少应用程序上下文，jsonify 在 SSE 流中失败。可能需要手动构建 JSON.")
-                    else:
-                        print("错误：由于缺少应用程序上下文，SSE 流中的 jsonify 失败。")
-                    # 回退到手动 JSON 构造或发送更简单的错误消息
-                    yield f"data: {{ \"progress\": {progress}, \"status_message\": \"Error fetching details.\", \"completed\": {str(completed).lower()} }}\n\n"
-
-                last_progress = progress
-                last_status_message = status_message
-                if current_error: last_error = current_error
-
-            if completed:
-                if not current_error and progress < 100:
-                    final_event_data = {"progress": 100,
-                                        "status_message": status_message or "处理完成 (Processing complete)",
-                                        "completed": True}
-                    try:
-                        yield f"data: {jsonify(final_event_data).get_data(as_text=True)}\n\n"
-                    except RuntimeError:
-                        yield f"data: {{ \"progress\": 100, \"status_message\": \"Processing complete (error formatting details).\", \"completed\": true }}\n\n"
-                break
-
-            if current_error:
-                break
-
-            time.sleep(0.5)
-
-    return Response(stream_with_context(generate_progress_stream()), mimetype='text/event-stream')
+                    break
+                elif now - last_heartbeat >= heartbeat_interval:
+                    yield ": keep-alive\n\n"
+                    last_heartbeat = now
+
+                if completed or current_error:
+                    if not current_error and progress < 100:
+                        yield _sse_event({"progress": 100,
+                                          "status_message": status_message or "处理完成 (Processing complete)",
+                                          "completed": True}, version)
+                    elif not sent_any:
+                        # 重连时最终状态已被客户端收到过，仍需再发一次以便客户端关闭连接
+                        final_event_data = {"progress": progress, "status_message": status_message,
+                                            "completed": True}
+                        if current_error:
+                            final_event_data["error"] = current_error
+                        yield _sse_event(final_event_data, version)
+                    break
+
+                subscription.wait(wait_timeout)
+
+    response = Response(stream_with_context(generate_progress_stream()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # 禁止反向代理缓冲事件流
+    # 即使客户端在流开始前断开，call_on_close 也会执行，保证连接计数被释放
+    response.call_on_close(_release_sse_slot)
+    return response
@@ -1,8 +1,11 @@
 # file_merger.py
+import hashlib
+import json
 import os
 import re
 import shutil
 import tempfile
+import threading
 import io
 import uuid
 
@@ -25,7 +28,10 @@ from pdf2image.exceptions import (
     PDFSyntaxError
 )
 
-from models import Project, ProjectFile, ProjectStage, StageTask, Subproject
+from sqlalchemy import and_
+
+from models import db, Project, ProjectFile, ProjectStage, StageTask, Subproject
+from utils.merge_session_store import get_merge_scratch_dir
 
 # --- Font Setup ---
 FONT_NAME = 'SimSun'
@@ -33,8 +39,23 @@ FONT_NAME = 'SimSun'
 TEMP_PREVIEW_IMAGE_SUBDIR = 'temp_preview_images'
 
 
+# 字体注册结果按进程缓存：探测字体路径和解析 simsun.ttf 只在首次调用时执行
+_font_setup_result = None
+_font_setup_lock = threading.Lock()
+
+
 def setup_fonts():
-    """设置 ReportLab 的 SimSun 字体."""
+    """设置 ReportLab 的 SimSun 字体（每个进程只执行一次）."""
+    global _font_setup_result
+    if _font_setup_result is not None:
+        return _font_setup_result
+    with _font_setup_lock:
+        if _font_setup_result is None:
+            _font_setup_result = _register_fonts()
+    return _font_setup_result
+
+
+def _register_fonts():
     try:
         # 尝试查找相对于应用程序根目录的字体
         font_path_app_root = os.path.join(current_app.root_path, 'fonts', 'simsun.ttf')
@@ -69,8 +90,94 @@ def setup_fonts():
 
 # ---PDF 生成实用程序 ---
 
+# --- 封面/目录页缓存 ---
+# 渲染结果以内容哈希为键保存在缓存目录中，结构未变化的重复合并直接复用，跳过 reportlab 渲染。
+# 修改封面或目录的绘制方式时需要递增版本号，使旧缓存失效。
+PAGE_CACHE_VERSION = 1
+_page_cache_lock = threading.Lock()
+
+
+def _get_page_cache_dir():
+    cache_dir = current_app.config.get('MERGE_PAGE_CACHE_DIR') or os.path.join(tempfile.gettempdir(),
+                                                                               'merge_page_cache')
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def _page_cache_key(kind, **key_data):
+    setup_fonts()
+    payload = {
+        'kind': kind,
+        'version': PAGE_CACHE_VERSION,
+        'font': FONT_NAME if FONT_NAME in pdfmetrics.getRegisteredFontNames() else 'Helvetica',
+        'data': key_data
+    }
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True, default=str)
+    return f"{kind}_{hashlib.sha256(raw.encode('utf-8')).hexdigest()}"
+
+
+def _evict_page_cache(cache_dir, max_entries):
+    """按最近使用时间（mtime）淘汰超出上限的缓存页"""
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.pdf') and entry.is_file():
+            try:
+                entries.append((entry.stat().st_mtime, entry.path))
+            except OSError:
+                pass
+    if len(entries) <= max_entries:
+        return
+    entries.sort()
+    for _, path in entries[:len(entries) - max_entries]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _render_cached_page(cache_key, output_path, render):
+    """
+    从缓存复制页面到 output_path；未命中时调用 render(output_path) 渲染并写入缓存。
+    缓存写入先写临时文件再 os.replace，并发合并不会读到半个文件。
+    """
+    try:
+        cache_dir = _get_page_cache_dir()
+        cached_path = os.path.join(cache_dir, f"{cache_key}.pdf")
+        if os.path.isfile(cached_path):
+            shutil.copyfile(cached_path, output_path)
+            os.utime(cached_path)  # 更新最近使用时间
+            current_app.logger.debug(f"页面缓存命中: {cache_key}")
+            return output_path
+    except OSError as e:
+        current_app.logger.warning(f"读取页面缓存失败，将重新渲染: {e}")
+        return render(output_path)
+
+    rendered_path = render(output_path)
+    if not rendered_path or not os.path.exists(rendered_path):
+        return rendered_path
+
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        os.close(fd)
+        shutil.copyfile(rendered_path, tmp_path)
+        os.replace(tmp_path, cached_path)
+        with _page_cache_lock:
+            _evict_page_cache(cache_dir, current_app.config.get('MERGE_PAGE_CACHE_MAX_ENTRIES', 256))
+    except OSError as e:
+        current_app.logger.warning(f"写入页面缓存失败: {e}")
+    return rendered_path
+
+
 def create_dynamic_title_page(title_text, output_path, subtitle_text=None, font_size=24):
-    """创建具有动态主标题和可选副标题的标题页。"""
+    """创建具有动态主标题和可选副标题的标题页（按内容缓存）。"""
+    cache_key = _page_cache_key('cover', title=title_text, subtitle=subtitle_text, font_size=font_size)
+    return _render_cached_page(
+        cache_key, output_path,
+        lambda path: _render_title_page(title_text, path, subtitle_text=subtitle_text, font_size=font_size))
+
+
+def _render_title_page(title_text, output_path, subtitle_text=None, font_size=24):
+    """使用 reportlab 渲染标题页。"""
     if not setup_fonts():
         current_app.logger.warning("创建标题页期间字体设置失败。可能会使用默认字体.")
 
@@ -123,7 +230,15 @@ def create_dynamic_title_page(title_text, output_path, subtitle_text=None, font_
 
 
 def create_toc_pdf_page(toc_items, output_path, max_level=4):
-    """创建目录 PDF 页面。"""
+    """创建目录 PDF 页面（按目录内容缓存）。"""
+    cache_key = _page_cache_key('toc', toc_items=toc_items, max_level=max_level)
+    return _render_cached_page(
+        cache_key, output_path,
+        lambda path: _render_toc_pdf_page(toc_items, path, max_level=max_level))
+
+
+def _render_toc_pdf_page(toc_items, output_path, max_level=4):
+    """使用 reportlab 渲染目录 PDF 页面。"""
     if not setup_fonts():
         current_app.logger.warning("创建 TOC 页面期间字体设置失败。可能会使用默认字体.")
 
@@ -182,33 +297,40 @@ def create_toc_pdf_page(toc_items, output_path, max_level=4):
     return output_path
 
 
-def add_page_numbers_to_pdf(input_pdf_path, output_pdf_path):
-    """将页码（第 X 页，共第 Y 页）添加到 PDF 的每一页。"""
+def add_page_numbers_to_pdf(input_pdf_path, output_pdf_path, pages_to_delete_indices=None):
+    """
+    将页码（第 X 页，共第 Y 页）添加到 PDF 的每一页，同时跳过 pages_to_delete_indices 中的页面。
+    删除页面和添加页码在一次读写中完成；所有页码绘制在同一个多页 canvas 上，只解析一次。
+    """
     if not setup_fonts():
         current_app.logger.warning("页码的字体设置失败。可能会使用默认字体.")
 
     reader = PdfReader(input_pdf_path)
     writer = PdfWriter()
-    num_pages = len(reader.pages)
+    pages_to_delete = set(pages_to_delete_indices or [])
+    kept_pages = [page for i, page in enumerate(reader.pages) if i not in pages_to_delete]
+    num_pages = len(kept_pages)
+    current_app.logger.info(
+        f"Original pages: {len(reader.pages)}, Pages deleted: {len(reader.pages) - num_pages}, Pages remaining: {num_pages}")
 
     default_font_name = "Helvetica" if FONT_NAME not in pdfmetrics.getRegisteredFontNames() else FONT_NAME
     current_app.logger.info(f"对页码使用字体'{default_font_name}' ")
 
-    for i, page in enumerate(reader.pages):
-        packet = io.BytesIO()
+    packet = io.BytesIO()
+    can = reportlab_canvas.Canvas(packet)
+    font_size = 9
+    y_pos = 1 * cm  # 位置从下开始
+    for i, page in enumerate(kept_pages):
         # 使用 Reader 中的页面尺寸
         page_width = float(page.mediabox.width)
         page_height = float(page.mediabox.height)
-        can = reportlab_canvas.Canvas(packet, pagesize=(page_width, page_height))
+        can.setPageSize((page_width, page_height))
 
+        page_number_text = f"第 {i + 1} 页 / 共 {num_pages} 页"
         try:
-            page_number_text = f"第 {i + 1} 页 / 共 {num_pages} 页"
-            font_size = 9
             can.setFont(default_font_name, font_size)  # 使用确定的字体
             text_width = can.stringWidth(page_number_text, default_font_name, font_size)
-            x_pos = (page_width - text_width) / 2
-            y_pos = 1 * cm  # 位置从下开始
-            can.drawString(x_pos, y_pos, page_number_text)
+            can.drawString((page_width - text_width) / 2, y_pos, page_number_text)
         except Exception as e:
             current_app.logger.error(f"在页面上绘制页码时出错 {i + 1}: {e}", exc_info=True)
             # 如果主数据库失败（例如字体问题），则尝试回退
@@ -216,19 +338,20 @@ def add_page_numbers_to_pdf(input_pdf_path, output_pdf_path):
                 try:
                     can.setFont("Helvetica", font_size)
                     text_width = can.stringWidth(page_number_text, "Helvetica", font_size)
-                    x_pos = (page_width - text_width) / 2
-                    can.drawString(x_pos, y_pos, page_number_text)
+                    can.drawString((page_width - text_width) / 2, y_pos, page_number_text)
                     current_app.logger.warning(f"回退到 Helvetica 获取 pag 上的页码e {i + 1}.")
                 except Exception as fallback_e:
                     current_app.logger.error(f"页面的回退页码绘制失败 {i + 1}: {fallback_e}",
                                              exc_info=True)
-
-        can.save()
-        packet.seek(0)
-        watermark_pdf = PdfReader(packet)
-        # 合并前确保水印页面存在
-        if watermark_pdf.pages:
-            page.merge_page(watermark_pdf.pages[0])
+        can.showPage()
+    can.save()
+
+    packet.seek(0)
+    number_pages = PdfReader(packet).pages if num_pages else []
+    for i, page in enumerate(kept_pages):
+        # 合并前确保页码页面存在
+        if i < len(number_pages):
+            page.merge_page(number_pages[i])
         else:
             current_app.logger.warning(f"页面水印 PDF {i + 1} 为空.")
         writer.add_page(page)
@@ -254,141 +377,168 @@ def sort_files_by_prefix(files):
     return sorted(files, key=lambda x: extract_prefix_number(x.original_name))
 
 
-def generate_toc_items_structure(project_id, selected_file_ids=None, max_level=4):
+def collect_merge_structure(project_id, selected_file_ids=None):
+    """
+    用一条查询取出项目的 子项目 -> 阶段 -> 任务 -> PDF 文件 层级，按名称排序。
+    目录和待合并文件列表都从这个结构派生，避免逐层逐任务查询。
+    selected_file_ids 为 None 时包含全部 PDF；为列表时只包含列表中的文件（空列表即不包含任何文件）。
+    返回：[{'id', 'name', 'stages': [{'id', 'name', 'tasks': [{'id', 'name', 'files': [...]}]}]}]
+    """
+    file_join = and_(ProjectFile.task_id == StageTask.id, ProjectFile.file_name.ilike('%.pdf'))
+    if selected_file_ids is not None:
+        file_join = and_(file_join, ProjectFile.id.in_(selected_file_ids))
+
+    rows = (db.session.query(
+                Subproject.id.label('subproject_id'), Subproject.name.label('subproject_name'),
+                ProjectStage.id.label('stage_id'), ProjectStage.name.label('stage_name'),
+                StageTask.id.label('task_id'), StageTask.name.label('task_name'),
+                ProjectFile.id.label('file_id'), ProjectFile.original_name, ProjectFile.file_path)
+            .select_from(Subproject)
+            .outerjoin(ProjectStage, ProjectStage.subproject_id == Subproject.id)
+            .outerjoin(StageTask, StageTask.stage_id == ProjectStage.id)
+            .outerjoin(ProjectFile, file_join)
+            .filter(Subproject.project_id == project_id)
+            .order_by(Subproject.name, Subproject.id, ProjectStage.name, ProjectStage.id,
+                      StageTask.name, StageTask.id, ProjectFile.id)
+            .all())
+
+    subprojects = []
+    subproject = stage = task = None
+    for row in rows:
+        if subproject is None or subproject['id'] != row.subproject_id:
+            subproject = {'id': row.subproject_id, 'name': row.subproject_name, 'stages': []}
+            subprojects.append(subproject)
+            stage = task = None
+        if row.stage_id is None:
+            continue
+        if stage is None or stage['id'] != row.stage_id:
+            stage = {'id': row.stage_id, 'name': row.stage_name, 'tasks': []}
+            subproject['stages'].append(stage)
+            task = None
+        if row.task_id is None:
+            continue
+        if task is None or task['id'] != row.task_id:
+            task = {'id': row.task_id, 'name': row.task_name, 'files': []}
+            stage['tasks'].append(task)
+        if row.file_id is not None:
+            task['files'].append({'id': row.file_id, 'original_name': row.original_name,
+                                  'file_path': row.file_path})
+
+    for subproject in subprojects:
+        for stage in subproject['stages']:
+            for task in stage['tasks']:
+                task['files'].sort(key=lambda f: extract_prefix_number(f['original_name']))
+
+    current_app.logger.debug(f"项目 {project_id} 的合并结构：{len(rows)} 行，{len(subprojects)} 个子项目")
+    return subprojects
+
+
+def generate_toc_items_structure(project_id, selected_file_ids=None, max_level=4, structure=None):
     """为目录生成结构化的项目列表."""
     project = Project.query.get(project_id)
     if not project:
         current_app.logger.warning(f"generate_toc_items_structure：ID 为 的项目 {project_id} 未找到.")
         return []
 
+    if structure is None:
+        structure = collect_merge_structure(project.id, selected_file_ids)
+
     toc_items = []
     current_app.logger.debug(
         f"为项目生成 TOC 结构: {project.name} (ID: {project.id}), 最高层级：{max_level}")
 
     if max_level >= 1:
         toc_items.append({'level': 1, 'text': project.name, 'id': f"project_{project.id}"})
-        current_app.logger.debug(f"  Added Level 1: {project.name}")
-
-    # 确保排序一致
-    subprojects = Subproject.query.filter_by(project_id=project.id).order_by(Subproject.name).all()
-    current_app.logger.debug(f"  Found {len(subprojects)} subprojects.")
 
-    for subproject in subprojects:
-        subproject_text = f"{project.name} - {subproject.name}"  # 示例格式
+    for subproject in structure:
         if max_level >= 2:
-            toc_items.append({'level': 2, 'text': subproject_text, 'id': f"subproject_{subproject.id}"})
-            current_app.logger.debug(f"    Added Level 2: {subproject_text}")
-
-        stages = ProjectStage.query.filter_by(subproject_id=subproject.id).order_by(ProjectStage.name).all()
-        current_app.logger.debug(f"    Subproject '{subproject.name}' has {len(stages)} stages.")
+            subproject_text = f"{project.name} - {subproject['name']}"  # 示例格式
+            toc_items.append({'level': 2, 'text': subproject_text, 'id': f"subproject_{subproject['id']}"})
 
-        for stage in stages:
-            stage_text = f"{subproject.name} - {stage.name}"  # 示例格式
+        for stage in subproject['stages']:
             if max_level >= 3:
-                toc_items.append({'level': 3, 'text': stage_text, 'id': f"stage_{stage.id}"})
-                current_app.logger.debug(f"      Added Level 3: {stage_text}")
-
-            tasks = StageTask.query.filter_by(stage_id=stage.id).order_by(StageTask.name).all()
-            current_app.logger.debug(f"      Stage '{stage.name}' has {len(tasks)} tasks.")
-
-            for task in tasks:
-                task_text = f"{stage.name} - {task.name}"  # 示例格式
-                # 查询与此任务关联的文件
-                query = ProjectFile.query.filter_by(task_id=task.id,
-                                                    project_id=project.id)  # 如果文件可以直接属于项目project_id请确保存在过滤器
-
-                # 按所选文件 ID 过滤（如果提供）
-                if selected_file_ids:
-                    current_app.logger.debug(
-                        f"        Filtering task '{task.name}' files by selected IDs: {selected_file_ids}")
-                    query = query.filter(ProjectFile.id.in_(selected_file_ids))
-
-                # 筛选专门用于 TOC 文件列表的 PDF 文件
-                task_files_query = query.filter(ProjectFile.file_name.ilike('%.pdf'))
-                task_files = sort_files_by_prefix(task_files_query.all())  # Execute query
-
-                current_app.logger.debug(
-                    f"       任务 '{task.name}' has {len(task_files)}过滤后的相关 PDF 文件.")
-
-                if task_files and max_level >= 4:
-                    file_names_for_toc = [f.original_name for f in task_files]
-                    toc_items.append(
-                        {'level': 4, 'text': task_text, 'id': f"task_{task.id}", 'files': file_names_for_toc})
-                    current_app.logger.debug(f"        Added Level 4: {task_text} with files: {file_names_for_toc}")
-                elif not task_files and max_level >= 4:
-                    current_app.logger.debug(
-                        f"        Task '{task.name}'没有 PDF 文件与级别 4 TOC 条目的条件匹配。")
+                stage_text = f"{subproject['name']} - {stage['name']}"  # 示例格式
+                toc_items.append({'level': 3, 'text': stage_text, 'id': f"stage_{stage['id']}"})
+
+            if max_level < 4:
+                continue
+            for task in stage['tasks']:
+                # 只有包含（已选中的）PDF 文件的任务才出现在第 4 级
+                if task['files']:
+                    task_text = f"{stage['name']} - {task['name']}"  # 示例格式
+                    toc_items.append({'level': 4, 'text': task_text, 'id': f"task_{task['id']}",
+                                      'files': [f['original_name'] for f in task['files']]})
 
     current_app.logger.debug(f"完成生成 TOC 结构。总项目： {len(toc_items)}")
     return toc_items
 
 
-def get_pdf_file_paths_for_merging(project_id, selected_file_ids=None):
+def _scan_directories(paths):
+    """
+    对路径所在的每个目录只执行一次 os.scandir，代替逐个文件的 exists/isfile 检查。
+    返回：{目录: (所有条目名集合, 普通文件名集合)}
+    """
+    listings = {}
+    for directory in {os.path.dirname(path) for path in paths}:
+        names, files = set(), set()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    names.add(entry.name)
+                    try:
+                        if entry.is_file():
+                            files.add(entry.name)
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+        listings[directory] = (names, files)
+    return listings
+
+
+def get_pdf_file_paths_for_merging(project_id, selected_file_ids=None, structure=None):
     """
     收集要合并的 PDF 文件的路径，同时考虑选择和顺序。
     优化了路径解析逻辑，以处理绝对路径和相对路径。
     """
     current_app.logger.info(f"开始为项目 {project_id} 获取 PDF 文件路径。选择的 ID: {selected_file_ids}")
-    files_to_merge_info = []
-    project = Project.query.get(project_id)
-    if not project:
-        current_app.logger.error(f"在 get_pdf_file_paths_for_merging 中未找到项目 {project_id}。")
-        return []
+    if structure is None:
+        if not Project.query.get(project_id):
+            current_app.logger.error(f"在 get_pdf_file_paths_for_merging 中未找到项目 {project_id}。")
+            return []
+        structure = collect_merge_structure(project_id, selected_file_ids)
 
     # 定义上传文件的基础目录 (根据你的实际配置修改)
     upload_base_directory = os.path.join(current_app.root_path, 'uploads')  # 存储在 应用根目录/uploads/ 下
-    current_app.logger.debug(f"使用的上传基础目录: {upload_base_directory}")
 
     # 保持结构顺序: Subproject -> Stage -> Task -> Files (已排序)
-    subprojects = Subproject.query.filter_by(project_id=project.id).order_by(Subproject.name).all()
-    current_app.logger.debug(f"  正在遍历 {len(subprojects)} 个子项目...")
-
-    for subproject in subprojects:
-        current_app.logger.debug(f"    处理子项目: {subproject.name}")
-        stages = ProjectStage.query.filter_by(subproject_id=subproject.id).order_by(ProjectStage.name).all()
-        for stage in stages:
-            current_app.logger.debug(f"      处理阶段: {stage.name}")
-            tasks = StageTask.query.filter_by(stage_id=stage.id).order_by(StageTask.name).all()
-            for task in tasks:
-                current_app.logger.debug(f"        处理任务: {task.name}")
-                query = ProjectFile.query.filter_by(task_id=task.id)
-
-                if selected_file_ids is not None:
-                    query = query.filter(ProjectFile.id.in_(selected_file_ids))
-                    current_app.logger.debug(f"          应用 selected_file_ids 过滤器: {selected_file_ids}")
-
-                query = query.filter(ProjectFile.file_name.ilike('%.pdf'))
-                pdf_files_for_task = sort_files_by_prefix(query.all())
-                current_app.logger.debug(f"          过滤和排序后，找到 {len(pdf_files_for_task)} 个此任务的 PDF 文件。")
-
-                for pf_obj in pdf_files_for_task:
-                    stored_path = pf_obj.file_path
-
+    candidates = []
+    for subproject in structure:
+        for stage in subproject['stages']:
+            for task in stage['tasks']:
+                for pf in task['files']:
+                    stored_path = pf['file_path']
                     if not stored_path:
-                        current_app.logger.warning(f"文件 ID={pf_obj.id} 的 stored_path 为空, 跳过。")
+                        current_app.logger.warning(f"文件 ID={pf['id']} 的 stored_path 为空, 跳过。")
                         continue
-
                     if os.path.isabs(stored_path):
                         full_path = stored_path
-                        current_app.logger.debug(f"将存储的路径视为绝对路径: '{full_path}'")
                     else:
                         full_path = os.path.join(upload_base_directory, stored_path)
-                        current_app.logger.debug(
-                            f"            将相对路径与上传基础目录 '{upload_base_directory}' 拼接: '{full_path}'")
-
-                    current_app.logger.debug(
-                        f"检查文件: ID={pf_obj.id}, Name='{pf_obj.original_name}', Stored Path='{stored_path}', Resolved Path='{full_path}'")
-
-                    if os.path.exists(full_path):
-                        if os.path.isfile(full_path):
-                            files_to_merge_info.append(
-                                {'id': pf_obj.id, 'path': full_path, 'original_name': pf_obj.original_name}
-                            )
-                            current_app.logger.debug(f"已添加文件到合并列表: {full_path}")
-                        else:
-                            current_app.logger.warning(f"路径存在但不是文件, 跳过: {full_path}")
-                    else:
-                        current_app.logger.warning(f"在解析的路径未找到文件, 跳过: {full_path}")
+                    candidates.append((pf, os.path.normpath(full_path)))
+
+    listings = _scan_directories(path for _, path in candidates)
+
+    files_to_merge_info = []
+    for pf, full_path in candidates:
+        names, files = listings[os.path.dirname(full_path)]
+        base_name = os.path.basename(full_path)
+        if base_name in files:
+            files_to_merge_info.append({'id': pf['id'], 'path': full_path, 'original_name': pf['original_name']})
+        elif base_name in names:
+            current_app.logger.warning(f"路径存在但不是文件, 跳过: {full_path}")
+        else:
+            current_app.logger.warning(f"在解析的路径未找到文件, 跳过: {full_path}")
 
     current_app.logger.info(f"总共找到 {len(files_to_merge_info)} 个要合并的 PDF 文件。")
     return files_to_merge_info
@@ -407,12 +557,15 @@ def _generate_base_merged_pdf(project_id, merge_config, selected_file_ids=None):
         current_app.logger.error(f"Project {project_id} 在 _generate_base_merged_pdf 中未找到.")
         return None, "项目不存在 (Project does not exist)", None
 
-    pdf_temp_dir = tempfile.mkdtemp(prefix=f"merge_pdf_{project.id}_")
+    pdf_temp_dir = tempfile.mkdtemp(prefix=f"merge_pdf_{project.id}_", dir=get_merge_scratch_dir())
     current_app.logger.info(f"Created temporary PDF directory: {pdf_temp_dir}")
 
     try:
         merger = PdfMerger()
 
+        # 目录和内容文件共用同一次查询的结果
+        merge_structure = collect_merge_structure(project.id, selected_file_ids)
+
         # 1. 准备封面
         cover_options = merge_config.get('coverPage', {})
         cover_title = cover_options.get('name', project.name)
@@ -431,7 +584,8 @@ def _generate_base_merged_pdf(project_id, merge_config, selected_file_ids=None):
         if toc_options.get('include', True):
             max_toc_level = toc_options.get('maxLevel', 3)
             current_app.logger.info(f"生成 TOC 项结构 (最高级别: {max_toc_level})...")
-            toc_items_data = generate_toc_items_structure(project_id, selected_file_ids, max_toc_level)
+            toc_items_data = generate_toc_items_structure(project_id, selected_file_ids, max_toc_level,
+                                                         structure=merge_structure)
 
             if toc_items_data:
                 toc_pdf_path = os.path.join(pdf_temp_dir, "01_toc_page.pdf")
@@ -449,7 +603,8 @@ def _generate_base_merged_pdf(project_id, merge_config, selected_file_ids=None):
 
         # 3. Get Content Files
         current_app.logger.info("正在获取用于合并的内容文件路径...")
-        content_file_infos = get_pdf_file_paths_for_merging(project_id, selected_file_ids)
+        content_file_infos = get_pdf_file_paths_for_merging(project_id, selected_file_ids,
+                                                            structure=merge_structure)
         if not content_file_infos:
             current_app.logger.warning(f"未找到或未为项目选择内容 PDF 文件 {project_id}.")
         else:
@@ -614,44 +769,27 @@ def build_final_pdf(project_id, merge_config, selected_file_ids=None, pages_to_d
         if base_pdf_temp_dir and os.path.exists(base_pdf_temp_dir): shutil.rmtree(base_pdf_temp_dir)
         return None, "Failed to create the base PDF file for finalization.", None
 
-    final_pdf_processing_temp_dir = tempfile.mkdtemp(prefix=f"final_pdf_{project.id}_")
+    final_pdf_processing_temp_dir = tempfile.mkdtemp(prefix=f"final_pdf_{project.id}_",
+                                                     dir=get_merge_scratch_dir())
     current_app.logger.info(f"已创建最终处理临时目录： {final_pdf_processing_temp_dir}")
 
     try:
-        pdf_path_before_numbering = os.path.join(final_pdf_processing_temp_dir, f"{project.name}_deleted_pages.pdf")
-
-        if pages_to_delete_indices is not None and pages_to_delete_indices:
+        final_output_filename = f"{project.name}_final_merged.pdf"
+        final_output_path_with_pagenumbers = os.path.join(final_pdf_processing_temp_dir, final_output_filename)
+        if pages_to_delete_indices:
             current_app.logger.info(f"删除带有索引的页面： {pages_to_delete_indices}")
-            reader = PdfReader(base_merged_pdf_path)
-            writer = PdfWriter()
-            original_page_count = len(reader.pages)
-            deleted_count = 0
-            for i, page in enumerate(reader.pages):
-                if i not in pages_to_delete_indices:
-                    writer.add_page(page)
-                else:
-                    deleted_count += 1
-            current_app.logger.info(
-                f"Original pages: {original_page_count}, Pages deleted: {deleted_count}, Pages remaining: {len(writer.pages)}")
-            with open(pdf_path_before_numbering, "wb") as f_out:
-                writer.write(f_out)
-            current_app.logger.info(f"已删除页面的 PDF 存储到：{pdf_path_before_numbering}")
-        else:
-            current_app.logger.info("没有要删除的页面。复制基础合并的 PDF.")
-            shutil.copy(base_merged_pdf_path, pdf_path_before_numbering)
+        current_app.logger.info(
+            f"添加页码 '{base_merged_pdf_path}' -> '{final_output_path_with_pagenumbers}'")
+
+        # 删除页面与添加页码一次完成，直接从基础合并 PDF 写出最终文件，不再生成中间副本
+        numbered_pdf_path = add_page_numbers_to_pdf(base_merged_pdf_path, final_output_path_with_pagenumbers,
+                                                    pages_to_delete_indices)
 
         if base_pdf_temp_dir and os.path.exists(base_pdf_temp_dir):
             shutil.rmtree(base_pdf_temp_dir)
             current_app.logger.info(f"清理了基本 PDF 临时目录： {base_pdf_temp_dir}")
             base_pdf_temp_dir = None
 
-        final_output_filename = f"{project.name}_final_merged.pdf"
-        final_output_path_with_pagenumbers = os.path.join(final_pdf_processing_temp_dir, final_output_filename)
-        current_app.logger.info(
-            f"添加页码 '{pdf_path_before_numbering}' -> '{final_output_path_with_pagenumbers}'")
-
-        numbered_pdf_path = add_page_numbers_to_pdf(pdf_path_before_numbering, final_output_path_with_pagenumbers)
-
         if not numbered_pdf_path or not os.path.exists(numbered_pdf_path):
             current_app.logger.error("添加页码失败或缺少最终编号的 PDF。")
             raise RuntimeError("页码排序失败。")
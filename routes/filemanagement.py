@@ -25,6 +25,9 @@ import os
 from models import db, Project, ProjectFile, ProjectStage, User, StageTask, FileContent, UserActivityLog, Subproject
 from auth import get_employee_id
 from utils.activity_tracking import track_activity
+from utils.file_serving import serve_file
+from utils.search_snippets import highlight_text, build_content_previews
+from utils.search_cache import search_result_cache, name_index, normalize_query
 from docx import Document
 
 from reportlab.lib.pagesizes import A4, landscape
@@ -431,6 +434,108 @@ def upload_task_file(project_id, subproject_id, stage_id, task_id):
     return jsonify({'message': '文件上传成功', 'file_id': project_file.id})
 
 
+def run_file_search(current_user, employee_id, search_query, visibility, subproject_id):
+    """执行文件搜索，返回响应数据（results/total）"""
+    base_query = ProjectFile.query.options(
+        joinedload(ProjectFile.project),
+        joinedload(ProjectFile.subproject),
+        joinedload(ProjectFile.stage),
+        joinedload(ProjectFile.task),
+        joinedload(ProjectFile.upload_user)
+    )
+
+    # 子项目筛选器
+    if subproject_id:
+        base_query = base_query.filter(ProjectFile.subproject_id == subproject_id)
+
+    if current_user.role not in [0, 1]:  # 非管理员
+        if visibility == 'public':
+            base_query = base_query.filter(ProjectFile.is_public == True)
+        elif visibility == 'private':
+            base_query = base_query.filter(
+                ProjectFile.upload_user_id == employee_id
+            )
+        else:
+            base_query = base_query.filter(
+                or_(
+                    ProjectFile.upload_user_id == employee_id,
+                    ProjectFile.is_public == True
+                )
+            )
+    else:  # 管理员可以查看所有文件，但仍可应用可见性筛选器
+        if visibility == 'public':
+            base_query = base_query.filter(ProjectFile.is_public == True)
+        elif visibility == 'private':
+            base_query = base_query.filter(ProjectFile.is_public == False)
+
+    # 将子项目添加到搜索条件
+    search_conditions = [
+        ProjectFile.original_name.ilike(f'%{search_query}%'),
+        ProjectFile.file_name.ilike(f'%{search_query}%'),
+        ProjectFile.file_type.ilike(f'%{search_query}%'),
+        ProjectFile.file_path.ilike(f'%{search_query}%'),
+        Project.name.ilike(f'%{search_query}%'),
+        Subproject.name.ilike(f'%{search_query}%'),
+        ProjectStage.name.ilike(f'%{search_query}%'),
+        StageTask.name.ilike(f'%{search_query}%'),
+        User.username.ilike(f'%{search_query}%'),
+        FileContent.content.ilike(f'%{search_query}%')
+    ]
+
+    # 将可选关系的 inner joins 更改为 outer joins
+    search_results = base_query \
+        .outerjoin(Project) \
+        .outerjoin(Subproject) \
+        .outerjoin(ProjectStage) \
+        .outerjoin(StageTask) \
+        .join(User, ProjectFile.upload_user_id == User.id) \
+        .outerjoin(FileContent) \
+        .filter(or_(*search_conditions)) \
+        .all()
+
+    # 一次批量生成所有命中文件的内容片段（不读取全文）
+    previews = build_content_previews([file.id for file in search_results], search_query, context_length=150)
+
+    results = []
+    for file in search_results:
+        try:
+            file_path = os.path.join(current_app.root_path, file.file_path)
+            file_size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+
+            result = {
+                'id': file.id,
+                'fileName': file.file_name,
+                'originalName': highlight_text(file.original_name, search_query),
+                'fileType': file.file_type,
+                'fileSize': file_size,
+                'uploadTime': file.upload_date.isoformat(),
+                'uploader': highlight_text(file.upload_user.username, search_query),
+                'projectName': highlight_text(file.project.name if file.project else None, search_query),
+                'subprojectName': highlight_text(file.subproject.name if file.subproject else None, search_query),
+                'stageName': highlight_text(file.stage.name if file.stage else None, search_query),
+                'taskName': highlight_text(file.task.name if file.task else None, search_query),
+                'is_public': file.is_public
+            }
+
+            # 添加内容预览
+            if file.id in previews:
+                fragments = previews[file.id]
+                result['contentPreview'] = ' '.join(fragments) if fragments else "无匹配内容"
+                result['contentFragments'] = fragments
+            else:
+                result['contentPreview'] = "未提取内容"
+
+            results.append(result)
+        except Exception as e:
+            print(f"处理文件 {file.id} 时出错: {str(e)}")
+            continue
+
+    return {
+        'results': results,
+        'total': len(results)
+    }
+
+
 # 搜索功能，加权限展示，加公开属性
 # 2025年3月31日11:32:32
 @files_bp.route('/search', methods=['GET'])
@@ -443,194 +548,46 @@ def search_files():
         if not current_user:
             return jsonify({'error': '未找到用户'}), 404
 
-        search_query = request.args.get('query', '').strip()
+        search_query = ' '.join(request.args.get('query', '').split())
         visibility = request.args.get('visibility', '')
         subproject_id = request.args.get('subproject_id', type=int)
 
         if not search_query:
             return jsonify({'error': '搜索条件必填'}), 400
 
-        base_query = ProjectFile.query.options(
-            joinedload(ProjectFile.project),
-            joinedload(ProjectFile.subproject),
-            joinedload(ProjectFile.stage),
-            joinedload(ProjectFile.task),
-            joinedload(ProjectFile.upload_user),
-            joinedload(ProjectFile.content)
+        # 相同检索词、过滤条件和可见范围的结果在数据变化前直接复用
+        scope = 'all' if current_user.role in [0, 1] else employee_id
+        cache_key = ('files', normalize_query(search_query), visibility, subproject_id, scope)
+        payload = search_result_cache.get_or_compute(
+            cache_key,
+            lambda: run_file_search(current_user, employee_id, search_query, visibility, subproject_id)
         )
-
-        # 子项目筛选器
-        if subproject_id:
-            base_query = base_query.filter(ProjectFile.subproject_id == subproject_id)
-
-        if current_user.role not in [0, 1]:  # 非管理员
-            if visibility == 'public':
-                base_query = base_query.filter(ProjectFile.is_public == True)
-            elif visibility == 'private':
-                base_query = base_query.filter(
-                    ProjectFile.upload_user_id == employee_id
-                )
-            else:
-                base_query = base_query.filter(
-                    or_(
-                        ProjectFile.upload_user_id == employee_id,
-                        ProjectFile.is_public == True
-                    )
-                )
-        else:  # 管理员可以查看所有文件，但仍可应用可见性筛选器
-            if visibility == 'public':
-                base_query = base_query.filter(ProjectFile.is_public == True)
-            elif visibility == 'private':
-                base_query = base_query.filter(ProjectFile.is_public == False)
-
-        # 将子项目添加到搜索条件
-        search_conditions = [
-            ProjectFile.original_name.ilike(f'%{search_query}%'),
-            ProjectFile.file_name.ilike(f'%{search_query}%'),
-            ProjectFile.file_type.ilike(f'%{search_query}%'),
-            ProjectFile.file_path.ilike(f'%{search_query}%'),
-            Project.name.ilike(f'%{search_query}%'),
-            Subproject.name.ilike(f'%{search_query}%'),
-            ProjectStage.name.ilike(f'%{search_query}%'),
-            StageTask.name.ilike(f'%{search_query}%'),
-            User.username.ilike(f'%{search_query}%'),
-            FileContent.content.ilike(f'%{search_query}%')
-        ]
-
-        # 将可选关系的 inner joins 更改为 outer joins
-        search_results = base_query \
-            .outerjoin(Project) \
-            .outerjoin(Subproject) \
-            .outerjoin(ProjectStage) \
-            .outerjoin(StageTask) \
-            .join(User, ProjectFile.upload_user_id == User.id) \
-            .outerjoin(FileContent) \
-            .filter(or_(*search_conditions)) \
-            .all()
-
-        results = []
-        for file in search_results:
-            try:
-                file_path = os.path.join(current_app.root_path, file.file_path)
-                file_size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
-
-                result = {
-                    'id': file.id,
-                    'fileName': file.file_name,
-                    'originalName': highlight_text(file.original_name, search_query),
-                    'fileType': file.file_type,
-                    'fileSize': file_size,
-                    'uploadTime': file.upload_date.isoformat(),
-                    'uploader': highlight_text(file.upload_user.username, search_query),
-                    'projectName': highlight_text(file.project.name if file.project else None, search_query),
-                    'subprojectName': highlight_text(file.subproject.name if file.subproject else None, search_query),
-                    'stageName': highlight_text(file.stage.name if file.stage else None, search_query),
-                    'taskName': highlight_text(file.task.name if file.task else None, search_query),
-                    'is_public': file.is_public
-                }
-
-                # 添加内容预览
-                if file.content:
-                    preview = get_content_preview(
-                        file.content.content,
-                        search_query,
-                        context_length=150
-                    )
-                    result['contentPreview'] = preview if preview else "无匹配内容"
-                else:
-                    result['contentPreview'] = "未提取内容"
-
-                results.append(result)
-            except Exception as e:
-                print(f"处理文件 {file.id} 时出错: {str(e)}")
-                continue
-
-        return jsonify({
-            'results': results,
-            'total': len(results)
-        })
+        return jsonify(payload)
 
     except Exception as e:
         print(f"搜索错误: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 
-# 获取内容预览
-def get_content_preview(content, query, context_length=150):
-    """
-    获取匹配内容的上下文预览，突出显示匹配的文本
-    """
-    if not content or not query:
-        return None
-
+# 搜索框自动补全：按前缀返回项目、子项目、阶段、任务和文件名
+@files_bp.route('/search/suggest', methods=['GET'])
+def search_suggest():
     try:
-        # 转换为小写进行不区分大小写的搜索
-        content_lower = content.lower()
-        query_lower = query.lower()
-
-        # 查找匹配位置
-        index = content_lower.find(query_lower)
-        if index == -1:
-            return None
-
-        # 计算预览窗口的起始和结束位置
-        start = max(0, index - context_length // 2)
-        end = min(len(content), index + len(query) + context_length // 2)
-
-        # 调整起始位置到单词边界（如果可能）
-        while start > 0 and content[start - 1].isalnum():
-            start -= 1
-
-        # 调整结束位置到单词边界（如果可能）
-        while end < len(content) - 1 and content[end].isalnum():
-            end += 1
-
-        # 构建预览文本
-        preview = content[start:end].strip()
-
-        # 添加省略号标记
-        if start > 0:
-            preview = f"...{preview}"
-        if end < len(content):
-            preview = f"{preview}..."
-
-        return preview
-
-    except Exception as e:
-        print(f"生成内容预览时出错: {str(e)}")
-        return None
-
+        employee_id = get_employee_id()
+        current_user = User.query.get(employee_id)
+        if not current_user:
+            return jsonify({'error': '未找到用户'}), 404
 
-def highlight_text(text, query):
-    """
-    在文本中为搜索关键词添加高亮标记
-    使用特殊标记 {{highlight}} 和 {{/highlight}} 包裹匹配文本
-    """
-    if not text or not query:
-        return text
+        prefix = request.args.get('q', '')
+        limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+        kinds = [kind for kind in request.args.get('types', '').split(',') if kind] or None
 
-    try:
-        # 不区分大小写
-        query_lower = query.lower()
-        # 分割文本以保留原始大小写
-        parts = []
-        last_idx = 0
-        text_lower = text.lower()
-
-        while True:
-            idx = text_lower.find(query_lower, last_idx)
-            if idx == -1:
-                parts.append(text[last_idx:])
-                break
-
-            parts.append(text[last_idx:idx])
-            parts.append("{{highlight}}" + text[idx:idx + len(query)] + "{{/highlight}}")
-            last_idx = idx + len(query)
-
-        return "".join(parts)
+        suggestions = name_index.suggest(prefix, user_id=employee_id, is_admin=current_user.role in [0, 1],
+                                         kinds=kinds, limit=limit)
+        return jsonify({'suggestions': suggestions})
     except Exception as e:
-        print(f"高亮处理错误: {str(e)}")
-        return text
+        print(f"自动补全错误: {str(e)}")
+        return jsonify({'error': str(e)}), 500
 
 
 #  文件删除接口
@@ -700,8 +657,10 @@ def download_file(file_id):
         if not os.path.exists(file_path):
             return jsonify({'error': '文件不存在'}), 404
 
-        return send_file(file_path, as_attachment=True, download_name=file.original_name)
+        return serve_file(file_path, as_attachment=True, download_name=file.original_name)
 
+    except FileNotFoundError:
+        return jsonify({'error': '文件不存在'}), 404
     except Exception as e:
         print(f"下载错误：{str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -738,48 +697,6 @@ def get_user_info_from_token():
         return None
 
 
-#  获取带高亮标记的内容预览
-def get_content_preview(content, query, context_length=150):
-    if not content or not query:
-        return None
-
-    try:
-        # 转换为小写进行不区分大小写的搜索
-        content_lower = content.lower()
-        query_lower = query.lower()
-
-        # 查找匹配位置
-        index = content_lower.find(query_lower)
-        if index == -1:
-            return None
-
-        # 计算预览窗口的起始和结束位置
-        start = max(0, index - context_length // 2)
-        end = min(len(content), index + len(query) + context_length // 2)
-
-        # 调整到单词边界
-        while start > 0 and content[start - 1].isalnum():
-            start -= 1
-        while end < len(content) - 1 and content[end].isalnum():
-            end += 1
-
-        # 提取预览文本
-        preview = content[start:end].strip()
-
-        # 添加省略号
-        if start > 0:
-            preview = "..." + preview
-        if end < len(content):
-            preview = preview + "..."
-
-        # 为预览文本添加高亮
-        return highlight_text(preview, query)
-
-    except Exception as e:
-        print(f"生成预览错误: {str(e)}")
-        return None
-
-
 # 导出文件列表
 @files_bp.route('/export', methods=['GET'])
 @track_activity
@@ -1224,6 +1141,3 @@ def should_use_landscape(data, font_name='SimSun', font_size=8):
     # 如果需要的宽度超过竖向A4可用宽度的80%，建议使用横向
     return total_required_width > (A4_PORTRAIT_WIDTH * 0.8)
 
-
-# Flask路由部分保持不变
-merge_progress = {}
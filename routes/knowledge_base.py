@@ -1,14 +1,26 @@
 # routes/knowledge_base.py
 import os
+import tempfile
+import zipfile
 from functools import wraps
-from flask import Blueprint, request, jsonify, current_app, send_from_directory
+from flask import Blueprint, request, jsonify, current_app
 from werkzeug.utils import secure_filename
 from datetime import datetime
 import mimetypes  # 导入 mimetypes
 
 
-from models import db, User, KnowledgeBase, KnowledgeBaseNode, KnowledgeBaseFile
+from models import db, User, KnowledgeBase, KnowledgeBaseNode, KnowledgeBaseFile, KnowledgeBaseFileContent
 from routes.employees import token_required
+from utils.file_serving import serve_file_from_directory
+from utils.kb_search import search_kb_files
+from .file_indexer import update_kb_file_index, get_mime_type
+from utils.kb_tree import (
+    load_tree, load_tree_levels, subtree_etag, assign_node_path, move_subtree, delete_subtree, delete_kb_nodes,
+    insert_nodes_bulk, copy_subtree, update_file_paths, move_node_files
+)
+from utils.kb_bulk import (
+    save_uploads, duplicate_files, extract_texts, read_zip_structure, extract_zip_files, remove_files
+)
 
 kb_bp = Blueprint('knowledge_base', __name__)
 
@@ -51,12 +63,33 @@ def get_current_user_profile(current_user):
 def build_node_tree(kb_id):
     """
     为给定的知识库构建完整的节点树。
+    节点和文件各用一条查询取出后在内存中组装（见 utils/kb_tree.py）。
     """
-    # 查找所有根节点 (没有父节点的节点)
-    root_nodes = KnowledgeBaseNode.query.filter_by(kb_id=kb_id, parent_id=None).all()
-    # 使用模型中定义的 to_dict 方法递归地构建树
-    tree = [node.to_dict() for node in root_nodes]
-    return tree
+    return load_tree(kb_id)
+
+
+def etag_json_response(etag, build_payload):
+    """
+    带 ETag 的 JSON 响应：客户端的 If-None-Match 与当前版本一致时直接返回 304，
+    不再构建和传输树数据。
+    """
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify(build_payload())
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def get_tree_request_options():
+    """解析懒加载参数：depth（返回的层数，1~20）和 include_files"""
+    depth = request.args.get('depth', type=int)
+    if depth is not None:
+        depth = min(max(depth, 1), 20)
+    include_files = request.args.get('include_files', 'false').lower() == 'true'
+    return depth, include_files
 
 
 # ===============================================================
@@ -123,10 +156,14 @@ def update_knowledge_base(current_user, kb_id):
 def delete_knowledge_base(current_user, kb_id):
     """删除一个知识库及其所有内容"""
     kb = KnowledgeBase.query.get_or_404(kb_id)
-    # 由于模型中设置了 cascade='all, delete-orphan'，相关节点和文件会被自动删除
+    kb_name = kb.name
+    # 按 kb_id 批量删除节点和文件记录，避免 ORM 级联逐个节点加载子节点和文件
+    file_paths = delete_kb_nodes(kb.id)
     db.session.delete(kb)
     db.session.commit()
-    return jsonify({'message': f'知识库 "{kb.name}" 已被成功删除'}), 200
+    # 记录提交后再删除物理文件
+    remove_files([os.path.join(current_app.config['UPLOAD_FOLDER'], path) for path in file_paths])
+    return jsonify({'message': f'知识库 "{kb_name}" 已被成功删除'}), 200
 
 
 # ===============================================================
@@ -136,11 +173,60 @@ def delete_knowledge_base(current_user, kb_id):
 @kb_bp.route('/kbs/<int:kb_id>/tree', methods=['GET'])
 @token_required
 def get_knowledge_base_tree(current_user, kb_id):
-    """获取指定知识库的完整节点树 (对所有登录用户开放)"""
+    """
+    获取指定知识库的节点树 (对所有登录用户开放)
+    不带参数时返回完整树；带 depth=N 时只返回最上面 N 层，每个节点附带 child_count/file_count，
+    文件列表需 include_files=true 或通过 /nodes/<id>/files 分页获取。
+    """
     if not KnowledgeBase.query.get(kb_id):
         return jsonify({'error': '知识库不存在'}), 404
-    tree = build_node_tree(kb_id)
-    return jsonify(tree), 200
+
+    depth, include_files = get_tree_request_options()
+    if depth is None:
+        return etag_json_response(subtree_etag(kb_id, variant='full'), lambda: build_node_tree(kb_id))
+
+    return etag_json_response(
+        subtree_etag(kb_id, variant=f'depth={depth};files={include_files}'),
+        lambda: load_tree_levels(kb_id, max_depth=depth, include_files=include_files)
+    )
+
+
+@kb_bp.route('/nodes/<int:node_id>/children', methods=['GET'])
+@token_required
+def expand_node(current_user, node_id):
+    """展开一个节点：返回该节点及其下 depth 层（默认 1 层）子节点"""
+    node = KnowledgeBaseNode.query.get_or_404(node_id)
+    depth, include_files = get_tree_request_options()
+    depth = depth or 1
+
+    def build_payload():
+        subtree = load_tree_levels(node.kb_id, root=node, max_depth=depth, include_files=include_files)
+        return subtree[0] if subtree else {}
+
+    return etag_json_response(
+        subtree_etag(node.kb_id, root=node, variant=f'depth={depth};files={include_files}'),
+        build_payload
+    )
+
+
+@kb_bp.route('/nodes/<int:node_id>/files', methods=['GET'])
+@token_required
+def list_node_files(current_user, node_id):
+    """分页获取一个节点下的文件"""
+    node = KnowledgeBaseNode.query.get_or_404(node_id)
+    page = request.args.get('page', 1, type=int)
+    per_page = min(request.args.get('per_page', 50, type=int), 500)
+
+    files = KnowledgeBaseFile.query.filter_by(node_id=node.id) \
+        .order_by(KnowledgeBaseFile.id).paginate(page=page, per_page=per_page, error_out=False)
+
+    return jsonify({
+        'files': [file.to_dict() for file in files.items],
+        'total': files.total,
+        'pages': files.pages,
+        'current_page': page,
+        'per_page': per_page
+    }), 200
 
 
 @kb_bp.route('/nodes', methods=['POST'])
@@ -151,17 +237,29 @@ def create_node(current_user):
     data = request.get_json()
     if not data or 'name' not in data or 'kb_id' not in data:
         return jsonify({'error': '缺少必要参数 (name, kb_id)'}), 400
+    try:
+        kb_id = int(data['kb_id'])
+    except (TypeError, ValueError):
+        return jsonify({'error': 'kb_id 必须是整数'}), 400
 
-    if not KnowledgeBase.query.get(data['kb_id']):
+    if not KnowledgeBase.query.get(kb_id):
         return jsonify({'error': '指定的知识库不存在'}), 404
 
+    parent_node = None
+    if data.get('parent_id') is not None:
+        parent_node = KnowledgeBaseNode.query.get(data['parent_id'])
+        if not parent_node or parent_node.kb_id != kb_id:
+            return jsonify({'error': '指定的父节点不存在'}), 404
+
     new_node = KnowledgeBaseNode(
         name=data['name'],
         description=data.get('description', ''),
-        kb_id=data['kb_id'],
+        kb_id=kb_id,
         parent_id=data.get('parent_id')  # 如果没有parent_id，则为根节点
     )
     db.session.add(new_node)
+    db.session.flush()  # 获取 new_node.id 以生成路径
+    assign_node_path(new_node, parent_node)
     db.session.commit()
     return jsonify(new_node.to_dict(include_children=False)), 201
 
@@ -170,12 +268,23 @@ def create_node(current_user):
 @token_required
 @permission_required([0, 1])  # 仅限管理员和领导
 def update_node(current_user, node_id):
-    """更新一个节点的名称或描述"""
+    """更新一个节点的名称、描述，或通过 parent_id 将节点及其子树移动到同一知识库的其他位置"""
     node = KnowledgeBaseNode.query.get_or_404(node_id)
     data = request.get_json()
     if not data:
         return jsonify({'error': '请求体为空'}), 400
 
+    if 'parent_id' in data and data['parent_id'] != node.parent_id:
+        new_parent = None
+        if data['parent_id'] is not None:
+            new_parent = KnowledgeBaseNode.query.get(data['parent_id'])
+            if not new_parent or new_parent.kb_id != node.kb_id:
+                return jsonify({'error': '指定的父节点不存在'}), 404
+        try:
+            move_subtree(node, new_parent)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
     if 'name' in data:
         node.name = data['name']
     if 'description' in data:
@@ -192,9 +301,12 @@ def update_node(current_user, node_id):
 def delete_node(current_user, node_id):
     """删除一个节点及其所有子节点和文件"""
     node = KnowledgeBaseNode.query.get_or_404(node_id)
-    db.session.delete(node)
+    node_name = node.name
+    # 按路径范围一次删除整棵子树的节点和文件记录，提交后再删除物理文件
+    file_paths = delete_subtree(node)
     db.session.commit()
-    return jsonify({'message': f'节点 "{node.name}" 已被成功删除'}), 200
+    remove_files([os.path.join(current_app.config['UPLOAD_FOLDER'], path) for path in file_paths])
+    return jsonify({'message': f'节点 "{node_name}" 已被成功删除'}), 200
 
 
 @kb_bp.route('/nodes/insert', methods=['POST'])
@@ -221,14 +333,10 @@ def insert_node_layer(current_user):
         )
         db.session.add(new_child_node)
         db.session.flush()  # 刷新会话以获取 new_child_node.id
+        assign_node_path(new_child_node, parent_node)
 
-        # 2. 查找原父节点的所有文件
-        files_to_move = list(parent_node.files)
-
-        # 3. 如果有文件，则移动它们
-        if files_to_move:
-            for file in files_to_move:
-                file.node_id = new_child_node.id
+        # 2. 将原父节点的所有文件移动到新层级（一条 UPDATE）
+        move_node_files(parent_node, new_child_node)
 
         db.session.commit()
         return jsonify(new_child_node.to_dict()), 201
@@ -238,6 +346,219 @@ def insert_node_layer(current_user):
         return jsonify({'error': f'插入层级时发生错误: {str(e)}'}), 500
 
 
+# ===============================================================
+#  批量操作：移动/复制子树、批量上传、zip 导入
+# ===============================================================
+
+def resolve_target_parent(data, default_kb_id):
+    """
+    解析批量操作的目标位置：parent_id 为空时作为 kb_id（默认为原知识库）的根节点
+    :return: (父节点或 None, 目标知识库ID, 错误响应)
+    """
+    parent_id = data.get('parent_id')
+    if parent_id is not None:
+        parent = KnowledgeBaseNode.query.get(parent_id)
+        if not parent:
+            return None, None, (jsonify({'error': '指定的父节点不存在'}), 404)
+        return parent, parent.kb_id, None
+
+    kb_id = data.get('kb_id') or default_kb_id
+    if not KnowledgeBase.query.get(kb_id):
+        return None, None, (jsonify({'error': '目标知识库不存在'}), 404)
+    return None, kb_id, None
+
+
+def insert_file_records(node_id, saved_files, texts, user_id):
+    """批量插入文件记录和提取出的文本（各一条多行 INSERT），返回新文件ID列表。调用方负责 commit。"""
+    if not saved_files:
+        return []
+    file_table = KnowledgeBaseFile.__table__
+    now = datetime.now()
+    file_ids = db.session.execute(
+        db.insert(file_table).returning(file_table.c.id, sort_by_parameter_order=True),
+        [{
+            'node_id': saved['node_id'] if node_id is None else node_id,
+            'original_name': saved['original_name'],
+            'file_path': saved['file_path'],
+            'file_type': saved['file_type'],
+            'upload_user_id': user_id,
+            'upload_date': now
+        } for saved in saved_files]
+    ).scalars().all()
+
+    # 无法提取文本的文件也写入只含文件名的记录，以便按文件名检索（与 update_kb_file_index 一致）
+    db.session.execute(
+        db.insert(KnowledgeBaseFileContent.__table__),
+        [{'file_id': file_id, 'title': saved['original_name'], 'content': extracted, 'extracted_at': now}
+         for file_id, saved, extracted in zip(file_ids, saved_files, texts)]
+    )
+    return file_ids
+
+
+@kb_bp.route('/nodes/<int:node_id>/move', methods=['POST'])
+@token_required
+@permission_required([0, 1])  # 仅限管理员和领导
+def move_node(current_user, node_id):
+    """
+    将节点及其整棵子树移动到 parent_id 下，parent_id 为空时移动为 kb_id（可为其他知识库）的根节点。
+    节点路径由一条 UPDATE 改写，文件记录无需改动。
+    """
+    node = KnowledgeBaseNode.query.get_or_404(node_id)
+    data = request.get_json() or {}
+    parent, kb_id, error = resolve_target_parent(data, node.kb_id)
+    if error:
+        return error
+
+    try:
+        move_subtree(node, parent, kb_id=kb_id)
+        db.session.commit()
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'移动节点时发生错误: {str(e)}'}), 500
+
+    return jsonify(KnowledgeBaseNode.query.get(node_id).to_dict(include_children=False)), 200
+
+
+@kb_bp.route('/nodes/<int:node_id>/copy', methods=['POST'])
+@token_required
+@permission_required([0, 1])  # 仅限管理员和领导
+def copy_node(current_user, node_id):
+    """
+    复制节点及其整棵子树（含文件）到 parent_id 下，parent_id 为空时复制为 kb_id 的根节点。
+    节点逐层批量插入，物理文件以硬链接复制，整个操作一次提交。
+    """
+    node = KnowledgeBaseNode.query.get_or_404(node_id)
+    data = request.get_json() or {}
+    parent, kb_id, error = resolve_target_parent(data, node.kb_id)
+    if error:
+        return error
+
+    new_paths = []
+    try:
+        new_root_id, copied_files = copy_subtree(node, parent, kb_id=kb_id, name=data.get('name'))
+        new_paths = duplicate_files([file.file_path for file, _ in copied_files], kb_id)
+        update_file_paths({new_id: path for (_, new_id), path in zip(copied_files, new_paths)})
+        db.session.commit()
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        remove_files([os.path.join(current_app.config['UPLOAD_FOLDER'], path) for path in new_paths])
+        return jsonify({'error': f'复制节点时发生错误: {str(e)}'}), 500
+
+    return jsonify({
+        'node': KnowledgeBaseNode.query.get(new_root_id).to_dict(include_children=False),
+        'file_count': len(copied_files)
+    }), 201
+
+
+@kb_bp.route('/nodes/<int:node_id>/files/batch', methods=['POST'])
+@token_required
+def batch_upload_files(current_user, node_id):
+    """
+    一次请求上传多个文件到一个节点 (对所有登录用户开放)，表单字段名为 files。
+    文件并发写入磁盘并提取文本，数据库记录批量插入后一次提交。
+    """
+    uploads = [upload for upload in request.files.getlist('files') if upload and upload.filename]
+    if not uploads:
+        return jsonify({'error': '没有选择文件'}), 400
+
+    node = KnowledgeBaseNode.query.get(node_id)
+    if not node:
+        return jsonify({'error': '目标节点不存在'}), 404
+    if node.children.first():
+        return jsonify({'error': '只能向最末端的节点上传文件'}), 400
+
+    saved_files = []
+    try:
+        saved_files = save_uploads(uploads, node.kb_id)
+        texts = extract_texts([(saved['absolute_path'], saved['file_type']) for saved in saved_files])
+        file_ids = insert_file_records(node.id, saved_files, texts, current_user.id)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        remove_files([saved['absolute_path'] for saved in saved_files])
+        return jsonify({'error': f'批量上传失败: {str(e)}'}), 500
+
+    files = KnowledgeBaseFile.query.filter(KnowledgeBaseFile.id.in_(file_ids)).order_by(KnowledgeBaseFile.id).all()
+    return jsonify({'files': [file.to_dict() for file in files], 'count': len(files)}), 201
+
+
+@kb_bp.route('/kbs/<int:kb_id>/import', methods=['POST'])
+@token_required
+@permission_required([0, 1])  # 仅限管理员和领导
+def import_zip(current_user, kb_id):
+    """
+    将 zip 压缩包导入为节点层级：目录成为节点，文件挂在所在目录对应的节点下。
+    表单字段：file（zip 文件），parent_id（可选，导入到该节点下，否则作为根节点），
+    name（可选，先创建一个以此命名的节点作为导入内容的容器）。
+    压缩包根目录下的文件需要一个容器节点，未提供 name 时使用压缩包文件名。
+    """
+    if not KnowledgeBase.query.get(kb_id):
+        return jsonify({'error': '知识库不存在'}), 404
+
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        return jsonify({'error': '没有选择文件'}), 400
+
+    parent = None
+    parent_id = request.form.get('parent_id', type=int)
+    if parent_id is not None:
+        parent = KnowledgeBaseNode.query.get(parent_id)
+        if not parent or parent.kb_id != kb_id:
+            return jsonify({'error': '指定的父节点不存在'}), 404
+
+    # 保存到临时文件，zipfile 需要可随机读取的文件，并发解压时各线程共享同一个文件
+    with tempfile.TemporaryDirectory() as temp_dir:
+        archive_path = os.path.join(temp_dir, 'import.zip')
+        upload.save(archive_path)
+        if not zipfile.is_zipfile(archive_path):
+            return jsonify({'error': '文件不是有效的 zip 压缩包'}), 400
+
+        saved_files = []
+        try:
+            with zipfile.ZipFile(archive_path) as archive:
+                directories, files = read_zip_structure(archive, current_app.config.get('KB_IMPORT_MAX_BYTES'))
+
+                container_name = request.form.get('name') or \
+                    (os.path.splitext(os.path.basename(upload.filename))[0] if any(not folder for _, folder, _ in files)
+                     else None)
+                specs = []
+                if container_name:
+                    specs.append({'key': (), 'parent_key': None, 'name': container_name})
+                for folder in directories:
+                    parent_key = folder[:-1] if (folder[:-1] or container_name) else None
+                    specs.append({'key': folder, 'parent_key': parent_key, 'name': folder[-1]})
+
+                node_ids = insert_nodes_bulk(kb_id, parent, specs)
+                saved_files = extract_zip_files(archive, [(info, name) for info, _, name in files], kb_id)
+
+            for saved, (_, folder, _) in zip(saved_files, files):
+                saved['node_id'] = node_ids[folder]
+            texts = extract_texts([(saved['absolute_path'], saved['file_type']) for saved in saved_files])
+            insert_file_records(None, saved_files, texts, current_user.id)
+            db.session.commit()
+        except ValueError as e:
+            db.session.rollback()
+            remove_files([saved['absolute_path'] for saved in saved_files])
+            return jsonify({'error': str(e)}), 400
+        except Exception as e:
+            db.session.rollback()
+            remove_files([saved['absolute_path'] for saved in saved_files])
+            return jsonify({'error': f'导入压缩包失败: {str(e)}'}), 500
+
+    return jsonify({
+        'message': '导入完成',
+        'node_count': len(node_ids),
+        'file_count': len(saved_files),
+        'root_node_ids': [node_ids[spec['key']] for spec in specs if spec['parent_key'] is None]
+    }), 201
+
+
 # ===============================================================
 #  知识库文件 (File) 管理 API
 # ===============================================================
@@ -290,6 +611,12 @@ def upload_file(current_user, node_id):
         db.session.add(new_file)
         db.session.commit()
 
+        # 提取文本并写入全文索引
+        try:
+            update_kb_file_index(new_file, file_path, get_mime_type(filename) or new_file.file_type)
+        except Exception as e:
+            print(f"创建知识库文件索引时出错: {str(e)}")
+
         return jsonify(new_file.to_dict()), 201
 
     return jsonify({'error': '文件上传失败'}), 500
@@ -318,6 +645,71 @@ def delete_file(current_user, file_id):
         return jsonify({'error': f'删除文件时发生错误: {str(e)}'}), 500
 
 
+@kb_bp.route('/search', methods=['GET'])
+@token_required
+def search_knowledge_base(current_user):
+    """
+    全文检索知识库文件 (对所有登录用户开放)
+    参数：q 检索词（空格分隔多个词），kb_id 限定知识库，node_id 限定子树，page / per_page 分页
+    """
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': '请输入检索词'}), 400
+
+    kb_id = request.args.get('kb_id', type=int)
+    node_id = request.args.get('node_id', type=int)
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
+
+    root = None
+    if node_id is not None:
+        root = KnowledgeBaseNode.query.get(node_id)
+        if not root:
+            return jsonify({'error': '节点不存在'}), 404
+
+    try:
+        results, total = search_kb_files(query, kb_id=kb_id, root=root, page=page, per_page=per_page)
+    except Exception as e:
+        return jsonify({'error': f'检索时发生错误: {str(e)}'}), 500
+
+    return jsonify({
+        'results': results,
+        'total': total,
+        'pages': (total + per_page - 1) // per_page,
+        'current_page': page,
+        'per_page': per_page
+    }), 200
+
+
+@kb_bp.route('/kbs/<int:kb_id>/reindex', methods=['POST'])
+@token_required
+@permission_required([0, 1])  # 仅限管理员和领导
+def reindex_knowledge_base(current_user, kb_id):
+    """
+    为知识库中尚未建立索引的文件提取文本（用于索引功能上线前上传的文件）
+    每次最多处理 limit 个文件，返回剩余数量，前端可重复调用直至为 0
+    """
+    if not KnowledgeBase.query.get(kb_id):
+        return jsonify({'error': '知识库不存在'}), 404
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 500)
+
+    pending = KnowledgeBaseFile.query \
+        .join(KnowledgeBaseNode, KnowledgeBaseFile.node_id == KnowledgeBaseNode.id) \
+        .filter(KnowledgeBaseNode.kb_id == kb_id, ~KnowledgeBaseFile.content.has())
+    remaining = pending.count()
+
+    indexed = 0
+    for kb_file in pending.order_by(KnowledgeBaseFile.id).limit(limit).all():
+        physical_file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], kb_file.file_path)
+        mime_type = get_mime_type(kb_file.original_name) or kb_file.file_type
+        # 无法提取文本（包括文件缺失）时也会写入只含文件名的记录，不会被重复处理
+        if update_kb_file_index(kb_file, physical_file_path, mime_type):
+            indexed += 1
+        remaining -= 1
+
+    return jsonify({'indexed': indexed, 'remaining': remaining}), 200
+
+
 # --- 优化 #4: 修改下载路由以支持预览 ---
 @kb_bp.route('/download/files/<int:file_id>', methods=['GET'])
 @token_required
@@ -341,7 +733,7 @@ def download_file(current_user, file_id):
         if mimetype is None:
             mimetype = 'application/octet-stream'
 
-        return send_from_directory(
+        return serve_file_from_directory(
             full_directory_path,
             filename,
             as_attachment=not is_preview,  # 如果是预览，则不是附件
@@ -1,19 +1,21 @@
 # routes/leaders.py
 import string
 import random
+from functools import lru_cache
 
 from flask import Blueprint, request, jsonify
 from flask_cors import CORS
-from sqlalchemy import desc
+from sqlalchemy import desc, func
 from user_agents import parse
 
 from models import db, Project, ProjectFile, User, StageTask, ProjectStage, EditTimeTracking, ReportClockinDetail, \
-    ReportClockin, UserSession, TaskProgressUpdate, Subproject, AnnouncementReadStatus, UserActivityLog, Comment, Reply, \
-    AIConversation, AIApi
+    ReportClockin, UserSession, TaskProgressUpdate, Subproject, UserActivityLog, UserDeletionJob
 from datetime import datetime, date, timedelta
 
 from routes.employees import token_required
 from utils.activity_tracking import track_activity, log_user_activity
+from utils.user_deletion import start_user_deletion, find_ongoing_assignment
+from utils.announcement_reads import init_read_watermark
 from utils.network_utils import get_real_ip
 
 leader_bp = Blueprint('leader', __name__)
@@ -448,6 +450,30 @@ def get_project_list(current_user):
 
 
 # 用户管理
+RECENT_SESSION_LIMIT = 5  # 用户列表中每个用户展示的最近会话数
+
+
+@lru_cache(maxsize=1024)
+def describe_user_agent(user_agent_string):
+    """把 User-Agent 解析为设备描述（同一浏览器的字符串大量重复，解析结果按字符串缓存）"""
+    if not user_agent_string:
+        return "未知设备"
+    try:
+        user_agent = parse(user_agent_string)
+        # 获取设备信息
+        if user_agent.is_mobile:
+            device = f"移动设备 ({user_agent.device.brand} {user_agent.device.model})"
+        elif user_agent.is_tablet:
+            device = f"平板设备 ({user_agent.device.brand} {user_agent.device.model})"
+        elif user_agent.is_pc:
+            device = f"电脑 ({user_agent.browser.family} on {user_agent.os.family})"
+        else:
+            device = f"{user_agent.browser.family} on {user_agent.os.family}"
+        return device
+    except Exception:
+        return "未知设备"
+
+
 @leader_bp.route('/users', methods=['GET'])
 @token_required
 def get_users(current_user):
@@ -460,7 +486,7 @@ def get_users(current_user):
         search = request.args.get('search', '')
         role = request.args.get('role', type=int)
 
-        query = User.query
+        query = db.session.query(User, func.count().over().label('total'))
 
         if search:
             query = query.filter(User.username.ilike(f'%{search}%'))
@@ -471,58 +497,60 @@ def get_users(current_user):
         if current_user.role == 1:
             query = query.filter(User.role != 0)
 
-        total = query.count()
-        users = query.paginate(page=page, per_page=page_size)
-
-        def parse_user_agent(user_agent_string):
-            if not user_agent_string:
-                return "未知设备"
-            try:
-                user_agent = parse(user_agent_string)
-                # 获取设备信息
-                if user_agent.is_mobile:
-                    device = f"移动设备 ({user_agent.device.brand} {user_agent.device.model})"
-                elif user_agent.is_tablet:
-                    device = f"平板设备 ({user_agent.device.brand} {user_agent.device.model})"
-                elif user_agent.is_pc:
-                    device = f"电脑 ({user_agent.browser.family} on {user_agent.os.family})"
-                else:
-                    device = f"{user_agent.browser.family} on {user_agent.os.family}"
-                return device
-            except:
-                return "未知设备"
+        # 1. 当前页的用户，总数由窗口函数在同一查询中得到
+        rows = query.order_by(User.id).offset((page - 1) * page_size).limit(page_size).all()
+        users = [user for user, _ in rows]
+        total = rows[0].total if rows else query.with_entities(func.count(User.id)).scalar()
+        user_ids = [user.id for user in users]
+
+        # 2. 这些用户各自最近的 RECENT_SESSION_LIMIT 个会话（窗口函数）
+        sessions_by_user = {}
+        if user_ids:
+            ranked = db.session.query(
+                UserSession.user_id, UserSession.login_time, UserSession.is_active,
+                UserSession.ip_address, UserSession.user_agent,
+                func.row_number().over(partition_by=UserSession.user_id,
+                                       order_by=desc(UserSession.login_time)).label('position')
+            ).filter(UserSession.user_id.in_(user_ids)).subquery()
+            for session in db.session.query(ranked).filter(ranked.c.position <= RECENT_SESSION_LIMIT) \
+                    .order_by(ranked.c.user_id, ranked.c.position).all():
+                sessions_by_user.setdefault(session.user_id, []).append(session)
+
+        # 3. 这些用户负责的项目
+        projects_by_user = {}
+        if user_ids:
+            for project in Project.query.filter(Project.employee_id.in_(user_ids)).all():
+                projects_by_user.setdefault(project.employee_id, []).append(project)
 
         user_list = []
-        for user in users.items:
-            last_session = UserSession.query.filter_by(user_id=user.id).order_by(desc(UserSession.login_time)).first()
-
-            projects = Project.query.filter_by(employee_id=user.id).all()
+        for user in users:
+            sessions = sessions_by_user.get(user.id, [])
+            last_session = sessions[0] if sessions else None
             project_list = [{
                 'id': project.id,
                 'name': project.name,
                 'progress': round(project.progress, 2) if project.progress else None,
                 'status': project.status,
                 'deadline': project.deadline.isoformat() if project.deadline else None
-            } for project in projects]
+            } for project in projects_by_user.get(user.id, [])]
 
-            # 更新获取IP的逻辑
             user_data = {
                 'id': user.id,
                 'username': user.username,
                 'role': user.role,
+                'is_disabled': user.is_disabled,
                 'lastLogin': {
-                    'login_time': last_session.login_time.isoformat() if last_session else None,
-                    'is_active': last_session.is_active if last_session else False,
-                    'ip_address': get_real_ip() if last_session else None,
-                    'device_info': parse_user_agent(last_session.user_agent) if last_session else "未知设备"
+                    'login_time': last_session.login_time.isoformat(),
+                    'is_active': last_session.is_active,
+                    'ip_address': last_session.ip_address,
+                    'device_info': describe_user_agent(last_session.user_agent)
                 } if last_session else None,
                 'projects': project_list,
                 'sessions': [{
                     'login_time': session.login_time.isoformat(),
-                    'ip_address': get_real_ip(),
-                    'device_info': parse_user_agent(session.user_agent)
-                } for session in
-                    UserSession.query.filter_by(user_id=user.id).order_by(desc(UserSession.login_time)).limit(5)]
+                    'ip_address': session.ip_address,
+                    'device_info': describe_user_agent(session.user_agent)
+                } for session in sessions]
             }
             user_list.append(user_data)
 
@@ -563,6 +591,9 @@ def create_user(current_user):
         new_user.role = data['role']
 
         db.session.add(new_user)
+        db.session.flush()
+        # 此前发布的公告不计入新用户的未读数
+        init_read_watermark(new_user.id)
         db.session.commit()
 
         return jsonify({
@@ -648,71 +679,13 @@ def delete_user(current_user, user_id):
         if user.id == current_user.id:
             return jsonify({'error': '不能删除当前登录用户'}), 400
 
-        # 开始事务
-        with db.session.begin_nested():
-            # 1. 处理用户关联的项目
-            projects = Project.query.filter_by(employee_id=user.id).all()
-            for project in projects:
-                # 检查项目状态
-                if project.status == 'ongoing':
-                    return jsonify({'error': f'用户有正在进行中的项目: {project.name}, 无法删除'}), 400
-                # 将项目负责人设为空
-                project.employee_id = None
-
-            # 2. 处理用户关联的子项目
-            subprojects = Subproject.query.filter_by(employee_id=user.id).all()
-            for subproject in subprojects:
-                # 检查子项目状态
-                if subproject.status == 'ongoing':
-                    return jsonify({'error': f'用户有正在进行中的子项目: {subproject.name}, 无法删除'}), 400
-                # 将子项目负责人设为空
-                subproject.employee_id = None
-
-            # 3. 处理用户的团队成员关系
-            if user.role == 2:  # 如果是组长
-                # 获取该组长的所有组员
-                team_members = User.query.filter_by(team_leader_id=user.id).all()
-                # 解除所有组员的组长关联
-                for member in team_members:
-                    member.team_leader_id = None
-            elif user.role == 3:  # 如果是组员
-                # 清除组长关联
-                user.team_leader_id = None
-
-            # 4. 处理上传文件的用户ID
-            ProjectFile.query.filter_by(upload_user_id=user.id).update({'upload_user_id': None})
-
-            # 5. 处理任务进度更新记录
-            TaskProgressUpdate.query.filter_by(recorder_id=user.id).update({'recorder_id': None})
-
-            # 6. 处理用户会话
-            UserSession.query.filter_by(user_id=user.id).delete()
-
-            # 7. 处理用户活动日志
-            UserActivityLog.query.filter_by(user_id=user.id).delete()
-
-            # 8. 处理用户的补卡记录
-            ReportClockin.query.filter_by(employee_id=user.id).delete()
+        # 正在进行中的项目/子项目不能解除负责人（后台任务执行前会再检查一次）
+        error = find_ongoing_assignment(user.id)
+        if error:
+            return jsonify({'error': error}), 400
 
-            # 9. 处理训练评论和回复
-            Comment.query.filter_by(user_id=user.id).delete()
-            Reply.query.filter_by(user_id=user.id).delete()
-
-            # 10. 处理AI相关数据
-            AIConversation.query.filter_by(user_id=user.id).delete()
-            AIApi.query.filter_by(user_id=user.id).delete()
-
-            # 11. 处理公告阅读状态
-            AnnouncementReadStatus.query.filter_by(user_id=user.id).delete()
-
-            # 12. 处理编辑时间跟踪
-            EditTimeTracking.query.filter_by(user_id=user.id).delete()
-
-            # 最后删除用户
-            db.session.delete(user)
-
-        # 提交事务
-        db.session.commit()
+        # 立即停用用户，关联数据由后台任务分块删除（utils/user_deletion.py）
+        job = start_user_deletion(user, current_user.id)
 
         # 记录删除用户操作
         log_user_activity(
@@ -724,9 +697,10 @@ def delete_user(current_user, user_id):
         )
 
         return jsonify({
-            'message': '用户删除成功',
-            'username': user.username
-        })
+            'message': '用户已停用，正在后台删除',
+            'username': user.username,
+            'job': job.to_dict()
+        }), 202
 
     except Exception as e:
         db.session.rollback()
@@ -734,6 +708,17 @@ def delete_user(current_user, user_id):
         return jsonify({'error': f'删除用户失败: {str(e)}'}), 500
 
 
+# 查询用户删除任务的进度
+@leader_bp.route('/users/deletion-jobs/<int:job_id>', methods=['GET'])
+@token_required
+def get_user_deletion_job(current_user, job_id):
+    if current_user.role not in [0, 1]:
+        return jsonify({'error': '权限不足'}), 403
+
+    job = UserDeletionJob.query.get_or_404(job_id)
+    return jsonify(job.to_dict())
+
+
 @leader_bp.route('/users/<int:user_id>/change-password', methods=['PUT'])
 @token_required
 def change_user_password(current_user, user_id):
@@ -1,20 +1,25 @@
-import base64
 import re
 import os
 import io
 import urllib
 import hashlib
 import json
+import shutil
+import tempfile
+import threading
 import time
-from flask import Blueprint, request, jsonify, current_app, send_from_directory
+from flask import Blueprint, request, jsonify, current_app
 from datetime import datetime, timedelta
 
 from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
+from config import register_maintenance_job
 from models import db, Training, Comment, Reply, User
-from routes.employees import token_required
+from routes.employees import token_required, get_user_from_query_token
 from routes.filemanagement import python_dir
 from utils.activity_tracking import track_activity
+from utils.file_serving import serve_file
 import urllib.parse
 
 
@@ -26,8 +31,11 @@ training_bp = Blueprint('training', __name__)
 ALLOWED_EXTENSIONS = {'pdf'}
 UPLOAD_FOLDER = os.path.join(python_dir, 'uploads')  # 基础上传目录
 # PDF缓存设置
-CACHE_EXPIRY = 60 * 60 * 24 * 7  # 缓存七天
+CACHE_EXPIRY = 60 * 60 * 24 * 7  # 缓存七天（按最近一次访问计算）
+CACHE_MAX_BYTES = 1024 * 1024 * 1024  # 预览缓存总大小上限，超出时按最近访问时间淘汰
 CACHE_DIR = os.path.join(python_dir, 'cache', 'pdf_previews')
+# 渲染锁按缓存键分片，避免同一页面被并发请求重复渲染
+_render_locks = [threading.Lock() for _ in range(32)]
 
 # 确保缓存目录存在
 os.makedirs(CACHE_DIR, exist_ok=True)
@@ -93,9 +101,43 @@ def generate_cache_key(file_path, scale=2.0):
     return hashlib.md5(cache_key.encode()).hexdigest()
 
 
-def get_cache_file_path(cache_key):
-    """获取缓存文件路径"""
-    return os.path.join(CACHE_DIR, f"{cache_key}.json")
+def get_cache_file_path(cache_key, page_number=None):
+    """
+    获取缓存文件路径
+    每个缓存键对应一个目录：manifest.json 记录页数，page_N.png 为第 N 页的图片
+    """
+    if page_number is None:
+        return os.path.join(CACHE_DIR, cache_key, 'manifest.json')
+    return os.path.join(CACHE_DIR, cache_key, f"page_{page_number}.png")
+
+
+def _write_cache_file(path, data):
+    """先写临时文件再替换，并发读取时不会读到不完整的文件"""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def normalize_preview_scale(scale):
+    """将缩放因子限制在 0.5~4 之间并取 0.5 的整数倍，避免缓存键无限增长"""
+    try:
+        scale = float(scale)
+    except (TypeError, ValueError):
+        return 2.0
+    return min(max(round(scale * 2) / 2, 0.5), 4.0)
+
+
+def get_training_file_path(filename):
+    """将请求中的文件名解析为 uploads 目录下的路径，越界时返回 None"""
+    return safe_join(os.path.join(current_app.root_path, 'uploads'), urllib.parse.unquote(filename))
 
 
 # 分配培训任务
@@ -468,18 +510,18 @@ def add_reply(comment_id):
 @token_required
 def preview_training_file(current_user, filename):
     try:
-        # 解码文件名
-        filename = urllib.parse.unquote(filename)
-
-        # 构建完整的文件路径
-        file_path = os.path.join(current_app.root_path, 'uploads', filename)
+        # 构建完整的文件路径（解码文件名，并禁止跳出 uploads 目录）
+        file_path = get_training_file_path(filename)
 
-        if not os.path.exists(file_path):
+        if not file_path or not os.path.isfile(file_path):
             return jsonify({
                 'code': 404,
                 'message': '文件不存在'
             }), 404
 
+        # 解码文件名（用于生成访问URL）
+        filename = urllib.parse.unquote(filename)
+
         # 对于PDF文件，返回文件信息和访问URL，而不是转换为图像
         if file_path.lower().endswith('.pdf'):
             # 计算文件大小
@@ -488,12 +530,18 @@ def preview_training_file(current_user, filename):
             # 生成用于前端访问的URL
             file_url = f'/api/training/view/{urllib.parse.quote(filename)}'
 
-            # 尝试获取PDF页数
+            # 获取PDF页数（结果随预览缓存保存，重复访问不再打开PDF）
+            scale = normalize_preview_scale(request.args.get('scale', 2.0))
+            page_image_urls = []
             try:
-                import fitz  # PyMuPDF
-                doc = fitz.open(file_path)
-                page_count = len(doc)
-                doc.close()
+                cache_key, manifest = PDFPreviewHandler.get_manifest(file_path, scale)
+                page_count = manifest['page_count']
+                # 页面图片URL带有缓存键，文件更新后URL随之变化；前端需像 file_url 一样附加 token 参数
+                page_image_urls = [
+                    f'/api/training/preview-page/{urllib.parse.quote(filename)}'
+                    f'?page={page_number}&scale={scale}&v={cache_key}'
+                    for page_number in range(1, page_count + 1)
+                ]
             except Exception as e:
                 print(f"获取PDF页数失败: {str(e)}")
                 page_count = 0
@@ -504,6 +552,7 @@ def preview_training_file(current_user, filename):
                     'file_url': file_url,
                     'file_size': file_size,
                     'page_count': page_count,
+                    'page_image_urls': page_image_urls,
                     'file_name': os.path.basename(file_path)
                 }
             })
@@ -529,54 +578,22 @@ def preview_training_file(current_user, filename):
 @training_bp.route('/view/<path:filename>')
 def view_pdf_file(filename):
     try:
-        # 从URL参数获取token
-        token = request.args.get('token')
-        if not token:
-            return jsonify({
-                'code': 401,
-                'message': '未授权访问'
-            }), 401
-
-        # 验证token
-        try:
-            # 使用与token_required相同的验证逻辑
-            import jwt
-            from flask import current_app
-            from models import User
-
-            data = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'])
-            current_user = User.query.filter_by(id=data['user_id']).first()
-
-            if not current_user:
-                return jsonify({'code': 401, 'message': '用户不存在'}), 401
+        # 从URL参数获取并验证token
+        current_user, error_response = get_user_from_query_token()
+        if error_response:
+            return error_response
 
-        except jwt.ExpiredSignatureError:
-            return jsonify({'code': 401, 'message': 'token已过期'}), 401
-        except jwt.InvalidTokenError:
-            return jsonify({'code': 401, 'message': '无效的token'}), 401
-        except Exception as e:
-            return jsonify({
-                'code': 401,
-                'message': f'token验证失败: {str(e)}'
-            }), 401
-
-        # 解码文件名
-        filename = urllib.parse.unquote(filename)
-
-        # 构建完整的文件路径
-        file_path = os.path.join(current_app.root_path, 'uploads', filename)
+        # 构建完整的文件路径（解码文件名，并禁止跳出 uploads 目录）
+        file_path = get_training_file_path(filename)
 
-        if not os.path.exists(file_path):
+        if not file_path or not os.path.isfile(file_path):
             return jsonify({
                 'code': 404,
                 'message': '文件不存在'
             }), 404
 
-        # 获取文件目录和文件名
-        directory = os.path.dirname(file_path)
-        return send_from_directory(
-            directory,
-            os.path.basename(file_path),
+        return serve_file(
+            file_path,
             mimetype='application/pdf',
             as_attachment=False  # 不作为附件，直接在浏览器中显示
         )
@@ -593,30 +610,50 @@ def view_pdf_file(filename):
 
 
 
+# 分页预览图片：每页只渲染一次，之后直接返回缓存的 PNG 文件
+@training_bp.route('/preview-page/<path:filename>')
+def preview_training_page(filename):
+    current_user, error_response = get_user_from_query_token()
+    if error_response:
+        return error_response
+
+    try:
+        file_path = get_training_file_path(filename)
+        if not file_path or not os.path.isfile(file_path) or not file_path.lower().endswith('.pdf'):
+            return jsonify({'code': 404, 'message': '文件不存在'}), 404
+
+        page_number = request.args.get('page', 1, type=int)
+        scale = normalize_preview_scale(request.args.get('scale', 2.0))
+        image_path = PDFPreviewHandler.render_page(file_path, page_number, scale)
+        if not image_path:
+            return jsonify({'code': 404, 'message': '页码超出范围'}), 404
+
+        # 缓存键包含文件修改时间，同一URL的内容不会变化，允许浏览器长期缓存
+        return serve_file(image_path, mimetype='image/png', max_age=CACHE_EXPIRY)
+
+    except Exception as e:
+        print(f"获取预览页面失败: {str(e)}")
+        return jsonify({
+            'code': 500,
+            'message': f'获取预览页面失败: {str(e)}'
+        }), 500
+
+
 # 下载文件
 @training_bp.route('/download/<path:filename>')
 @token_required
 def download_training_file(current_user, filename):
     try:
-        # 解码文件名
-        filename = urllib.parse.unquote(filename)
+        # 构建完整的文件路径（解码文件名，并禁止跳出 uploads 目录）
+        file_path = get_training_file_path(filename)
 
-        # 构建完整的文件路径
-        file_path = os.path.join(current_app.root_path, 'uploads', filename)
-
-        if not os.path.exists(file_path):
+        if not file_path or not os.path.isfile(file_path):
             return jsonify({
                 'code': 404,
                 'message': '文件不存在'
             }), 404
 
-        # 获取文件的原始名称
-        directory = os.path.dirname(file_path)
-        return send_from_directory(
-            directory,
-            os.path.basename(file_path),
-            as_attachment=True
-        )
+        return serve_file(file_path, as_attachment=True)
 
     except Exception as e:
         return jsonify({
@@ -627,63 +664,96 @@ def download_training_file(current_user, filename):
 
 # 修改为PDF预览 - 使用PyMuPDF (fitz)
 class PDFPreviewHandler:
-    """使用PyMuPDF处理PDF预览的类"""
+    """使用PyMuPDF处理PDF预览的类，渲染结果按 (路径, 修改时间, 缩放) 缓存为 PNG 文件"""
 
     @staticmethod
-    def process_pdf(pdf_path, scale=2.0):
+    def get_manifest(pdf_path, scale=2.0):
         """
-        处理PDF文件，将每页转换为图像
-
-        Args:
-            pdf_path: PDF文件路径
-            scale: 缩放因子，用于提高图像质量
+        获取PDF的缓存清单（页数），不存在时打开PDF生成
 
         Returns:
-            字典，包含成功标志和页面数据
+            (缓存键, 清单字典)
         """
+        cache_key = generate_cache_key(pdf_path, scale)
+        manifest_path = get_cache_file_path(cache_key)
         try:
-            print(f"处理PDF文件: {pdf_path}")
+            with open(manifest_path, 'r') as f:
+                manifest = json.load(f)
+            os.utime(manifest_path)  # 记录最近访问时间，供 LRU 淘汰使用
+            return cache_key, manifest
+        except (OSError, ValueError):
+            pass
 
-            import fitz  # PyMuPDF
+        import fitz  # PyMuPDF
 
-            # 打开PDF文件
-            doc = fitz.open(pdf_path)
-            total_pages = len(doc)
-            print(f"PDF共有 {total_pages} 页")
+        with fitz.open(pdf_path) as doc:
+            page_count = len(doc)
+        manifest = {'page_count': page_count, 'scale': scale, 'timestamp': time.time()}
+        _write_cache_file(manifest_path, json.dumps(manifest).encode())
+        return cache_key, manifest
 
-            slides = []
+    @staticmethod
+    def render_page(pdf_path, page_number, scale=2.0):
+        """
+        返回第 page_number 页（从1开始）的缓存图片路径，未缓存时渲染一次
+        页码超出范围时返回 None
+        """
+        cache_key = generate_cache_key(pdf_path, scale)
+        image_path = get_cache_file_path(cache_key, page_number)
+        if os.path.exists(image_path):
+            PDFPreviewHandler._touch(cache_key)
+            return image_path
 
-            # 处理每一页
-            for page_num in range(total_pages):
-                print(f"处理第 {page_num + 1} 页")
+        with _render_locks[hash(image_path) % len(_render_locks)]:
+            if os.path.exists(image_path):
+                return image_path
 
-                # 获取页面
-                page = doc.load_page(page_num)
+            import fitz  # PyMuPDF
 
+            with fitz.open(pdf_path) as doc:
+                if not 1 <= page_number <= len(doc):
+                    return None
                 # 设置渲染参数 - 提高分辨率
-                matrix = fitz.Matrix(scale, scale)
+                pix = doc.load_page(page_number - 1).get_pixmap(matrix=fitz.Matrix(scale, scale))
+                _write_cache_file(image_path, pix.tobytes("png"))
+        PDFPreviewHandler._touch(cache_key)
+        return image_path
 
-                # 渲染页面为像素图
-                pix = page.get_pixmap(matrix=matrix)
+    @staticmethod
+    def _touch(cache_key):
+        try:
+            os.utime(get_cache_file_path(cache_key))
+        except OSError:
+            pass
 
-                # 将图像数据转换为PIL图像
-                img_data = pix.tobytes("png")
+    @staticmethod
+    def process_pdf(pdf_path, scale=2.0):
+        """
+        预先渲染PDF的所有页面到缓存
 
-                # 转换为base64
-                img_base64 = base64.b64encode(img_data).decode()
+        Args:
+            pdf_path: PDF文件路径
+            scale: 缩放因子，用于提高图像质量
 
-                # 添加到结果中
+        Returns:
+            字典，包含成功标志和页面数据（缓存键及每页图片路径）
+        """
+        try:
+            print(f"处理PDF文件: {pdf_path}")
+            cache_key, manifest = PDFPreviewHandler.get_manifest(pdf_path, scale)
+            total_pages = manifest['page_count']
+
+            slides = []
+            for page_num in range(1, total_pages + 1):
                 slides.append({
-                    'image': img_base64,
-                    'page_number': page_num + 1,
+                    'image_path': PDFPreviewHandler.render_page(pdf_path, page_num, scale),
+                    'page_number': page_num,
                     'texts': []  # PDF预览不提取文本
                 })
 
-            # 关闭PDF文档
-            doc.close()
-
             return {
                 'success': True,
+                'cache_key': cache_key,
                 'slides': slides,
                 'total_slides': total_pages
             }
@@ -698,32 +768,59 @@ class PDFPreviewHandler:
             }
 
 
-# 清理过期缓存的计划任务函数 - 可以通过Celery或其他方式定时调用
+def _cache_entry_info(entry_path):
+    """返回缓存目录的 (最近访问时间, 总字节数)"""
+    total_size = 0
+    last_access = 0
+    for entry in os.scandir(entry_path):
+        if entry.is_file():
+            stat = entry.stat()
+            total_size += stat.st_size
+            if entry.name == 'manifest.json':
+                last_access = stat.st_mtime
+            elif not last_access:
+                last_access = stat.st_mtime
+    return last_access, total_size
+
+
+# 清理过期缓存的计划任务函数，由维护调度器每小时执行
 def clean_expired_cache():
-    """清理过期的文件缓存"""
+    """清理超过 CACHE_EXPIRY 未访问的预览缓存，并将总大小控制在 CACHE_MAX_BYTES 以内"""
     now = time.time()
     count = 0
+    entries = []
 
-    # 检查文件缓存
-    for filename in os.listdir(CACHE_DIR):
-        if not filename.endswith('.json'):
-            continue
+    if not os.path.isdir(CACHE_DIR):
+        return count
 
-        file_path = os.path.join(CACHE_DIR, filename)
+    for entry in os.scandir(CACHE_DIR):
         try:
-            with open(file_path, 'r') as f:
-                data = json.load(f)
-                if now - data['timestamp'] > CACHE_EXPIRY:
-                    os.remove(file_path)
-                    count += 1
+            if not entry.is_dir():
+                # 旧版本遗留的 JSON 缓存文件
+                os.remove(entry.path)
+                count += 1
+                continue
+
+            last_access, total_size = _cache_entry_info(entry.path)
+            if now - last_access > CACHE_EXPIRY:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                count += 1
+            else:
+                entries.append((last_access, total_size, entry.path))
         except Exception as e:
             print(f"清理缓存文件出错: {str(e)}")
-            # 如果文件损坏，直接删除
-            try:
-                os.remove(file_path)
-                count += 1
-            except:
-                pass
+
+    # 按最近访问时间从旧到新淘汰，直到总大小低于上限
+    total_bytes = sum(size for _, size, _ in entries)
+    for last_access, size, path in sorted(entries):
+        if total_bytes <= CACHE_MAX_BYTES:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total_bytes -= size
+        count += 1
 
     print(f"清理了 {count} 个过期缓存文件")
-    return count
\ No newline at end of file
+    return count
+
+
+register_maintenance_job('training_preview_cache_cleanup', clean_expired_cache, hours=1)
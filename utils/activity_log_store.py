@@ -0,0 +1,339 @@
+# utils/activity_log_store.py
+"""
+用户活动日志的分区存储、归档和查询
+
+- 热表：主库中的 user_activity_logs，只保存当月（以及尚未轮转的）日志，ORM 写入方式不变
+- 月分区：每天的维护任务把当月以前的日志按月移动到独立的 SQLite 文件
+  （ACTIVITY_LOG_PARTITION_DIR/activity_YYYY_MM.db），主库只保留最近的数据，备份和 VACUUM 更快
+- 压缩：移动时，由端点/方法/路径自动生成的 action_detail 不再保存，读取时重新生成
+- 归档：超过 ACTIVITY_LOG_RETENTION_MONTHS 个月的分区压缩为 .db.gz 并删除原文件（不再参与查询）；
+  ACTIVITY_LOG_ARCHIVE_MONTHS 不为 None 时，更早的归档文件会被删除
+- 查询：query_activity_logs 按时间范围只打开相关的分区，按 (时间, ID) 倒序跨分区做游标（keyset）分页，
+  每页的代价与翻到第几页无关
+
+活动次数统计读取 user_activity_rollups（见 utils/activity_rollups.py），不受轮转和归档影响。
+"""
+import base64
+import gzip
+import os
+import re
+import shutil
+import sqlite3
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import text
+
+from config import register_maintenance_job
+from models import db, User
+
+PARTITION_PATTERN = re.compile(r'^activity_(\d{4})_(\d{2})\.db$')
+ARCHIVE_PATTERN = re.compile(r'^activity_(\d{4})_(\d{2})\.db\.gz$')
+# 与 SQLAlchemy 在 SQLite 中保存 DateTime 的格式一致，可直接按字符串比较
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+LOG_COLUMNS = ('id', 'user_id', 'action_type', 'action_detail', 'ip_address', 'timestamp', 'resource_type',
+               'resource_id', 'status_code', 'request_method', 'endpoint', 'request_path')
+
+PARTITION_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS {schema}.user_activity_logs (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        action_type VARCHAR(50) NOT NULL,
+        action_detail TEXT,
+        detail_compacted BOOLEAN NOT NULL DEFAULT 0,
+        ip_address VARCHAR(50),
+        timestamp DATETIME NOT NULL,
+        resource_type VARCHAR(50),
+        resource_id INTEGER,
+        status_code INTEGER,
+        request_method VARCHAR(10),
+        endpoint VARCHAR(255),
+        request_path VARCHAR(255)
+    )""",
+    "CREATE INDEX IF NOT EXISTS {schema}.ix_activity_logs_timestamp ON user_activity_logs (timestamp)",
+    "CREATE INDEX IF NOT EXISTS {schema}.ix_activity_logs_user_timestamp ON user_activity_logs (user_id, timestamp)",
+    "CREATE INDEX IF NOT EXISTS {schema}.ix_activity_logs_action_timestamp ON user_activity_logs (action_type, timestamp)",
+)
+
+# track_activity 自动生成的详情（不含“结果”部分），与端点/方法/路径完全一致时可以省略
+AUTO_DETAIL_SQL = "'访问端点: ' || coalesce(endpoint, 'None') || ', 方法: ' || request_method || ', 路径: ' || request_path"
+
+
+def month_start(year, month):
+    return datetime(year, month, 1)
+
+
+def next_month(moment):
+    return month_start(moment.year + (moment.month == 12), moment.month % 12 + 1)
+
+
+def format_timestamp(moment):
+    return moment.strftime(TIMESTAMP_FORMAT)
+
+
+def partition_dir():
+    directory = current_app.config.get('ACTIVITY_LOG_PARTITION_DIR')
+    if not directory:
+        directory = os.path.join(os.path.dirname(db.engine.url.database or '.'), 'activity_logs')
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def partition_path(moment):
+    return os.path.join(partition_dir(), f"activity_{moment.year:04d}_{moment.month:02d}.db")
+
+
+def list_partitions(pattern=PARTITION_PATTERN):
+    """返回 [(月份起点, 文件路径)]，按月份倒序"""
+    directory = partition_dir()
+    partitions = []
+    for name in os.listdir(directory):
+        match = pattern.match(name)
+        if match:
+            partitions.append((month_start(int(match.group(1)), int(match.group(2))), os.path.join(directory, name)))
+    return sorted(partitions, reverse=True)
+
+
+def ensure_activity_log_indexes():
+    """
+    热表和已有分区的时间索引（按时间范围轮转、查询和游标分页），启动时调用
+    SQLite 的索引隐含 rowid，(timestamp) 索引即可按 (timestamp, id) 排序
+    """
+    for statement in PARTITION_SCHEMA[1:]:
+        db.session.execute(text(statement.format(schema='main')))
+    db.session.commit()
+    for _, path in list_partitions():
+        connection = sqlite3.connect(path)
+        try:
+            for statement in PARTITION_SCHEMA[1:]:
+                connection.execute(statement.format(schema='main'))
+            connection.commit()
+        finally:
+            connection.close()
+
+
+def rotate_activity_logs(now=None):
+    """
+    把当月以前的日志按月移动到分区文件（每个月一个事务：复制后从热表删除）
+    :return: {‘YYYY-MM’: 移动的行数}
+    """
+    now = now or datetime.now()
+    current_month = format_timestamp(month_start(now.year, now.month))
+    months = db.session.execute(text(
+        "SELECT DISTINCT substr(timestamp, 1, 7) FROM user_activity_logs WHERE timestamp < :current_month"
+    ), {'current_month': current_month}).scalars().all()
+    db.session.commit()
+
+    moved = {}
+    for month in sorted(months):
+        start = month_start(int(month[:4]), int(month[5:7]))
+        moved[month] = _move_month(start)
+    return moved
+
+
+def _move_month(start):
+    params = {'start': format_timestamp(start), 'end': format_timestamp(next_month(start))}
+    columns = ', '.join(column for column in LOG_COLUMNS if column != 'action_detail')
+    # ATTACH/DETACH 不能在事务中执行，使用独立连接，每步之后立即提交
+    with db.engine.connect() as connection:
+        connection.exec_driver_sql("ATTACH DATABASE ? AS partition_db", (partition_path(start),))
+        connection.commit()
+        try:
+            for statement in PARTITION_SCHEMA:
+                connection.exec_driver_sql(statement.format(schema='partition_db'))
+            connection.commit()
+            # 复制和删除在同一事务中，中途失败时热表不受影响；重复执行时 INSERT OR IGNORE 跳过已复制的行
+            # 方法/路径为空的日志（如 log_activity 直接写入的）比较结果为 NULL，按未省略处理
+            compacted = f"coalesce(action_detail = {AUTO_DETAIL_SQL}, 0)"
+            connection.execute(text(f"""
+                INSERT OR IGNORE INTO partition_db.user_activity_logs ({columns}, action_detail, detail_compacted)
+                SELECT {columns},
+                       CASE WHEN {compacted} THEN NULL ELSE action_detail END,
+                       {compacted}
+                FROM main.user_activity_logs
+                WHERE timestamp >= :start AND timestamp < :end
+            """), params)
+            # 只删除分区中已有的行，未能复制的行留在热表
+            result = connection.execute(text(
+                "DELETE FROM main.user_activity_logs WHERE timestamp >= :start AND timestamp < :end "
+                "AND id IN (SELECT id FROM partition_db.user_activity_logs)"
+            ), params)
+            connection.commit()
+            return result.rowcount
+        finally:
+            connection.rollback()
+            connection.exec_driver_sql("DETACH DATABASE partition_db")
+            connection.commit()
+
+
+def archive_old_partitions(now=None):
+    """
+    超过保留期的分区压缩归档，超过归档保留期的归档文件删除
+    :return: (归档的分区数, 删除的归档数)
+    """
+    now = now or datetime.now()
+    retention = current_app.config.get('ACTIVITY_LOG_RETENTION_MONTHS', 12)
+    archive_retention = current_app.config.get('ACTIVITY_LOG_ARCHIVE_MONTHS')
+    current_index = now.year * 12 + now.month - 1
+
+    archived = 0
+    for start, path in list_partitions():
+        if current_index - (start.year * 12 + start.month - 1) <= retention:
+            continue
+        with open(path, 'rb') as source, gzip.open(path + '.gz', 'wb') as target:
+            shutil.copyfileobj(source, target, 1024 * 1024)
+        os.remove(path)
+        archived += 1
+
+    removed = 0
+    if archive_retention is not None:
+        for start, path in list_partitions(ARCHIVE_PATTERN):
+            if current_index - (start.year * 12 + start.month - 1) > retention + archive_retention:
+                os.remove(path)
+                removed += 1
+    return archived, removed
+
+
+def maintain_activity_logs():
+    """定时任务：轮转热表、归档过期分区"""
+    moved = rotate_activity_logs()
+    archived, removed = archive_old_partitions()
+    if moved or archived or removed:
+        current_app.logger.info(
+            f"活动日志维护：移动 {sum(moved.values())} 条，归档 {archived} 个分区，删除 {removed} 个归档")
+
+
+register_maintenance_job('activity_log_rotation', maintain_activity_logs, hours=24)
+
+
+def delete_user_partition_logs(user_id):
+    """删除某个用户在各月分区中的日志（热表中的日志由调用方删除；已归档的压缩文件不处理）"""
+    deleted = 0
+    for _, path in list_partitions():
+        connection = sqlite3.connect(path)
+        try:
+            with connection:
+                deleted += connection.execute(
+                    "DELETE FROM user_activity_logs WHERE user_id = ?", (user_id,)).rowcount
+        finally:
+            connection.close()
+    return deleted
+
+
+# ---------------------------------------------------------------
+# 查询
+# ---------------------------------------------------------------
+
+def encode_cursor(timestamp, log_id):
+    """游标为最后一条日志的 (时间, ID)，对客户端不透明"""
+    return base64.urlsafe_b64encode(f"{timestamp}|{log_id}".encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """:raises ValueError: 游标无效"""
+    try:
+        timestamp, log_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|')
+        datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+        return timestamp, int(log_id)
+    except Exception:
+        raise ValueError('无效的分页游标')
+
+
+def _filters(user_id, action_type, start, end, cursor):
+    conditions, params = [], []
+    if user_id:
+        conditions.append('user_id = ?')
+        params.append(user_id)
+    if action_type:
+        conditions.append('action_type = ?')
+        params.append(action_type)
+    if start is not None:
+        conditions.append('timestamp >= ?')
+        params.append(format_timestamp(start))
+    if end is not None:
+        conditions.append('timestamp < ?')
+        params.append(format_timestamp(end))
+    if cursor is not None:
+        # 第一项可直接使用索引做范围扫描，第二项排除同一时间戳下已返回的行
+        conditions.append('timestamp <= ? AND (timestamp < ? OR id < ?)')
+        params.extend([cursor[0], cursor[0], cursor[1]])
+    return (' WHERE ' + ' AND '.join(conditions)) if conditions else '', params
+
+
+def _select_sql(where, compacted_column):
+    return (f"SELECT {', '.join(LOG_COLUMNS)}, {compacted_column} AS detail_compacted "
+            f"FROM user_activity_logs{where} ORDER BY timestamp DESC, id DESC LIMIT ?")
+
+
+def _fetch_hot(where, params, limit):
+    """主库热表（通过当前会话的连接读取）"""
+    sql = _select_sql(where, '0')
+    bind = {}
+    for index, value in enumerate(params + [limit]):
+        sql = sql.replace('?', f':p{index}', 1)
+        bind[f'p{index}'] = value
+    return [dict(row) for row in db.session.execute(text(sql), bind).mappings().all()]
+
+
+def _fetch_partition(path, where, params, limit):
+    """月分区文件（只读打开）"""
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    connection.row_factory = sqlite3.Row
+    try:
+        return [dict(row) for row in connection.execute(_select_sql(where, 'detail_compacted'), params + [limit])]
+    finally:
+        connection.close()
+
+
+def _partitions_in_range(start, end):
+    """与时间范围有交集的分区，按月份倒序"""
+    for partition_start, path in list_partitions():
+        if end is not None and partition_start >= end:
+            continue
+        if start is not None and next_month(partition_start) <= start:
+            continue
+        yield path
+
+
+def query_activity_logs(per_page=20, user_id=None, action_type=None, start=None, end=None, cursor=None):
+    """
+    跨热表和月分区按 (时间, ID) 倒序分页查询活动日志
+    热表中的日志一定比所有分区新，依次读取热表和各分区，直到凑满一页
+    :param start: 起始时间（含），None 表示不限
+    :param end: 结束时间（不含），None 表示不限
+    :param cursor: 上一页返回的 next_cursor，None 表示第一页
+    :return: (日志字典列表（含 username）, 下一页游标（没有更多时为 None）)
+    :raises ValueError: 游标无效
+    """
+    position = decode_cursor(cursor) if cursor else None
+    where, params = _filters(user_id, action_type, start, end, position)
+    # 多取一条判断是否还有下一页
+    wanted = per_page + 1
+    logs = _fetch_hot(where, params, wanted)
+    if len(logs) < wanted:
+        # 游标之后的分区不会有结果
+        partition_end = datetime.strptime(position[0], TIMESTAMP_FORMAT) if position else None
+        if partition_end is not None and (end is None or partition_end < end):
+            partition_end += timedelta(microseconds=1)
+        else:
+            partition_end = end
+        for path in _partitions_in_range(start, partition_end):
+            logs.extend(_fetch_partition(path, where, params, wanted - len(logs)))
+            if len(logs) >= wanted:
+                break
+
+    next_cursor = None
+    if len(logs) > per_page:
+        logs = logs[:per_page]
+        next_cursor = encode_cursor(logs[-1]['timestamp'], logs[-1]['id'])
+
+    usernames = dict(db.session.query(User.id, User.username)
+                     .filter(User.id.in_({log['user_id'] for log in logs})).all()) if logs else {}
+    for log in logs:
+        if log.pop('detail_compacted') and log['action_detail'] is None:
+            log['action_detail'] = f"访问端点: {log['endpoint']}, 方法: {log['request_method']}, 路径: {log['request_path']}"
+        log['username'] = usernames.get(log['user_id'])
+        if isinstance(log['timestamp'], str):
+            log['timestamp'] = datetime.fromisoformat(log['timestamp'])
+    return logs, next_cursor
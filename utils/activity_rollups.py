@@ -0,0 +1,118 @@
+# utils/activity_rollups.py
+"""
+用户活动的按天汇总
+
+每写入一条 UserActivityLog，就在同一事务中对 user_activity_rollups 的天桶执行一次
+UPSERT（计数加一）。管理后台的统计只读取汇总表，查询代价与日志总量无关。
+
+汇总表在首次启动时由 backfill_activity_rollups 从已有日志生成；
+此前写入的小时桶没有接口使用，启动时删除。
+删除日志（例如删除用户）时需同时删除对应的汇总行。
+"""
+from datetime import datetime, time, timedelta
+
+from sqlalchemy import event, func, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import db, UserActivityLog, UserActivityRollup
+
+BUCKET_HOUR = 'hour'  # 已停用，仅用于清理旧数据
+BUCKET_DAY = 'day'
+
+
+def day_start(day=None):
+    return datetime.combine(day or datetime.now().date(), time.min)
+
+
+@event.listens_for(UserActivityLog, 'after_insert')
+def _increment_rollups(mapper, connection, target):
+    day = day_start((target.timestamp or datetime.now()).date())
+    table = UserActivityRollup.__table__
+    statement = sqlite_insert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=['bucket_type', 'bucket_start', 'user_id', 'endpoint', 'action_type', 'status_code'],
+        set_={'count': table.c['count'] + 1}
+    )
+    base = {
+        'user_id': target.user_id,
+        'endpoint': target.endpoint or '',
+        'action_type': target.action_type,
+        'status_code': target.status_code or 0,
+        'count': 1
+    }
+    connection.execute(statement, dict(base, bucket_type=BUCKET_DAY, bucket_start=day))
+
+
+def backfill_activity_rollups():
+    """
+    汇总表为空而日志不为空时，从日志一次性生成汇总（启动时调用）
+    :return: 生成的汇总行数
+    """
+    # 旧版本写入的小时桶
+    if UserActivityRollup.query.filter_by(bucket_type=BUCKET_HOUR).delete(synchronize_session=False):
+        db.session.commit()
+    if db.session.query(UserActivityRollup.id).first() is not None:
+        return 0
+    if db.session.query(UserActivityLog.id).first() is None:
+        return 0
+
+    # 与 SQLAlchemy 在 SQLite 中保存 DateTime 的格式一致
+    bucket_expression = "strftime('%Y-%m-%d 00:00:00.000000', timestamp)"
+    db.session.execute(text(f"""
+        INSERT INTO user_activity_rollups
+            (bucket_type, bucket_start, user_id, endpoint, action_type, status_code, count)
+        SELECT :bucket_type, {bucket_expression}, user_id, coalesce(endpoint, ''), action_type,
+               coalesce(status_code, 0), count(*)
+        FROM user_activity_logs
+        GROUP BY {bucket_expression}, user_id, coalesce(endpoint, ''), action_type, coalesce(status_code, 0)
+    """), {'bucket_type': BUCKET_DAY})
+    db.session.commit()
+    return db.session.query(func.count(UserActivityRollup.id)).scalar()
+
+
+def delete_user_rollups(user_id):
+    """删除某个用户的所有汇总行（与删除其活动日志一同调用），调用方负责 commit"""
+    UserActivityRollup.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+
+
+def _day_query(*columns, user_id=None):
+    query = db.session.query(*columns).filter(UserActivityRollup.bucket_type == BUCKET_DAY)
+    if user_id:
+        query = query.filter(UserActivityRollup.user_id == user_id)
+    return query
+
+
+def count_activities(user_id=None, start=None, end=None, action_type=None):
+    """[start, end) 范围内的活动次数（按天汇总，start/end 为当天零点）；不指定范围时为全部"""
+    query = _day_query(func.coalesce(func.sum(UserActivityRollup.count), 0), user_id=user_id)
+    if start is not None:
+        query = query.filter(UserActivityRollup.bucket_start >= start)
+    if end is not None:
+        query = query.filter(UserActivityRollup.bucket_start < end)
+    if action_type is not None:
+        query = query.filter(UserActivityRollup.action_type == action_type)
+    return query.scalar()
+
+
+def count_today(user_id=None):
+    today = day_start()
+    return count_activities(user_id=user_id, start=today, end=today + timedelta(days=1))
+
+
+def daily_trend(days=30, user_id=None):
+    """最近有活动的 days 天的每日活动次数，按日期倒序"""
+    rows = _day_query(UserActivityRollup.bucket_start, func.sum(UserActivityRollup.count), user_id=user_id) \
+        .group_by(UserActivityRollup.bucket_start) \
+        .order_by(UserActivityRollup.bucket_start.desc()) \
+        .limit(days).all()
+    return [(bucket_start.date(), count) for bucket_start, count in rows]
+
+
+def breakdown(column, user_id=None, start=None, end=None):
+    """按 column（endpoint/action_type/status_code/user_id）分组的活动次数"""
+    query = _day_query(column, func.sum(UserActivityRollup.count), user_id=user_id)
+    if start is not None:
+        query = query.filter(UserActivityRollup.bucket_start >= start)
+    if end is not None:
+        query = query.filter(UserActivityRollup.bucket_start < end)
+    return dict(query.group_by(column).all())
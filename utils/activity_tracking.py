@@ -1,6 +1,6 @@
 # utils/activity_tracking.py
 
-from datetime import datetime, timedelta
+from datetime import datetime
 from functools import wraps
 from flask import request, jsonify, g
 
@@ -10,6 +10,9 @@ import jwt
 import re
 
 from utils.network_utils import get_real_ip
+from utils.session_store import touch_active_session
+# 导入即注册活动汇总的 after_insert 事件
+from utils import activity_rollups  # noqa: F401
 
 def create_user_session(user_id):
     """
@@ -50,53 +53,6 @@ def create_user_session(user_id):
 
 
 
-# 更新用户的最后活动时间
-def update_user_activity(user_id):
-    try:
-        active_session = UserSession.query.filter_by(
-            user_id=user_id,
-            is_active=True
-        ).first()
-
-        if active_session:
-            active_session.last_activity_time = datetime.now()  # 直接使用datetime对象
-            db.session.commit()
-    except Exception as e:
-        print(f"Error updating user activity: {str(e)}")
-        db.session.rollback()
-
-
-def check_session_timeout(user_id):
-    """
-    检查用户会话是否超时（1小时无活动）
-    """
-    try:
-        active_session = UserSession.query.filter_by(
-            user_id=user_id,
-            is_active=True
-        ).first()
-
-        if not active_session:
-            return False
-
-        last_activity = active_session.last_activity_time
-        timeout_threshold = datetime.now() - timedelta(hours=1)
-
-        if last_activity < timeout_threshold:
-            current_time = datetime.now()
-            active_session.is_active = False
-            active_session.logout_time = current_time
-            active_session.session_duration = int((current_time - active_session.login_time).total_seconds())
-            db.session.commit()
-            return False
-
-        return True
-    except Exception as e:
-        print(f"检查会话超时时出错：{str(e)}")
-        return False
-
-
-
 def extract_resource_info(endpoint, view_args):
     """
     从端点和URL参数中提取资源类型和ID
@@ -187,16 +143,13 @@ def track_activity(f):
             data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
             user_id = data['user_id']
 
-            # 检查会话超时
-            if not check_session_timeout(user_id):
+            # 检查会话超时并更新最后活动时间（一条 UPDATE；超时会话由后台任务统一结束）
+            if not touch_active_session(user_id):
                 return jsonify({
                     'message': '会话已过期，请重新登录',
                     'code': 'SESSION_EXPIRED'
                 }), 401
 
-            # 更新最后活动时间
-            update_user_activity(user_id)
-
             # 执行原始函数
             response = f(*args, **kwargs)
 
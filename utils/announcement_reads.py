@@ -0,0 +1,159 @@
+# utils/announcement_reads.py
+"""
+公告阅读状态（稀疏存储）
+
+不再为每条公告给每个用户预先写一行状态，某用户对某公告是否已读按以下顺序判断：
+1. announcement_read_status 中有 is_read = 0 的记录：用户手动标记为未读
+2. 有 is_read = 1 且 read_at >= 公告 revised_at 的记录：已读
+3. 用户的已读水位 seen_until >= 公告 revised_at（“全部标为已读”）：已读
+4. 公告发布早于用户的 joined_at（创建用户之前的公告）：已读，且不计入阅读统计
+5. 其余为未读
+
+创建用户时调用 init_read_watermark 写入水位（seen_until = joined_at = 当前时间）。
+发布公告只写公告本身；修改内容时只更新 revised_at，旧的已读记录自然失效。
+未读数和阅读统计都由一条聚合查询（NOT EXISTS 反连接 / COUNT）得到。
+"""
+from datetime import datetime
+
+from sqlalchemy import DateTime, and_, bindparam, case, exists, func, inspect, or_, select, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import db, Announcement, AnnouncementReadStatus, AnnouncementReadWatermark, User
+
+
+def ensure_announcement_read_columns():
+    """
+    旧数据库迁移（启动时调用）：
+    - 补充 announcements.revised_at，回填为发布时间（此前修改内容会把状态重置为未读，现存的已读记录都晚于发布时间）
+    - 为没有水位的用户补写水位：seen_until 为当前时间，joined_at 为该用户最早有状态行的公告的发布时间。
+      此前只有发布时已存在的用户才有状态行，没有状态行的旧公告因此仍不计入未读；
+      预先写入的未读行保留，按手动未读标记处理，未读数与迁移前一致
+    """
+    columns = {column['name'] for column in inspect(db.engine).get_columns('announcements')}
+    if 'revised_at' not in columns:
+        db.session.execute(text("ALTER TABLE announcements ADD COLUMN revised_at DATETIME"))
+        db.session.execute(text("UPDATE announcements SET revised_at = created_at WHERE revised_at IS NULL"))
+    columns = {column['name'] for column in inspect(db.engine).get_columns('announcement_read_watermarks')}
+    if 'joined_at' not in columns:
+        db.session.execute(text("ALTER TABLE announcement_read_watermarks ADD COLUMN joined_at DATETIME"))
+
+    first_row = ("SELECT min(a.created_at) FROM announcement_read_status s "
+                 "JOIN announcements a ON a.id = s.announcement_id WHERE s.user_id = {user}")
+    now = datetime.now()
+    db.session.execute(text(f"""
+        INSERT INTO announcement_read_watermarks (user_id, seen_until, joined_at)
+        SELECT u.id, :now, coalesce(({first_row.format(user='u.id')}), :now)
+        FROM users u
+        WHERE NOT EXISTS (SELECT 1 FROM announcement_read_watermarks w WHERE w.user_id = u.id)
+    """).bindparams(bindparam('now', type_=DateTime)), {'now': now})
+    db.session.execute(text(f"""
+        UPDATE announcement_read_watermarks
+        SET joined_at = coalesce(({first_row.format(user='announcement_read_watermarks.user_id')}), seen_until)
+        WHERE joined_at IS NULL
+    """))
+    db.session.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_announcement_read_user ON announcement_read_status (user_id, announcement_id)"))
+    db.session.commit()
+
+
+def init_read_watermark(user_id):
+    """新建用户时调用：此前发布的公告不计入该用户的未读数和阅读统计（调用方负责 commit）"""
+    now = datetime.now()
+    statement = sqlite_insert(AnnouncementReadWatermark.__table__).values(
+        user_id=user_id, seen_until=now, joined_at=now)
+    db.session.execute(statement.on_conflict_do_nothing(index_elements=['user_id']))
+
+
+def _watermark(user_id, column):
+    return select(column).where(AnnouncementReadWatermark.user_id == user_id).scalar_subquery()
+
+
+def is_read_expression(user_id):
+    """当前用户是否已读某公告的 SQL 表达式（与 Announcement 关联使用）"""
+    receipt = AnnouncementReadStatus
+    explicit_unread = exists().where(receipt.announcement_id == Announcement.id,
+                                     receipt.user_id == user_id,
+                                     receipt.is_read.is_(False))
+    valid_receipt = exists().where(receipt.announcement_id == Announcement.id,
+                                   receipt.user_id == user_id,
+                                   receipt.is_read.is_(True),
+                                   receipt.read_at >= Announcement.revised_at)
+    watermark = AnnouncementReadWatermark
+    return and_(~explicit_unread,
+                or_(valid_receipt,
+                    func.coalesce(_watermark(user_id, watermark.seen_until) >= Announcement.revised_at, False),
+                    func.coalesce(_watermark(user_id, watermark.joined_at) > Announcement.created_at, False)))
+
+
+def read_states(user_id, announcement_ids):
+    """:return: {公告ID: 是否已读}"""
+    if not announcement_ids:
+        return {}
+    rows = db.session.query(Announcement.id, is_read_expression(user_id)) \
+        .filter(Announcement.id.in_(announcement_ids)).all()
+    return {announcement_id: bool(is_read) for announcement_id, is_read in rows}
+
+
+def count_unread(user_id):
+    """当前用户的有效公告中未读的数量（一条查询）"""
+    return db.session.query(func.count(Announcement.id)).filter(
+        Announcement.is_active.is_(True),
+        ~is_read_expression(user_id)
+    ).scalar()
+
+
+def set_read_state(user_id, announcement_id, is_read=True):
+    """写入一条已读回执或手动未读标记（UPSERT），调用方负责 commit"""
+    values = {'is_read': is_read, 'read_at': datetime.now() if is_read else None}
+    statement = sqlite_insert(AnnouncementReadStatus.__table__).values(
+        announcement_id=announcement_id, user_id=user_id, **values)
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['announcement_id', 'user_id'], set_=values))
+
+
+def mark_all_read(user_id):
+    """把水位推进到当前时间，并清除手动未读标记，调用方负责 commit"""
+    now = datetime.now()
+    statement = sqlite_insert(AnnouncementReadWatermark.__table__).values(user_id=user_id, seen_until=now)
+    db.session.execute(statement.on_conflict_do_update(index_elements=['user_id'], set_={'seen_until': now}))
+    AnnouncementReadStatus.query.filter_by(user_id=user_id, is_read=False).delete(synchronize_session=False)
+    return now
+
+
+def _statistics_query(announcement):
+    """非管理员用户（role != 0，不含已停用用户和公告发布之后创建的用户）对该公告的阅读状态"""
+    receipt = AnnouncementReadStatus
+    watermark = AnnouncementReadWatermark
+    is_read = case(
+        (receipt.is_read.is_(False), False),
+        (receipt.read_at >= announcement.revised_at, True),
+        (watermark.seen_until >= announcement.revised_at, True),
+        else_=False
+    )
+    query = db.session.query(User.id, User.username, User.role, is_read.label('is_read'),
+                             case((receipt.read_at >= announcement.revised_at, receipt.read_at)).label('read_at')) \
+        .outerjoin(receipt, and_(receipt.user_id == User.id, receipt.announcement_id == announcement.id)) \
+        .outerjoin(watermark, watermark.user_id == User.id) \
+        .filter(User.role != 0, User.is_disabled.is_(False),
+                or_(watermark.joined_at.is_(None), watermark.joined_at <= announcement.created_at))
+    return query, is_read
+
+
+def read_statistics(announcement, with_users=True):
+    """
+    :return: (总人数, 已读人数, 用户阅读状态列表或 None)
+    """
+    query, is_read = _statistics_query(announcement)
+    total_users, read_users = query.with_entities(
+        func.count(User.id), func.coalesce(func.sum(case((is_read, 1), else_=0)), 0)).one()
+
+    user_status = None
+    if with_users:
+        user_status = [{
+            'user_id': user_id,
+            'username': username,
+            'is_read': bool(read),
+            'read_at': read_at.isoformat() if read_at else None,
+            'role': role
+        } for user_id, username, role, read, read_at in query.order_by(User.id).all()]
+    return total_users, read_users, user_status
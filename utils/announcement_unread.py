@@ -0,0 +1,126 @@
+# utils/announcement_unread.py
+"""
+未读公告数的进程内缓存和推送
+
+1. 计数缓存
+   每个用户的未读数在首次查询时计算（count_unread，一条聚合查询），之后直接返回缓存值。
+   - 公告发布、修改、上下线后调用 invalidate_unread_counts()：全局代次加一，所有用户的缓存失效
+   - 用户标记已读/未读、全部标为已读后调用 invalidate_unread_counts(user_id)：只使该用户的缓存失效
+   失效需在 commit 之后调用；计算期间发生失效时结果不写入缓存，避免缓存旧值。
+   其他 worker 进程中的变化无法通知到本进程，由 ANNOUNCEMENT_UNREAD_CACHE_TTL 限制过期时间。
+
+2. 推送（Server-Sent Events）
+   客户端订阅后，缓存失效时向订阅队列投递一个通知，unread_count_events 重新取数，
+   数值变化时才推送 unread-count 事件；无变化时每 ANNOUNCEMENT_STREAM_HEARTBEAT 秒发送一次心跳，
+   同时按 TTL 重新取数以包含其他进程的修改。每个连接最长保持 ANNOUNCEMENT_STREAM_MAX_AGE 秒，
+   之后由 EventSource 自动重连，重连时重新校验令牌和会话。
+"""
+import queue
+import threading
+import time
+
+from flask import current_app
+
+from models import db
+from utils.announcement_reads import count_unread
+
+_lock = threading.Lock()
+_generation = 0  # 全局代次：公告本身变化时加一
+_user_versions = {}  # 用户ID -> 该用户阅读状态的变化次数
+_counts = {}  # 用户ID -> (未读数, 全局代次, 用户版本, 缓存时间)
+_subscribers = {}  # 用户ID -> {订阅队列}
+
+
+def get_unread_count(user_id):
+    """返回用户的未读公告数，优先使用缓存"""
+    ttl = current_app.config.get('ANNOUNCEMENT_UNREAD_CACHE_TTL', 300)
+    now = time.monotonic()
+    with _lock:
+        generation, version = _generation, _user_versions.get(user_id, 0)
+        entry = _counts.get(user_id)
+        if entry is not None:
+            count, entry_generation, entry_version, cached_at = entry
+            if (entry_generation, entry_version) == (generation, version) and now - cached_at < ttl:
+                return count
+
+    count = count_unread(user_id)
+
+    with _lock:
+        if (_generation, _user_versions.get(user_id, 0)) == (generation, version):
+            _counts[user_id] = (count, generation, version, now)
+    return count
+
+
+def invalidate_unread_counts(user_id=None):
+    """
+    使未读数缓存失效并通知订阅者（commit 之后调用）
+    :param user_id: None 表示公告本身发生变化，所有用户失效
+    """
+    global _generation
+    with _lock:
+        if user_id is None:
+            _generation += 1
+            _counts.clear()
+            targets = [q for queues in _subscribers.values() for q in queues]
+        else:
+            _user_versions[user_id] = _user_versions.get(user_id, 0) + 1
+            _counts.pop(user_id, None)
+            targets = list(_subscribers.get(user_id, ()))
+    for subscriber in targets:
+        try:
+            subscriber.put_nowait(True)
+        except queue.Full:
+            # 已有未处理的通知，订阅者取数时会拿到最新值
+            pass
+
+
+def _subscribe(user_id):
+    subscriber = queue.Queue(maxsize=1)
+    with _lock:
+        _subscribers.setdefault(user_id, set()).add(subscriber)
+    return subscriber
+
+
+def _unsubscribe(user_id, subscriber):
+    with _lock:
+        queues = _subscribers.get(user_id)
+        if queues is not None:
+            queues.discard(subscriber)
+            if not queues:
+                del _subscribers[user_id]
+
+
+def _current_count(user_id):
+    try:
+        return get_unread_count(user_id)
+    finally:
+        # 长连接中不持有数据库会话（SQLite 读事务）
+        db.session.remove()
+
+
+def unread_count_events(user_id):
+    """
+    SSE 事件流（需在 stream_with_context 中迭代）：连接后先推送当前未读数，之后只在数值变化时推送
+    """
+    heartbeat = current_app.config.get('ANNOUNCEMENT_STREAM_HEARTBEAT', 25)
+    max_age = current_app.config.get('ANNOUNCEMENT_STREAM_MAX_AGE', 600)
+    subscriber = _subscribe(user_id)
+    try:
+        last_count = _current_count(user_id)
+        yield f"retry: 3000\nevent: unread-count\ndata: {last_count}\n\n"
+
+        deadline = time.monotonic() + max_age
+        while time.monotonic() < deadline:
+            try:
+                subscriber.get(timeout=heartbeat)
+            except queue.Empty:
+                pass
+            count = _current_count(user_id)
+            if count != last_count:
+                last_count = count
+                yield f"event: unread-count\ndata: {count}\n\n"
+            else:
+                yield ": keep-alive\n\n"
+    finally:
+        # 客户端断开时生成器被关闭（GeneratorExit），同样取消订阅
+        _unsubscribe(user_id, subscriber)
@@ -0,0 +1,46 @@
+# utils/bulk_write.py
+"""
+批量插入
+
+确实需要一次写入多行时（公告附件、补卡明细、AI 会话标签关联等），不再逐个 db.session.add 对象，
+而是把行整理成字典列表，用 Core insert 按 CHUNK_SIZE 分块执行：每块一次 executemany，
+由 DB-API 驱动在 C 层循环绑定参数，不创建 ORM 对象，也不经过 flush 的单元操作。
+
+- 列上的 Python 默认值（如 default=datetime.now）由 Core 照常填充
+- on_conflict_do_nothing=True 时生成 INSERT ... ON CONFLICT DO NOTHING，
+  冲突的行（唯一约束/主键重复）被跳过，适合重复执行也应无害的关联写入
+- 绕过了 ORM：会话中已加载的关系集合不会自动更新，需要时由调用方 refresh/expire；
+  与全文检索相关的表还需调用 invalidate_search_caches()
+- 调用方负责 commit
+"""
+from sqlalchemy import insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import db
+
+CHUNK_SIZE = 500
+
+
+def bulk_insert(target, rows, on_conflict_do_nothing=False, index_elements=None, chunk_size=CHUNK_SIZE):
+    """
+    批量插入多行
+    :param target: 模型类或 Table
+    :param rows: 字典列表，各行的键应一致
+    :param on_conflict_do_nothing: 是否跳过违反唯一约束的行
+    :param index_elements: 冲突判断使用的列，None 表示任意唯一约束/主键
+    :return: 插入的行数（跳过的冲突行不计入）
+    """
+    rows = list(rows)
+    if not rows:
+        return 0
+    table = getattr(target, '__table__', target)
+    if on_conflict_do_nothing:
+        statement = sqlite_insert(table).on_conflict_do_nothing(index_elements=index_elements)
+    else:
+        statement = insert(table)
+
+    inserted = 0
+    for start in range(0, len(rows), chunk_size):
+        result = db.session.execute(statement, rows[start:start + chunk_size])
+        inserted += max(result.rowcount, 0)
+    return inserted
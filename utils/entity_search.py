@@ -0,0 +1,237 @@
+# utils/entity_search.py
+"""
+项目、子项目、阶段、任务和文件的统一检索索引
+
+entity_search_fts 是一张 FTS5 表，每个实体一行：名称、描述（参与检索），以及类型、ID、
+所属项目/子项目/阶段和状态（UNINDEXED，仅用于过滤）。rowid = 实体ID * 8 + 类型编号，
+按实体增删改时只需按 rowid 定位。
+
+- 索引由 ORM 的 mapper 事件在同一事务中维护；删除项目/子项目/阶段时一并删除其下实体的索引行
+  （数据库的级联删除不会触发 ORM 事件）
+- 一条查询完成所有类型的检索、排序（bm25，名称权重高于描述）、每种类型的计数（窗口函数）
+  和权限过滤（与 projects 表关联，只返回当前员工负责的项目下的实体）
+- 分词器优先使用 trigram；检索词不足 3 个字符或只能使用 unicode61 时改为对索引表做 LIKE 查询
+"""
+from sqlalchemy import event, text
+
+from models import db, Project, Subproject, ProjectStage, StageTask, ProjectFile
+
+FTS_TABLE = 'entity_search_fts'
+
+# 类型 -> (编号, 模型)
+ENTITY_TYPES = {
+    'project': (1, Project),
+    'subproject': (2, Subproject),
+    'stage': (3, ProjectStage),
+    'task': (4, StageTask),
+    'file': (5, ProjectFile),
+}
+_MODEL_TYPES = {model: entity_type for entity_type, (_, model) in ENTITY_TYPES.items()}
+
+# 删除这些实体时，按对应列删除其下所有实体的索引行
+_DESCENDANT_COLUMNS = {'project': 'project_id', 'subproject': 'subproject_id', 'stage': 'stage_id'}
+
+# 从业务表重建索引（rowid 与 entity_rowid 的编码一致）
+_REBUILD_SQL = (
+    """INSERT INTO entity_search_fts (rowid, name, description, entity_type, entity_id,
+                                      project_id, subproject_id, stage_id, status)
+       SELECT id * 8 + 1, name, coalesce(description, ''), 'project', id, id, NULL, NULL, status FROM projects""",
+    """INSERT INTO entity_search_fts (rowid, name, description, entity_type, entity_id,
+                                      project_id, subproject_id, stage_id, status)
+       SELECT id * 8 + 2, name, coalesce(description, ''), 'subproject', id, project_id, id, NULL, status
+       FROM subprojects""",
+    """INSERT INTO entity_search_fts (rowid, name, description, entity_type, entity_id,
+                                      project_id, subproject_id, stage_id, status)
+       SELECT id * 8 + 3, name, coalesce(description, ''), 'stage', id, project_id, subproject_id, id, status
+       FROM project_stages""",
+    """INSERT INTO entity_search_fts (rowid, name, description, entity_type, entity_id,
+                                      project_id, subproject_id, stage_id, status)
+       SELECT t.id * 8 + 4, t.name, coalesce(t.description, ''), 'task', t.id, s.project_id, s.subproject_id,
+              t.stage_id, t.status
+       FROM stage_tasks t JOIN project_stages s ON s.id = t.stage_id""",
+    """INSERT INTO entity_search_fts (rowid, name, description, entity_type, entity_id,
+                                      project_id, subproject_id, stage_id, status)
+       SELECT id * 8 + 5, coalesce(original_name, ''), '', 'file', id, project_id, subproject_id, stage_id, NULL
+       FROM project_files""",
+)
+
+_tokenizer = None
+
+
+def entity_rowid(entity_type, entity_id):
+    return entity_id * 8 + ENTITY_TYPES[entity_type][0]
+
+
+def ensure_entity_search_index():
+    """
+    创建检索索引（启动时调用）；新建或行数与业务表不一致时从业务表整体重建
+    :return: 使用的分词器，FTS5 不可用时返回 None
+    """
+    global _tokenizer
+    exists = db.session.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': FTS_TABLE}
+    ).scalar()
+    if not exists:
+        for tokenizer in ('trigram', 'unicode61'):
+            try:
+                db.session.execute(text(
+                    f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+                    f"name, description, entity_type UNINDEXED, entity_id UNINDEXED, project_id UNINDEXED, "
+                    f"subproject_id UNINDEXED, stage_id UNINDEXED, status UNINDEXED, tokenize='{tokenizer}')"
+                ))
+                break
+            except Exception as e:
+                db.session.rollback()
+                print(f"统一检索索引（{tokenizer}）创建失败: {str(e)}")
+        else:
+            _tokenizer = ''
+            return None
+
+    indexed = db.session.execute(text(f"SELECT count(*) FROM {FTS_TABLE}")).scalar()
+    stored = sum(db.session.execute(text(f"SELECT count(*) FROM {table}")).scalar()
+                 for table in ('projects', 'subprojects', 'project_stages', 'stage_tasks', 'project_files'))
+    if indexed != stored:
+        rebuild_entity_search_index()
+    db.session.commit()
+
+    _tokenizer = None
+    return get_tokenizer()
+
+
+def rebuild_entity_search_index():
+    db.session.execute(text(f"DELETE FROM {FTS_TABLE}"))
+    for statement in _REBUILD_SQL:
+        db.session.execute(text(statement))
+    db.session.commit()
+
+
+def get_tokenizer():
+    global _tokenizer
+    if _tokenizer is None:
+        sql = db.session.execute(
+            text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': FTS_TABLE}
+        ).scalar()
+        _tokenizer = ('trigram' if 'trigram' in sql else 'unicode61') if sql else ''
+    return _tokenizer or None
+
+
+def search_entities(user_id, query, entity_types, status='', per_type_limit=100):
+    """
+    在当前员工负责的项目范围内检索实体
+    :param entity_types: 要检索的类型列表（ENTITY_TYPES 的键）
+    :param per_type_limit: 每种类型最多返回的条数（计数不受限制）
+    :return: ([(类型, ID)]（按相关度排序）, {类型: 命中总数})
+    :raises RuntimeError: 索引不可用，调用方应退回到逐表查询
+    """
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        raise RuntimeError('统一检索索引不可用')
+
+    terms = query.split()
+    type_placeholders = ', '.join(f':type{index}' for index in range(len(entity_types)))
+    params = {f'type{index}': entity_type for index, entity_type in enumerate(entity_types)}
+    params.update(user_id=user_id, status=status or '', per_type=per_type_limit)
+    conditions = [
+        'p.employee_id = :user_id',
+        f'e.entity_type IN ({type_placeholders})',
+        "(:status = '' OR e.entity_type = 'file' OR e.status = :status)",
+    ]
+
+    if not terms:
+        score = '0'
+    elif tokenizer == 'trigram' and all(len(term) >= 3 for term in terms):
+        conditions.append(f'{FTS_TABLE} MATCH :match')
+        params['match'] = '{name description} : ' + ' '.join('"' + term.replace('"', '""') + '"' for term in terms)
+        score = f'bm25({FTS_TABLE}, 10.0, 1.0)'
+    else:
+        for index, term in enumerate(terms):
+            conditions.append(f"(e.name LIKE :term{index} ESCAPE '\\' OR e.description LIKE :term{index} ESCAPE '\\')")
+            escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            params[f'term{index}'] = f'%{escaped}%'
+        # 名称命中排在描述命中之前
+        score = "CASE WHEN e.name LIKE :term0 ESCAPE '\\' THEN 0 ELSE 1 END"
+
+    rows = db.session.execute(text(f"""
+        WITH hits AS (
+            SELECT e.entity_type, e.entity_id, {score} AS score
+            FROM {FTS_TABLE} e
+            JOIN projects p ON p.id = e.project_id
+            WHERE {' AND '.join(conditions)}
+        ), ranked AS (
+            SELECT entity_type, entity_id, score,
+                   count(*) OVER (PARTITION BY entity_type) AS type_total,
+                   row_number() OVER (PARTITION BY entity_type ORDER BY score, entity_id) AS type_rank
+            FROM hits
+        )
+        SELECT entity_type, entity_id, type_total FROM ranked
+        WHERE type_rank <= :per_type
+        ORDER BY score, entity_type, entity_id
+    """), params).all()
+
+    facets = {entity_type: 0 for entity_type in entity_types}
+    hits = []
+    for entity_type, entity_id, type_total in rows:
+        facets[entity_type] = type_total
+        hits.append((entity_type, entity_id))
+    return hits, facets
+
+
+# ---------------------------------------------------------------
+# 索引维护（mapper 事件，与业务数据在同一事务中写入）
+# ---------------------------------------------------------------
+
+def _ancestry(connection, entity_type, target):
+    """返回 (project_id, subproject_id, stage_id)"""
+    if entity_type == 'project':
+        return target.id, None, None
+    if entity_type == 'subproject':
+        return target.project_id, target.id, None
+    if entity_type == 'stage':
+        return target.project_id, target.subproject_id, target.id
+    if entity_type == 'task':
+        stage = connection.execute(
+            text("SELECT project_id, subproject_id FROM project_stages WHERE id = :id"), {'id': target.stage_id}
+        ).first()
+        return (stage[0], stage[1], target.stage_id) if stage else (None, None, target.stage_id)
+    return target.project_id, target.subproject_id, target.stage_id
+
+
+def _index_entity(mapper, connection, target):
+    entity_type = _MODEL_TYPES[type(target)]
+    project_id, subproject_id, stage_id = _ancestry(connection, entity_type, target)
+    name = target.original_name if entity_type == 'file' else target.name
+    description = '' if entity_type == 'file' else target.description
+    rowid = entity_rowid(entity_type, target.id)
+    try:
+        connection.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid = :rowid"), {'rowid': rowid})
+        connection.execute(text(f"""
+            INSERT INTO {FTS_TABLE} (rowid, name, description, entity_type, entity_id,
+                                     project_id, subproject_id, stage_id, status)
+            VALUES (:rowid, :name, :description, :entity_type, :entity_id,
+                    :project_id, :subproject_id, :stage_id, :status)
+        """), {
+            'rowid': rowid, 'name': name or '', 'description': description or '', 'entity_type': entity_type,
+            'entity_id': target.id, 'project_id': project_id, 'subproject_id': subproject_id,
+            'stage_id': stage_id, 'status': getattr(target, 'status', None)
+        })
+    except Exception:
+        # 索引不可用时不影响业务数据的写入
+        pass
+
+
+def _unindex_entity(mapper, connection, target):
+    entity_type = _MODEL_TYPES[type(target)]
+    try:
+        connection.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid = :rowid"),
+                           {'rowid': entity_rowid(entity_type, target.id)})
+        column = _DESCENDANT_COLUMNS.get(entity_type)
+        if column:
+            connection.execute(text(f"DELETE FROM {FTS_TABLE} WHERE {column} = :id"), {'id': target.id})
+    except Exception:
+        pass
+
+
+for _entity_type, (_, _model) in ENTITY_TYPES.items():
+    event.listen(_model, 'after_insert', _index_entity)
+    event.listen(_model, 'after_update', _index_entity)
+    event.listen(_model, 'after_delete', _unindex_entity)
@@ -0,0 +1,96 @@
+# utils/event_channel.py
+"""
+进程内的发布/订阅通道
+
+每个 key（例如合并会话ID）对应一个条件变量，发布方调用 publish(key) 唤醒
+所有在该 key 上等待的订阅方。订阅方阻塞在条件变量上，不占用 CPU。
+
+通道只负责“有变化”的通知，不传递数据；订阅方被唤醒后自行从存储中读取最新状态。
+跨进程的变化无法通过通道通知，订阅方应在超时后重新检查一次存储。
+"""
+import threading
+
+
+class _Slot:
+    __slots__ = ('condition', 'seq', 'subscribers')
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.seq = 0
+        self.subscribers = 0
+
+
+class Subscription:
+    """对某个 key 的订阅，需通过 EventChannel.subscribe 以上下文管理器方式使用"""
+
+    def __init__(self, channel, key):
+        self._channel = channel
+        self.key = key
+        self._slot = None
+        self._seen = 0
+
+    def __enter__(self):
+        self._slot = self._channel._acquire(self.key)
+        with self._slot.condition:
+            self._seen = self._slot.seq
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._channel._release(self.key)
+        self._slot = None
+
+    def wait(self, timeout=None):
+        """
+        阻塞直到有新的发布或超时
+        :return: 自上次 wait 以来是否有新的发布
+        """
+        slot = self._slot
+        with slot.condition:
+            if slot.seq == self._seen:
+                slot.condition.wait(timeout)
+            changed = slot.seq != self._seen
+            self._seen = slot.seq
+        return changed
+
+
+class EventChannel:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._slots = {}
+
+    def subscribe(self, key):
+        return Subscription(self, key)
+
+    def publish(self, key):
+        """通知 key 的所有订阅方；没有订阅方时不做任何事"""
+        with self._lock:
+            slot = self._slots.get(key)
+        if slot is None:
+            return
+        with slot.condition:
+            slot.seq += 1
+            slot.condition.notify_all()
+
+    def subscriber_count(self, key=None):
+        with self._lock:
+            if key is not None:
+                slot = self._slots.get(key)
+                return slot.subscribers if slot else 0
+            return sum(slot.subscribers for slot in self._slots.values())
+
+    def _acquire(self, key):
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is None:
+                slot = self._slots[key] = _Slot()
+            slot.subscribers += 1
+            return slot
+
+    def _release(self, key):
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is None:
+                return
+            slot.subscribers -= 1
+            if slot.subscribers <= 0:
+                del self._slots[key]
@@ -0,0 +1,137 @@
+# utils/file_deletion.py
+"""
+项目文件的批量删除
+
+1. 一条关联查询取出所有待删除文件及其项目/子项目/阶段/任务名称（不逐个懒加载）
+2. 按 CHUNK_SIZE 分块，用 DELETE ... WHERE id IN (...) 依次删除全文索引行、统一检索索引行、
+   文件内容和文件记录；每块单独提交，一块失败只影响该块中的文件，已提交的块不回滚
+3. 提交后在线程池中并发删除物理文件
+4. 返回每个文件的结果
+
+批量 SQL 绕过了 ORM 事件，删除后需调用 invalidate_search_caches()（本模块已处理）。
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from sqlalchemy import text
+
+from models import db, ProjectFile, Project, Subproject, ProjectStage, StageTask
+from utils.search_cache import invalidate_search_caches
+from utils.entity_search import ENTITY_TYPES, FTS_TABLE as ENTITY_FTS_TABLE
+from utils.search_snippets import FTS_TABLE as CONTENT_FTS_TABLE
+
+CHUNK_SIZE = 500
+
+STATUS_DELETED = 'deleted'
+STATUS_ERROR = 'error'
+
+
+def _chunks(items, size=CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def find_files(*criteria):
+    """
+    按条件查询待删除的文件（一条关联查询）
+    :return: [{'id', 'name', 'file_path', 'project', 'subproject', 'stage', 'task'}]
+    """
+    rows = db.session.query(
+        ProjectFile.id, ProjectFile.original_name, ProjectFile.file_path,
+        Project.name, Subproject.name, ProjectStage.name, StageTask.name
+    ).outerjoin(Project, Project.id == ProjectFile.project_id) \
+        .outerjoin(Subproject, Subproject.id == ProjectFile.subproject_id) \
+        .outerjoin(ProjectStage, ProjectStage.id == ProjectFile.stage_id) \
+        .outerjoin(StageTask, StageTask.id == ProjectFile.task_id) \
+        .filter(*criteria).all()
+    return [{
+        'id': file_id,
+        'name': name,
+        'file_path': file_path,
+        'project': project or "Unknown",
+        'subproject': subproject or "Unknown",
+        'stage': stage or "Unknown",
+        'task': task or "Unknown",
+    } for file_id, name, file_path, project, subproject, stage, task in rows]
+
+
+def find_files_by_ids(file_ids):
+    files = []
+    for chunk in _chunks(list(dict.fromkeys(file_ids))):
+        files.extend(find_files(ProjectFile.id.in_(chunk)))
+    return files
+
+
+def _existing_tables(*names):
+    rows = db.session.execute(text(
+        f"SELECT name FROM sqlite_master WHERE name IN ({', '.join(f':t{i}' for i in range(len(names)))})"
+    ), {f't{i}': name for i, name in enumerate(names)}).scalars().all()
+    return set(rows)
+
+
+def _delete_chunk(file_ids, tables):
+    id_list = ','.join(str(int(file_id)) for file_id in file_ids)
+    if CONTENT_FTS_TABLE in tables:
+        db.session.execute(text(
+            f"DELETE FROM {CONTENT_FTS_TABLE} WHERE rowid IN (SELECT id FROM file_contents WHERE file_id IN ({id_list}))"
+        ))
+    if ENTITY_FTS_TABLE in tables:
+        type_code = ENTITY_TYPES['file'][0]
+        db.session.execute(text(
+            f"DELETE FROM {ENTITY_FTS_TABLE} WHERE rowid IN ({','.join(str(int(i) * 8 + type_code) for i in file_ids)})"
+        ))
+    db.session.execute(text(f"DELETE FROM file_contents WHERE file_id IN ({id_list})"))
+    db.session.execute(text(f"DELETE FROM project_files WHERE id IN ({id_list})"))
+
+
+def _remove_physical_file(path):
+    """:return: (是否删除了文件, 错误信息)"""
+    try:
+        os.remove(path)
+        return True, None
+    except FileNotFoundError:
+        return False, None
+    except OSError as e:
+        return False, str(e)
+
+
+def delete_files(files):
+    """
+    删除 find_files 返回的文件
+    :return: 与 files 对应的结果列表，每项在文件信息之外增加
+             status（deleted/error）、file_removed（物理文件是否已删除）和 error
+    """
+    tables = _existing_tables(CONTENT_FTS_TABLE, ENTITY_FTS_TABLE)
+    failed = {}
+    deleted = []
+    for chunk in _chunks(files):
+        try:
+            _delete_chunk([file['id'] for file in chunk], tables)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"批量删除文件记录出错: {str(e)}")
+            failed.update((file['id'], str(e)) for file in chunk)
+            continue
+        deleted.extend(chunk)
+    if deleted:
+        invalidate_search_caches()
+        # ORM 会话中可能缓存着已删除的对象
+        db.session.expire_all()
+
+    root = current_app.root_path
+    paths = [os.path.join(root, file['file_path']) for file in deleted]
+    workers = current_app.config.get('FILE_DELETE_WORKERS', 8)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        outcomes = dict(zip((file['id'] for file in deleted), executor.map(_remove_physical_file, paths)))
+
+    # 按输入顺序返回结果
+    results = []
+    for file in files:
+        if file['id'] in failed:
+            results.append(dict(file, status=STATUS_ERROR, file_removed=False, error=failed[file['id']]))
+        else:
+            removed, error = outcomes[file['id']]
+            results.append(dict(file, status=STATUS_DELETED, file_removed=removed, error=error))
+    return results
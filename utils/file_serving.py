@@ -0,0 +1,131 @@
+# utils/file_serving.py
+"""
+文件下载/预览的统一出口
+
+所有下载和查看路由在完成权限检查后调用 serve_file / serve_file_from_directory：
+- ETag（默认由文件大小和修改时间生成）和 Last-Modified
+- 处理 If-None-Match / If-Modified-Since（304）以及 Range / If-Range（206），
+  PDF.js 等客户端可以按需分段读取
+- 按资源是否私有设置 Cache-Control
+
+FILE_SERVING_MODE 为 'x-accel' 或 'x-sendfile' 时，只返回响应头，由前端的 nginx
+（X-Accel-Redirect）或 Apache/lighttpd（X-Sendfile）发送文件内容，Python worker
+不再被大文件下载占用；路径不在 X_ACCEL_LOCATIONS 映射中时仍由 Flask 直接发送。
+"""
+import mimetypes
+import os
+import unicodedata
+from urllib.parse import quote
+
+from flask import current_app, send_file
+from werkzeug.security import safe_join
+
+OFFLOAD_HEADERS = ('X-Accel-Redirect', 'X-Sendfile')
+
+
+def file_etag(stat_result):
+    """由文件大小和修改时间生成 ETag，文件内容变化时随之变化"""
+    return f"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"
+
+
+def serve_file(path, download_name=None, as_attachment=False, mimetype=None, private=True, max_age=None,
+               etag=None):
+    """
+    返回支持条件请求和范围请求的文件响应
+    :param path: 文件的完整路径，文件不存在时抛出 FileNotFoundError
+    :param download_name: 下载文件名（会按 RFC 5987 编码，支持中文）
+    :param as_attachment: True 为下载，False 为在浏览器中直接显示
+    :param mimetype: 内容类型，默认按 download_name 或路径推断
+    :param private: 需要登录才能访问的资源只允许浏览器缓存，不允许共享缓存（代理）缓存
+    :param max_age: 缓存秒数；None 表示可以缓存但每次使用前需用 ETag 重新验证
+    :param etag: 自定义 ETag（例如文件的 sha256），默认由大小和修改时间生成
+    """
+    stat_result = os.stat(path)
+    if not os.path.isfile(path):
+        raise FileNotFoundError(path)
+
+    response = _offload_response(path, download_name, as_attachment, mimetype)
+    if response is not None:
+        _set_cache_control(response, private, max_age)
+        return response
+
+    response = send_file(
+        path,
+        mimetype=mimetype,
+        as_attachment=as_attachment,
+        download_name=download_name,
+        conditional=True,
+        etag=etag or file_etag(stat_result),
+        last_modified=stat_result.st_mtime,
+        max_age=max_age or 0
+    )
+
+    _set_cache_control(response, private, max_age)
+    return response
+
+
+def _set_cache_control(response, private, max_age):
+    response.cache_control.public = not private
+    response.cache_control.private = private
+    if max_age:
+        response.cache_control.no_cache = None
+        response.cache_control.max_age = max_age
+    else:
+        response.cache_control.no_cache = True
+        response.cache_control.max_age = None
+        response.expires = None
+
+
+def is_offloaded(response):
+    """响应的文件内容是否交给了反向代理发送（此时文件在响应返回后仍需保留）"""
+    return any(header in response.headers for header in OFFLOAD_HEADERS)
+
+
+def _accel_location(path):
+    """按最长前缀在 X_ACCEL_LOCATIONS 中查找 nginx internal location，找不到时返回 None"""
+    path = os.path.abspath(path)
+    locations = current_app.config.get('X_ACCEL_LOCATIONS') or {}
+    for prefix in sorted(locations, key=len, reverse=True):
+        prefix_abs = os.path.abspath(prefix)
+        if path == prefix_abs or path.startswith(prefix_abs.rstrip(os.sep) + os.sep):
+            relative = os.path.relpath(path, prefix_abs).replace(os.sep, '/')
+            return f"{locations[prefix].rstrip('/')}/{quote(relative)}"
+    return None
+
+
+def _offload_response(path, download_name, as_attachment, mimetype):
+    mode = current_app.config.get('FILE_SERVING_MODE', 'direct')
+    if mode == 'x-accel':
+        location = _accel_location(path)
+        if location is None:
+            return None
+        header = ('X-Accel-Redirect', location)
+    elif mode == 'x-sendfile':
+        header = ('X-Sendfile', os.path.abspath(path))
+    else:
+        return None
+
+    download_name = download_name or os.path.basename(path)
+    if mimetype is None:
+        mimetype = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+
+    response = current_app.response_class(mimetype=mimetype)
+    response.headers[header[0]] = header[1]
+    # 与 send_file 相同的 Content-Disposition 格式，非 ASCII 文件名使用 RFC 5987 编码
+    disposition = 'attachment' if as_attachment else 'inline'
+    try:
+        download_name.encode('ascii')
+        names = {'filename': download_name}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+        names = {'filename': simple, 'filename*': f"UTF-8''{quote(download_name, safe='!#$&+^`|')}"}
+    response.headers.set('Content-Disposition', disposition, **names)
+    return response
+
+
+def serve_file_from_directory(directory, filename, **kwargs):
+    """与 serve_file 相同，但 filename 不能跳出 directory（防止路径穿越）"""
+    path = safe_join(directory, filename)
+    if path is None:
+        raise FileNotFoundError(filename)
+    return serve_file(path, **kwargs)
@@ -0,0 +1,203 @@
+# utils/kb_bulk.py
+"""
+知识库批量操作中的文件处理：批量上传、复制子树时的物理文件复制、zip 导入
+
+文件写入和文本提取都是 I/O 或 CPU 密集且彼此独立的操作，交给线程池并发执行；
+数据库写入由调用方在主线程中批量完成并统一 commit。
+任一步骤失败时，调用方用 remove_files 删除已写入的文件。
+"""
+import os
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from flask import current_app
+from werkzeug.utils import secure_filename
+
+from routes.file_indexer import create_file_index, get_mime_type
+
+ZIP_UTF8_FLAG = 0x800
+
+
+def bulk_workers():
+    return current_app.config.get('KB_BULK_WORKERS', 4)
+
+
+def kb_upload_dir(kb_id):
+    """返回 (绝对目录, 相对于 UPLOAD_FOLDER 的目录)，目录不存在时创建"""
+    relative_dir = os.path.join('knowledge_base', f"kb_{kb_id}")
+    absolute_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], relative_dir)
+    os.makedirs(absolute_dir, exist_ok=True)
+    return absolute_dir, relative_dir
+
+
+def unique_storage_name(filename):
+    """存储文件名：时间戳 + 随机串，批量写入时同一秒内的同名文件也不会冲突"""
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    return f"{timestamp}_{uuid.uuid4().hex[:8]}_{secure_filename(filename) or 'file'}"
+
+
+def guess_file_type(filename, fallback=None):
+    return get_mime_type(filename) or fallback
+
+
+def _extract_text(item):
+    path, file_type = item
+    if not file_type:
+        return None
+    try:
+        return create_file_index(path, file_type)
+    except Exception as e:
+        print(f"提取文本出错 {path}: {str(e)}")
+        return None
+
+
+def extract_texts(items):
+    """并发提取文本，items 为 [(绝对路径, MIME 类型)]，返回与之对应的文本列表（无法提取时为 None）"""
+    with ThreadPoolExecutor(max_workers=bulk_workers()) as executor:
+        return list(executor.map(_extract_text, items))
+
+
+def save_uploads(uploads, kb_id):
+    """
+    并发保存请求中的多个上传文件
+    :param uploads: werkzeug FileStorage 列表
+    :return: [{'original_name', 'file_path'(相对), 'absolute_path', 'file_type'}]，顺序与 uploads 相同
+    """
+    absolute_dir, relative_dir = kb_upload_dir(kb_id)
+
+    def save(upload):
+        original_name = os.path.basename(upload.filename.replace('\\', '/'))
+        storage_name = unique_storage_name(original_name)
+        absolute_path = os.path.join(absolute_dir, storage_name)
+        upload.save(absolute_path)
+        return {
+            'original_name': original_name,
+            'file_path': os.path.join(relative_dir, storage_name),
+            'absolute_path': absolute_path,
+            'file_type': guess_file_type(original_name, upload.mimetype)
+        }
+
+    return _run_all(save, uploads)
+
+
+def duplicate_files(relative_paths, kb_id):
+    """
+    为复制出的文件记录复制物理文件：优先建立硬链接（不占额外空间，删除任一方不影响另一方），
+    跨文件系统等情况下退回到复制。
+    :return: 与 relative_paths 对应的新相对路径列表
+    """
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    absolute_dir, relative_dir = kb_upload_dir(kb_id)
+
+    def duplicate(relative_path):
+        source = os.path.join(upload_folder, relative_path)
+        storage_name = unique_storage_name(os.path.basename(relative_path))
+        target = os.path.join(absolute_dir, storage_name)
+        if os.path.exists(source):
+            try:
+                os.link(source, target)
+            except OSError:
+                shutil.copy2(source, target)
+        return os.path.join(relative_dir, storage_name)
+
+    return _run_all(duplicate, relative_paths)
+
+
+def decode_zip_name(info):
+    """
+    zip 条目名：未设置 UTF-8 标志时 zipfile 按 cp437 解码，
+    而 Windows 中文系统压缩的文件名实际是 GBK，这里还原为正确的中文
+    """
+    if info.flag_bits & ZIP_UTF8_FLAG:
+        return info.filename
+    raw = info.filename.encode('cp437')
+    for encoding in ('utf-8', 'gbk'):
+        try:
+            return raw.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return info.filename
+
+
+def read_zip_structure(archive, max_bytes=None):
+    """
+    解析 zip 目录结构（不解压）
+    :return: (目录列表, 文件列表)。目录为相对路径元组（父目录在前）；文件为 (ZipInfo, 目录元组, 文件名)
+    :raises ValueError: 解压后总大小超过 max_bytes
+    """
+    directories = set()
+    files = []
+    total_size = 0
+    for info in archive.infolist():
+        parts = [part for part in decode_zip_name(info).replace('\\', '/').split('/') if part not in ('', '.', '..')]
+        if not parts or parts[0] == '__MACOSX':
+            continue
+        if info.is_dir():
+            folder = tuple(parts)
+        else:
+            folder = tuple(parts[:-1])
+            if parts[-1].startswith('._') or parts[-1] in ('.DS_Store', 'Thumbs.db'):
+                continue
+            files.append((info, folder, parts[-1]))
+            total_size += info.file_size
+        for depth in range(1, len(folder) + 1):
+            directories.add(folder[:depth])
+
+    if max_bytes and total_size > max_bytes:
+        raise ValueError(f'压缩包解压后超过 {max_bytes // (1024 * 1024)} MB 限制')
+    return sorted(directories, key=lambda folder: (len(folder), folder)), files
+
+
+def extract_zip_files(archive, entries, kb_id):
+    """
+    并发解压 zip 中的文件到知识库目录（存储文件名由程序生成，不使用条目中的路径，避免路径穿越）
+    :param entries: [(ZipInfo, 文件名)]
+    :return: 与 save_uploads 相同结构的列表
+    """
+    absolute_dir, relative_dir = kb_upload_dir(kb_id)
+
+    def extract(entry):
+        info, original_name = entry
+        storage_name = unique_storage_name(original_name)
+        absolute_path = os.path.join(absolute_dir, storage_name)
+        with archive.open(info) as source, open(absolute_path, 'wb') as target:
+            shutil.copyfileobj(source, target, 1024 * 1024)
+        return {
+            'original_name': original_name,
+            'file_path': os.path.join(relative_dir, storage_name),
+            'absolute_path': absolute_path,
+            'file_type': guess_file_type(original_name)
+        }
+
+    return _run_all(extract, entries)
+
+
+def remove_files(absolute_paths):
+    for path in absolute_paths:
+        try:
+            if path and os.path.exists(path):
+                os.remove(path)
+        except OSError as e:
+            print(f"删除文件失败 {path}: {str(e)}")
+
+
+def _run_all(func, items):
+    """
+    在线程池中执行 func；任一项失败时删除已成功写入的文件并重新抛出异常
+    """
+    with ThreadPoolExecutor(max_workers=bulk_workers()) as executor:
+        futures = [executor.submit(func, item) for item in items]
+    results, error = [], None
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            error = error or e
+    if error is not None:
+        upload_folder = current_app.config['UPLOAD_FOLDER']
+        remove_files([item['absolute_path'] if isinstance(item, dict) else os.path.join(upload_folder, item)
+                      for item in results])
+        raise error
+    return results
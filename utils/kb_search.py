@@ -0,0 +1,225 @@
+# utils/kb_search.py
+"""
+知识库文件全文检索
+
+kb_file_contents 保存提取出的文本，kb_file_contents_fts 是以它为外部内容表的 FTS5 索引
+（content='kb_file_contents'，rowid 即文件ID），由 SQLite 触发器同步，因此 ORM 删除和
+子树的批量 DELETE 都不会留下过期索引。
+
+分词器优先使用 trigram（中文无需分词，支持任意子串匹配），SQLite 不支持时退回 unicode61。
+FTS5 不可用或检索词过短（trigram 至少 3 个字符）时，使用 LIKE 查询，并在 SQL 中截取匹配处附近的
+片段，不把整篇文本读回 Python。
+"""
+from sqlalchemy import text
+
+from models import db
+from utils.kb_tree import subtree_range
+from utils.search_snippets import HIGHLIGHT_START, HIGHLIGHT_END, highlight_text
+
+FTS_TABLE = 'kb_file_contents_fts'
+SNIPPET_TOKENS = 24  # FTS5 snippet() 返回的片段长度（词元数）
+LIKE_SNIPPET_CHARS = 160  # LIKE 查询时截取的片段长度（字符数）
+
+# 进程内缓存的索引状态：None 表示尚未检查
+_fts_tokenizer = None
+
+_TRIGGERS = (
+    # 文件记录删除时同时删除提取的文本（不依赖 PRAGMA foreign_keys）
+    """
+    CREATE TRIGGER IF NOT EXISTS kb_files_after_delete AFTER DELETE ON knowledge_base_files BEGIN
+        DELETE FROM kb_file_contents WHERE file_id = old.id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS kb_contents_after_insert AFTER INSERT ON kb_file_contents BEGIN
+        INSERT INTO {FTS_TABLE} (rowid, title, content) VALUES (new.file_id, new.title, new.content);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS kb_contents_after_delete AFTER DELETE ON kb_file_contents BEGIN
+        INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, title, content)
+        VALUES ('delete', old.file_id, old.title, old.content);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS kb_contents_after_update AFTER UPDATE ON kb_file_contents BEGIN
+        INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, title, content)
+        VALUES ('delete', old.file_id, old.title, old.content);
+        INSERT INTO {FTS_TABLE} (rowid, title, content) VALUES (new.file_id, new.title, new.content);
+    END
+    """,
+)
+
+
+def ensure_kb_search_index():
+    """
+    创建全文索引表和同步触发器（启动时调用），新建索引时从 kb_file_contents 重建一次。
+    :return: 使用的分词器，FTS5 不可用时返回 None
+    """
+    global _fts_tokenizer
+    exists = db.session.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': FTS_TABLE}
+    ).scalar()
+
+    if not exists:
+        for tokenizer in ('trigram', 'unicode61'):
+            try:
+                db.session.execute(text(
+                    f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+                    f"title, content, content='kb_file_contents', content_rowid='file_id', tokenize='{tokenizer}')"
+                ))
+                break
+            except Exception as e:
+                db.session.rollback()
+                print(f"知识库全文索引（{tokenizer}）创建失败: {str(e)}")
+        else:
+            db.session.execute(text(_TRIGGERS[0]))
+            db.session.commit()
+            _fts_tokenizer = ''
+            return None
+
+    for trigger in _TRIGGERS:
+        db.session.execute(text(trigger))
+    if not exists:
+        db.session.execute(text(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('rebuild')"))
+    db.session.commit()
+
+    _fts_tokenizer = None
+    return get_fts_tokenizer()
+
+
+def get_fts_tokenizer():
+    """返回全文索引使用的分词器（'trigram' / 'unicode61'），索引不存在时返回 None"""
+    global _fts_tokenizer
+    if _fts_tokenizer is None:
+        sql = db.session.execute(
+            text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': FTS_TABLE}
+        ).scalar()
+        if not sql:
+            _fts_tokenizer = ''
+        else:
+            _fts_tokenizer = 'trigram' if 'trigram' in sql else 'unicode61'
+    return _fts_tokenizer or None
+
+
+def split_terms(query):
+    return [term for term in query.split() if term]
+
+
+def build_match_expression(terms):
+    """每个词作为短语加引号，多个词之间为 AND；避免用户输入被解析为 FTS5 语法"""
+    return ' '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def _scope_filters(kb_id, root):
+    conditions = []
+    params = {}
+    if kb_id is not None:
+        conditions.append('n.kb_id = :kb_id')
+        params['kb_id'] = kb_id
+    if root is not None:
+        low, high = subtree_range(root.path)
+        conditions.append('n.kb_id = :root_kb_id AND n.path >= :low AND n.path < :high')
+        params.update(root_kb_id=root.kb_id, low=low, high=high)
+    return conditions, params
+
+
+def search_kb_files(query, kb_id=None, root=None, page=1, per_page=20):
+    """
+    检索知识库文件，可限定知识库或子树（root 为 KnowledgeBaseNode）
+    :return: (结果列表, 总数)；结果按相关度排序，title/snippet 中的匹配用 {{highlight}} 标记
+    """
+    terms = split_terms(query)
+    if not terms:
+        return [], 0
+
+    tokenizer = get_fts_tokenizer()
+    if tokenizer and not (tokenizer == 'trigram' and any(len(term) < 3 for term in terms)):
+        try:
+            return _search_fts(terms, kb_id, root, page, per_page)
+        except Exception as e:
+            db.session.rollback()
+            print(f"知识库全文检索失败，改用 LIKE 查询: {str(e)}")
+    return _search_like(terms, kb_id, root, page, per_page)
+
+
+def _search_fts(terms, kb_id, root, page, per_page):
+    conditions, params = _scope_filters(kb_id, root)
+    conditions.insert(0, f'{FTS_TABLE} MATCH :match')
+    params.update(match=build_match_expression(terms), limit=per_page, offset=(page - 1) * per_page,
+                  hl_start=HIGHLIGHT_START, hl_end=HIGHLIGHT_END)
+    where = ' AND '.join(conditions)
+    source = f"""
+        FROM {FTS_TABLE}
+        JOIN knowledge_base_files f ON f.id = {FTS_TABLE}.rowid
+        JOIN knowledge_base_nodes n ON n.id = f.node_id
+        WHERE {where}
+    """
+
+    total = db.session.execute(text(f"SELECT count(*) {source}"), params).scalar()
+    if not total:
+        return [], 0
+
+    # 文件名命中的权重高于正文
+    rows = db.session.execute(text(f"""
+        SELECT f.id, f.node_id, f.original_name, f.file_type, f.upload_date, n.kb_id, n.name AS node_name,
+               highlight({FTS_TABLE}, 0, :hl_start, :hl_end) AS title_highlight,
+               snippet({FTS_TABLE}, 1, :hl_start, :hl_end, '...', {SNIPPET_TOKENS}) AS snippet,
+               bm25({FTS_TABLE}, 5.0, 1.0) AS score
+        {source}
+        ORDER BY score
+        LIMIT :limit OFFSET :offset
+    """), params).mappings().all()
+
+    return [_result_dict(row, row['title_highlight'] or row['original_name'], row['snippet'], -row['score'])
+            for row in rows], total
+
+
+def _search_like(terms, kb_id, root, page, per_page):
+    conditions, params = _scope_filters(kb_id, root)
+    for index, term in enumerate(terms):
+        conditions.append(f"(f.original_name LIKE :term{index} ESCAPE '\\' OR c.content LIKE :term{index} ESCAPE '\\')")
+        escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        params[f'term{index}'] = f'%{escaped}%'
+    params.update(first=terms[0].lower(), half=LIKE_SNIPPET_CHARS // 2, length=LIKE_SNIPPET_CHARS,
+                  limit=per_page, offset=(page - 1) * per_page)
+    where = ' AND '.join(conditions)
+    source = f"""
+        FROM knowledge_base_files f
+        JOIN knowledge_base_nodes n ON n.id = f.node_id
+        LEFT JOIN kb_file_contents c ON c.file_id = f.id
+        WHERE {where}
+    """
+
+    total = db.session.execute(text(f"SELECT count(*) {source}"), params).scalar()
+    if not total:
+        return [], 0
+
+    # 只截取第一个词首次出现处附近的片段（SQLite 的 lower() 只转换 ASCII，中文不受影响）
+    rows = db.session.execute(text(f"""
+        SELECT f.id, f.node_id, f.original_name, f.file_type, f.upload_date, n.kb_id, n.name AS node_name,
+               substr(c.content, max(instr(lower(c.content), :first) - :half, 1), :length) AS snippet
+        {source}
+        ORDER BY f.upload_date DESC, f.id DESC
+        LIMIT :limit OFFSET :offset
+    """), params).mappings().all()
+
+    query = ' '.join(terms)
+    return [_result_dict(row, highlight_text(row['original_name'], query), highlight_text(row['snippet'], query), None)
+            for row in rows], total
+
+
+def _result_dict(row, title, snippet, score):
+    upload_date = row['upload_date']
+    return {
+        'id': row['id'],
+        'node_id': row['node_id'],
+        'kb_id': row['kb_id'],
+        'node_name': row['node_name'],
+        'original_name': row['original_name'],
+        'title_highlight': title,
+        'snippet': snippet,
+        'file_type': row['file_type'],
+        'upload_date': upload_date.isoformat() if hasattr(upload_date, 'isoformat') else upload_date,
+        'score': score
+    }
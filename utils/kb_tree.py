@@ -0,0 +1,423 @@
+# utils/kb_tree.py
+"""
+知识库节点树（物化路径）
+
+每个节点保存从根到自身的 ID 路径，例如根节点 1 下的节点 5 下的节点 9：path = '/1/5/9/'，depth = 2。
+- 一个知识库（或一棵子树）的所有节点和文件各用一条查询取出，在内存中组装成树
+- 子树查询、移动、删除都是 path 上的一次索引范围操作
+
+path 由 '/' 和数字组成，前缀 P 的子树范围为 [P, P[:-1] + '0')：'/' 之后紧跟的字符都不小于 '0'，
+而兄弟节点（如 '/1/50/' 相对于 '/1/5/'）恰好落在范围之外。
+"""
+import hashlib
+from datetime import datetime
+
+from sqlalchemy import text, inspect, func, delete, update, insert, literal, bindparam
+
+from models import db, KnowledgeBaseNode, KnowledgeBaseFile
+
+
+def make_node_path(parent, node_id):
+    """返回 (path, depth)"""
+    if parent is None:
+        return f"/{node_id}/", 0
+    return f"{parent.path}{node_id}/", parent.depth + 1
+
+
+def assign_node_path(node, parent=None):
+    """为新建节点设置 path/depth（需要先 flush 以获得 node.id）"""
+    if parent is None and node.parent_id is not None:
+        parent = db.session.get(KnowledgeBaseNode, node.parent_id)
+    node.path, node.depth = make_node_path(parent, node.id)
+
+
+def subtree_range(path):
+    """子树（含自身）的 path 范围 [low, high)"""
+    return path, path[:-1] + '0'
+
+
+def subtree_filter(path, column=None):
+    column = column if column is not None else KnowledgeBaseNode.path
+    low, high = subtree_range(path)
+    return (column >= low) & (column < high)
+
+
+def serialize_node(node):
+    return {
+        'id': node.id,
+        'kb_id': node.kb_id,  # 返回所属知识库ID
+        'name': node.name,
+        'description': node.description,
+        'parent_id': node.parent_id,
+        'created_at': node.created_at.isoformat(),
+        'updated_at': node.updated_at.isoformat(),
+        'files': [],
+        'children': []
+    }
+
+
+def load_tree(kb_id, root=None):
+    """
+    两条查询加载整个知识库（或以 root 为根的子树）的节点和文件，并在内存中组装
+    返回根节点字典列表，结构与 KnowledgeBaseNode.to_dict() 相同
+    """
+    node_query = KnowledgeBaseNode.query.filter(KnowledgeBaseNode.kb_id == kb_id)
+    if root is not None:
+        node_query = node_query.filter(subtree_filter(root.path))
+    nodes = node_query.order_by(KnowledgeBaseNode.depth, KnowledgeBaseNode.id).all()
+
+    node_dicts = {node.id: serialize_node(node) for node in nodes}
+    if not node_dicts:
+        return []
+
+    file_query = (KnowledgeBaseFile.query
+                  .join(KnowledgeBaseNode, KnowledgeBaseFile.node_id == KnowledgeBaseNode.id)
+                  .filter(KnowledgeBaseNode.kb_id == kb_id))
+    if root is not None:
+        file_query = file_query.filter(subtree_filter(root.path))
+    for file in file_query.order_by(KnowledgeBaseFile.id).all():
+        node_dicts[file.node_id]['files'].append(file.to_dict())
+
+    roots = []
+    root_id = root.id if root is not None else None
+    # 按 depth 排序保证父节点先于子节点出现
+    for node in nodes:
+        node_dict = node_dicts[node.id]
+        parent_dict = node_dicts.get(node.parent_id)
+        if node.id == root_id or parent_dict is None:
+            roots.append(node_dict)
+        else:
+            parent_dict['children'].append(node_dict)
+    return roots
+
+
+def load_tree_levels(kb_id, root=None, max_depth=1, include_files=False):
+    """
+    按层级懒加载节点树。
+    - root 为 None 时返回知识库最上面 max_depth 层（max_depth=1 只返回根节点）
+    - root 不为 None 时返回 root 及其下 max_depth 层（max_depth=1 为 root 和直接子节点）
+    每个节点附带 child_count 和 file_count，children_loaded 表示 children 是否已完整返回；
+    include_files 为 False 时不返回文件列表，由前端按节点分页获取。
+    共三条查询：节点、子节点计数、文件计数（或文件列表）。
+    """
+    last_depth = root.depth + max_depth if root is not None else max_depth - 1
+
+    scope = [KnowledgeBaseNode.kb_id == kb_id]
+    if root is not None:
+        scope.append(subtree_filter(root.path))
+    in_levels = scope + [KnowledgeBaseNode.depth <= last_depth]
+
+    nodes = KnowledgeBaseNode.query.filter(*in_levels) \
+        .order_by(KnowledgeBaseNode.depth, KnowledgeBaseNode.id).all()
+    if not nodes:
+        return []
+
+    # 子节点数：统计范围内深度不超过 last_depth + 1 的节点的 parent_id
+    child_counts = dict(db.session.execute(
+        db.select(KnowledgeBaseNode.parent_id, func.count())
+        .where(*scope, KnowledgeBaseNode.depth <= last_depth + 1, KnowledgeBaseNode.parent_id.isnot(None))
+        .group_by(KnowledgeBaseNode.parent_id)
+    ).all())
+
+    node_dicts = {}
+    for node in nodes:
+        node_dict = serialize_node(node)
+        node_dict['child_count'] = child_counts.get(node.id, 0)
+        node_dict['file_count'] = 0
+        node_dict['children_loaded'] = node.depth < last_depth or node_dict['child_count'] == 0
+        node_dicts[node.id] = node_dict
+
+    if include_files:
+        files = (KnowledgeBaseFile.query
+                 .join(KnowledgeBaseNode, KnowledgeBaseFile.node_id == KnowledgeBaseNode.id)
+                 .filter(*in_levels)
+                 .order_by(KnowledgeBaseFile.id).all())
+        for file in files:
+            node_dicts[file.node_id]['files'].append(file.to_dict())
+            node_dicts[file.node_id]['file_count'] += 1
+    else:
+        file_counts = db.session.execute(
+            db.select(KnowledgeBaseFile.node_id, func.count())
+            .join(KnowledgeBaseNode, KnowledgeBaseFile.node_id == KnowledgeBaseNode.id)
+            .where(*in_levels)
+            .group_by(KnowledgeBaseFile.node_id)
+        ).all()
+        for node_id, count in file_counts:
+            node_dicts[node_id]['file_count'] = count
+
+    roots = []
+    root_id = root.id if root is not None else None
+    for node in nodes:
+        node_dict = node_dicts[node.id]
+        parent_dict = node_dicts.get(node.parent_id)
+        if node.id == root_id or parent_dict is None:
+            roots.append(node_dict)
+        else:
+            parent_dict['children'].append(node_dict)
+    return roots
+
+
+def subtree_etag(kb_id, root=None, variant=''):
+    """
+    由聚合查询生成子树的版本标识：节点数、最近修改时间、节点ID之和，文件数、最大文件ID、文件所属节点之和。
+    新增/删除/重命名/移动节点以及上传/删除/移动文件都会改变结果。
+    """
+    scope = [KnowledgeBaseNode.kb_id == kb_id]
+    if root is not None:
+        scope.append(subtree_filter(root.path))
+
+    node_stats = db.session.execute(
+        db.select(func.count(), func.max(KnowledgeBaseNode.updated_at), func.total(KnowledgeBaseNode.id))
+        .where(*scope)
+    ).one()
+    file_stats = db.session.execute(
+        db.select(func.count(), func.max(KnowledgeBaseFile.id), func.total(KnowledgeBaseFile.node_id))
+        .join(KnowledgeBaseNode, KnowledgeBaseFile.node_id == KnowledgeBaseNode.id)
+        .where(*scope)
+    ).one()
+    raw = f"{kb_id}|{root.id if root is not None else ''}|{tuple(node_stats)}|{tuple(file_stats)}|{variant}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def is_descendant(node, ancestor):
+    return node.path.startswith(ancestor.path)
+
+
+def move_subtree(node, new_parent, kb_id=None):
+    """
+    将 node 及其子树移动到 new_parent 下（None 表示移动为根节点），一条 UPDATE 改写整棵子树的 path。
+    kb_id 不为 None 时同时把子树移动到另一个知识库。调用方负责 commit。
+    """
+    if new_parent is not None and is_descendant(new_parent, node):
+        raise ValueError('不能将节点移动到自身或其子节点下')
+    # 先写入会话中未提交的修改，下面的 expire_all 不会丢失它们
+    db.session.flush()
+
+    old_path, old_depth = node.path, node.depth
+    new_path, new_depth = make_node_path(new_parent, node.id)
+    target_kb_id = kb_id if kb_id is not None else (new_parent.kb_id if new_parent is not None else node.kb_id)
+
+    low, high = subtree_range(old_path)
+    table = KnowledgeBaseNode.__table__
+    db.session.execute(
+        update(table)
+        .where(table.c.kb_id == node.kb_id, table.c.path >= low, table.c.path < high)
+        .values(path=literal(new_path) + func.substr(table.c.path, len(old_path) + 1),
+                depth=table.c.depth + (new_depth - old_depth),
+                kb_id=target_kb_id,
+                updated_at=datetime.now())
+        .execution_options(synchronize_session=False)
+    )
+    db.session.execute(
+        update(table).where(table.c.id == node.id)
+        .values(parent_id=new_parent.id if new_parent is not None else None)
+        .execution_options(synchronize_session=False)
+    )
+    # 已加载到会话中的对象与数据库不一致，使其过期以便下次访问时重新读取
+    db.session.expire_all()
+
+
+def insert_nodes_bulk(kb_id, parent, specs):
+    """
+    批量创建节点：每一层一条多行 INSERT ... RETURNING 加一条批量 UPDATE 写入 path，调用方负责 commit。
+    :param parent: 新节点挂载的父节点（None 表示作为根节点）
+    :param specs: 字典列表，含 key、parent_key（None 表示直接挂在 parent 下）、name，可选 description；
+                  父节点必须排在子节点之前
+    :return: {key: 新节点ID}
+    """
+    db.session.flush()
+    table = KnowledgeBaseNode.__table__
+    now = datetime.now()
+    base_path, base_depth = (parent.path, parent.depth + 1) if parent is not None else ('/', 0)
+
+    ids = {}
+    paths = {None: (base_path, base_depth)}
+    pending = list(specs)
+    while pending:
+        level = [spec for spec in pending if spec.get('parent_key') in paths]
+        if not level:
+            raise ValueError('节点的父节点不存在或存在循环引用')
+        pending = [spec for spec in pending if spec.get('parent_key') not in paths]
+
+        rows = [{
+            'name': spec['name'],
+            'description': spec.get('description', ''),
+            'kb_id': kb_id,
+            'parent_id': ids.get(spec.get('parent_key'), parent.id if parent is not None else None),
+            'depth': paths[spec.get('parent_key')][1],
+            'created_at': now,
+            'updated_at': now
+        } for spec in level]
+        new_ids = db.session.execute(
+            insert(table).returning(table.c.id, sort_by_parameter_order=True), rows
+        ).scalars().all()
+
+        path_rows = []
+        for spec, node_id in zip(level, new_ids):
+            parent_path, depth = paths[spec.get('parent_key')]
+            ids[spec['key']] = node_id
+            paths[spec['key']] = (f"{parent_path}{node_id}/", depth + 1)
+            path_rows.append({'_id': node_id, '_path': paths[spec['key']][0]})
+        db.session.execute(
+            update(table).where(table.c.id == bindparam('_id')).values(path=bindparam('_path'))
+            .execution_options(synchronize_session=False),
+            path_rows
+        )
+    return ids
+
+
+def copy_subtree(node, new_parent, kb_id=None, name=None):
+    """
+    复制 node 及其子树到 new_parent 下（None 表示复制为根节点），逐层批量插入节点，文件记录一次批量插入，
+    已提取的全文内容用 INSERT ... SELECT 复制。调用方负责复制物理文件并 commit。
+    :param name: 复制后根节点的名称，默认与原节点相同
+    :return: (新根节点ID, [(原文件记录, 新文件ID)])
+    """
+    if new_parent is not None and is_descendant(new_parent, node):
+        raise ValueError('不能将节点复制到自身或其子节点下')
+    target_kb_id = kb_id if kb_id is not None else (new_parent.kb_id if new_parent is not None else node.kb_id)
+
+    nodes = KnowledgeBaseNode.query.filter(KnowledgeBaseNode.kb_id == node.kb_id, subtree_filter(node.path)) \
+        .order_by(KnowledgeBaseNode.depth, KnowledgeBaseNode.id).all()
+    specs = [{
+        'key': item.id,
+        'parent_key': None if item.id == node.id else item.parent_id,
+        'name': name if (item.id == node.id and name) else item.name,
+        'description': item.description
+    } for item in nodes]
+    id_map = insert_nodes_bulk(target_kb_id, new_parent, specs)
+
+    files = (KnowledgeBaseFile.query
+             .join(KnowledgeBaseNode, KnowledgeBaseFile.node_id == KnowledgeBaseNode.id)
+             .filter(KnowledgeBaseNode.kb_id == node.kb_id, subtree_filter(node.path))
+             .order_by(KnowledgeBaseFile.id).all())
+    copied = []
+    if files:
+        file_table = KnowledgeBaseFile.__table__
+        new_file_ids = db.session.execute(
+            insert(file_table).returning(file_table.c.id, sort_by_parameter_order=True),
+            [{
+                'node_id': id_map[file.node_id],
+                'original_name': file.original_name,
+                'file_path': file.file_path,  # 由调用方复制物理文件后改写
+                'file_type': file.file_type,
+                'upload_user_id': file.upload_user_id,
+                'upload_date': file.upload_date
+            } for file in files]
+        ).scalars().all()
+        copied = list(zip(files, new_file_ids))
+        db.session.execute(
+            text("INSERT INTO kb_file_contents (file_id, title, content, extracted_at) "
+                 "SELECT :new_id, title, content, extracted_at FROM kb_file_contents WHERE file_id = :old_id"),
+            [{'new_id': new_id, 'old_id': file.id} for file, new_id in copied]
+        )
+    return id_map[node.id], copied
+
+
+def update_file_paths(new_paths):
+    """批量改写文件记录的 file_path：new_paths 为 {文件ID: 相对路径}"""
+    if not new_paths:
+        return
+    table = KnowledgeBaseFile.__table__
+    db.session.execute(
+        update(table).where(table.c.id == bindparam('_id')).values(file_path=bindparam('_path'))
+        .execution_options(synchronize_session=False),
+        [{'_id': file_id, '_path': path} for file_id, path in new_paths.items()]
+    )
+
+
+def move_node_files(source, target):
+    """将 source 节点下的所有文件移动到 target 节点（一条 UPDATE），调用方负责 commit"""
+    table = KnowledgeBaseFile.__table__
+    db.session.execute(
+        update(table).where(table.c.node_id == source.id).values(node_id=target.id)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.expire(source, ['files'])
+
+
+def delete_subtree(node):
+    """用两条范围 DELETE 删除节点、所有子节点及其文件记录，返回被删除文件的相对路径列表。调用方负责 commit。"""
+    db.session.flush()
+    low, high = subtree_range(node.path)
+    node_table = KnowledgeBaseNode.__table__
+    file_table = KnowledgeBaseFile.__table__
+    in_subtree = (node_table.c.kb_id == node.kb_id) & (node_table.c.path >= low) & (node_table.c.path < high)
+    subtree_ids = db.select(node_table.c.id).where(in_subtree)
+
+    file_paths = db.session.execute(
+        db.select(file_table.c.file_path).where(file_table.c.node_id.in_(subtree_ids))
+    ).scalars().all()
+    db.session.execute(delete(file_table).where(file_table.c.node_id.in_(subtree_ids)))
+    db.session.execute(delete(node_table).where(in_subtree))
+    db.session.expire_all()
+    return file_paths
+
+
+def delete_kb_nodes(kb_id):
+    """删除知识库下的全部节点和文件记录，返回被删除文件的相对路径列表。调用方负责 commit。"""
+    db.session.flush()
+    node_table = KnowledgeBaseNode.__table__
+    file_table = KnowledgeBaseFile.__table__
+    kb_node_ids = db.select(node_table.c.id).where(node_table.c.kb_id == kb_id)
+
+    file_paths = db.session.execute(
+        db.select(file_table.c.file_path).where(file_table.c.node_id.in_(kb_node_ids))
+    ).scalars().all()
+    db.session.execute(delete(file_table).where(file_table.c.node_id.in_(kb_node_ids)))
+    db.session.execute(delete(node_table).where(node_table.c.kb_id == kb_id))
+    db.session.expire_all()
+    return file_paths
+
+
+def ensure_kb_tree_columns():
+    """
+    为已有数据库补充 path/depth 列和索引，并回填缺失的路径（启动时调用）。
+    db.create_all() 不会修改已存在的表。
+    """
+    columns = {column['name'] for column in inspect(db.engine).get_columns('knowledge_base_nodes')}
+    if 'path' not in columns:
+        db.session.execute(text("ALTER TABLE knowledge_base_nodes ADD COLUMN path VARCHAR(1024)"))
+    if 'depth' not in columns:
+        db.session.execute(text("ALTER TABLE knowledge_base_nodes ADD COLUMN depth INTEGER NOT NULL DEFAULT 0"))
+    db.session.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_kb_nodes_kb_path ON knowledge_base_nodes (kb_id, path)"))
+    db.session.commit()
+    return backfill_node_paths()
+
+
+def backfill_node_paths():
+    """根据 parent_id 重新计算所有缺失 path 的节点（一次读取，一次批量更新）"""
+    table = KnowledgeBaseNode.__table__
+    if not db.session.execute(db.select(func.count()).where(table.c.path.is_(None))).scalar():
+        return 0
+
+    rows = db.session.execute(db.select(table.c.id, table.c.parent_id)).all()
+    parents = {row.id: row.parent_id for row in rows}
+    computed = {}
+
+    def compute(node_id):
+        # 迭代向上查找，避免深层树递归过深
+        chain = []
+        current = node_id
+        while current is not None and current in parents and current not in computed:
+            chain.append(current)
+            current = parents.get(current)
+            if len(chain) > len(parents):
+                raise ValueError(f'知识库节点 {node_id} 的父节点存在环')
+        prefix, depth = computed.get(current, ('/', -1))
+        for item in reversed(chain):
+            prefix, depth = f"{prefix}{item}/", depth + 1
+            computed[item] = (prefix, depth)
+        return computed[node_id]
+
+    params = []
+    for node_id in parents:
+        path, depth = compute(node_id)
+        params.append({'node_id': node_id, 'path': path, 'depth': depth})
+
+    db.session.execute(text("UPDATE knowledge_base_nodes SET path = :path, depth = :depth WHERE id = :node_id"),
+                       params)
+    db.session.commit()
+    print(f"已回填 {len(params)} 个知识库节点的路径")
+    return len(params)
@@ -0,0 +1,321 @@
+# utils/merge_session_store.py
+"""
+文件合并会话存储
+
+合并预览、最终合并与 SSE 进度请求可能落在不同的 worker 进程上，
+因此会话状态不能保存在进程内的字典里：
+- SQLiteMergeSessionStore：保存在数据库 merge_sessions 表中，多 worker 共享（默认）
+- MemoryMergeSessionStore：进程内字典，仅适用于单进程开发环境
+
+所有会话都带有 TTL，过期会话及其临时目录由定时清理任务回收，
+即使客户端在 call_on_close 之前断开连接也不会泄漏。
+
+每次更新都会递增会话的 version 并通过 session_events 通知本进程内的
+SSE 订阅方；其他 worker 上的订阅方在等待超时后重新读取存储。
+"""
+import os
+import shutil
+from abc import ABC, abstractmethod
+import tempfile
+import threading
+import time
+import uuid
+
+from flask import current_app
+from sqlalchemy import select, update, delete
+
+from config import db, register_maintenance_job
+from models import MergeSession
+from utils.event_channel import EventChannel
+
+DEFAULT_TTL = 60 * 60  # 默认会话存活时间（秒）
+
+# 临时目录前缀，清理任务据此识别孤立目录
+PDF_TEMP_DIR_PREFIXES = ('merge_pdf_', 'final_pdf_')
+TEMP_PREVIEW_IMAGE_SUBDIR = 'temp_preview_images'
+
+# 会话变化通知通道，key 为会话ID
+session_events = EventChannel()
+
+
+def _progress_fields(progress, status_message=None, completed=False, error=None):
+    """把一次进度更新转换为需要写入的字段"""
+    fields = {'progress': progress, 'completed': completed}
+    if status_message:
+        fields['status_message'] = status_message
+    if error:
+        fields['error'] = error
+    if completed or error:
+        fields['status'] = 'error' if error else 'completed'
+    return fields
+
+
+def _new_session_data(now, ttl, fields):
+    data = {
+        'progress': 0,
+        'status_message': 'Initializing...',
+        'status': 'running',  # '正在运行'， '已完成'， '错误'
+        'completed': False,
+        'error': None,
+        'version': 1,
+        'pdf_temp_dir': None,  # 对于 PDF 生成临时文件
+        'image_temp_dir': None,  # 用于预览图像临时文件
+        'start_time': now,
+        'updated_at': now,
+        'expires_at': now + ttl
+    }
+    data.update(fields)
+    return data
+
+
+class MergeSessionStore(ABC):
+    """合并会话存储接口"""
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+
+    @abstractmethod
+    def create(self, session_id=None, **fields):
+        """创建（或覆盖）会话，返回会话ID"""
+
+    @abstractmethod
+    def get(self, session_id):
+        """返回会话数据字典，不存在时返回 None"""
+
+    @abstractmethod
+    def update(self, session_id, **fields):
+        """原子地更新会话字段并续期，会话不存在时返回 False"""
+
+    @abstractmethod
+    def pop(self, session_id):
+        """删除并返回会话数据；并发调用时只有一个调用方能拿到数据"""
+
+    @abstractmethod
+    def pop_expired(self, now=None):
+        """删除并返回所有已过期的会话 [(session_id, data), ...]"""
+
+    @abstractmethod
+    def session_ids(self):
+        """返回当前所有会话ID"""
+
+    def update_progress(self, session_id, progress, status_message=None, completed=False, error=None):
+        return self.update(session_id, **_progress_fields(progress, status_message, completed, error))
+
+
+class MemoryMergeSessionStore(MergeSessionStore):
+    """进程内存储，仅适用于单进程部署"""
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        super().__init__(ttl)
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def create(self, session_id=None, **fields):
+        session_id = session_id or str(uuid.uuid4())
+        with self._lock:
+            self._sessions[session_id] = _new_session_data(time.time(), self.ttl, fields)
+        session_events.publish(session_id)
+        return session_id
+
+    def get(self, session_id):
+        with self._lock:
+            data = self._sessions.get(session_id)
+            return dict(data) if data else None
+
+    def update(self, session_id, **fields):
+        now = time.time()
+        with self._lock:
+            data = self._sessions.get(session_id)
+            if data is None:
+                return False
+            data.update(fields)
+            data['version'] += 1
+            data['updated_at'] = now
+            data['expires_at'] = now + self.ttl
+        session_events.publish(session_id)
+        return True
+
+    def pop(self, session_id):
+        with self._lock:
+            data = self._sessions.pop(session_id, None)
+        if data is not None:
+            session_events.publish(session_id)
+        return data
+
+    def pop_expired(self, now=None):
+        now = now or time.time()
+        with self._lock:
+            expired = [sid for sid, data in self._sessions.items() if data['expires_at'] < now]
+            popped = [(sid, self._sessions.pop(sid)) for sid in expired]
+        for sid, _ in popped:
+            session_events.publish(sid)
+        return popped
+
+    def session_ids(self):
+        with self._lock:
+            return set(self._sessions)
+
+
+class SQLiteMergeSessionStore(MergeSessionStore):
+    """
+    基于 merge_sessions 表的存储，所有 worker 共享。
+    只使用 Core 语句而不经过 ORM 身份映射，保证每次读取都是最新状态，
+    每次更新都是一条 UPDATE 语句。
+    """
+
+    table = MergeSession.__table__
+
+    def _commit(self):
+        try:
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+    def create(self, session_id=None, **fields):
+        session_id = session_id or str(uuid.uuid4())
+        data = _new_session_data(time.time(), self.ttl, fields)
+        db.session.execute(delete(self.table).where(self.table.c.session_id == session_id))
+        db.session.execute(self.table.insert().values(session_id=session_id, **data))
+        self._commit()
+        session_events.publish(session_id)
+        return session_id
+
+    def get(self, session_id):
+        row = db.session.execute(
+            select(self.table).where(self.table.c.session_id == session_id)
+        ).mappings().first()
+        if row is None:
+            return None
+        data = dict(row)
+        data.pop('session_id', None)
+        return data
+
+    def update(self, session_id, **fields):
+        now = time.time()
+        result = db.session.execute(
+            update(self.table)
+            .where(self.table.c.session_id == session_id)
+            .values(version=self.table.c.version + 1, updated_at=now, expires_at=now + self.ttl, **fields)
+        )
+        self._commit()
+        if result.rowcount > 0:
+            session_events.publish(session_id)
+            return True
+        return False
+
+    def pop(self, session_id):
+        data = self.get(session_id)
+        if data is None:
+            return None
+        result = db.session.execute(delete(self.table).where(self.table.c.session_id == session_id))
+        self._commit()
+        # 其他 worker 已经先一步删除了该会话
+        if result.rowcount == 0:
+            return None
+        session_events.publish(session_id)
+        return data
+
+    def pop_expired(self, now=None):
+        now = now or time.time()
+        expired_ids = db.session.execute(
+            select(self.table.c.session_id).where(self.table.c.expires_at < now)
+        ).scalars().all()
+        popped = []
+        for session_id in expired_ids:
+            data = self.pop(session_id)
+            if data is not None:
+                popped.append((session_id, data))
+        return popped
+
+    def session_ids(self):
+        return set(db.session.execute(select(self.table.c.session_id)).scalars().all())
+
+
+_memory_store = None
+
+
+def get_merge_session_store():
+    """根据 MERGE_SESSION_BACKEND 配置返回会话存储"""
+    global _memory_store
+    backend = current_app.config.get('MERGE_SESSION_BACKEND', 'sqlite')
+    ttl = current_app.config.get('MERGE_SESSION_TTL', DEFAULT_TTL)
+    if backend == 'memory':
+        if _memory_store is None:
+            _memory_store = MemoryMergeSessionStore(ttl)
+        return _memory_store
+    return SQLiteMergeSessionStore(ttl)
+
+
+def remove_session_temp_dirs(session_id, session_data, logger=None):
+    """删除会话关联的 PDF 临时目录和预览图片目录"""
+    logger = logger or current_app.logger
+    for key, label in (('pdf_temp_dir', '临时 PDF 目录'), ('image_temp_dir', '临时镜像目录')):
+        dir_to_clean = session_data.get(key)
+        if dir_to_clean and os.path.exists(dir_to_clean):
+            try:
+                shutil.rmtree(dir_to_clean)
+                logger.info(f"{label} {dir_to_clean} 已清理会话{session_id}.")
+            except Exception as e:
+                logger.error(f"无法清理{label} {dir_to_clean}: {e}")
+
+
+def _is_stale(path, cutoff):
+    try:
+        return os.path.getmtime(path) < cutoff
+    except OSError:
+        return False
+
+
+def _remove_orphan_dirs(parent_dir, live_ids, cutoff, name_filter=None):
+    removed = 0
+    if not parent_dir or not os.path.isdir(parent_dir):
+        return removed
+    for entry in os.scandir(parent_dir):
+        if not entry.is_dir(follow_symlinks=False):
+            continue
+        if name_filter and not name_filter(entry.name):
+            continue
+        if entry.name in live_ids or not _is_stale(entry.path, cutoff):
+            continue
+        shutil.rmtree(entry.path, ignore_errors=True)
+        removed += 1
+    return removed
+
+
+def get_merge_scratch_dir():
+    """合并过程中临时 PDF 文件所在的根目录（MERGE_SCRATCH_DIR，未配置时为系统临时目录）"""
+    scratch_dir = current_app.config.get('MERGE_SCRATCH_DIR')
+    if not scratch_dir:
+        return tempfile.gettempdir()
+    os.makedirs(scratch_dir, exist_ok=True)
+    return scratch_dir
+
+
+def clean_expired_merge_sessions():
+    """
+    定时清理任务：
+    1. 删除过期会话并清理它们的临时目录
+    2. 删除没有对应会话、且超过 TTL 未修改的孤立临时目录（进程崩溃或客户端断开遗留）
+    """
+    logger = current_app.logger
+    store = get_merge_session_store()
+
+    expired = store.pop_expired()
+    for session_id, data in expired:
+        remove_session_temp_dirs(session_id, data, logger)
+
+    cutoff = time.time() - store.ttl
+    live_ids = store.session_ids()
+    image_root = os.path.join(current_app.static_folder, TEMP_PREVIEW_IMAGE_SUBDIR)
+    orphan_images = _remove_orphan_dirs(image_root, live_ids, cutoff)
+    orphan_pdfs = _remove_orphan_dirs(get_merge_scratch_dir(), set(), cutoff,
+                                      name_filter=lambda name: name.startswith(PDF_TEMP_DIR_PREFIXES))
+
+    if expired or orphan_images or orphan_pdfs:
+        logger.info(f"合并会话清理：过期会话 {len(expired)} 个，孤立预览目录 {orphan_images} 个，"
+                    f"孤立 PDF 临时目录 {orphan_pdfs} 个")
+    return len(expired), orphan_images, orphan_pdfs
+
+
+register_maintenance_job('merge_session_janitor', clean_expired_merge_sessions, minutes=10)
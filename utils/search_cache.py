@@ -0,0 +1,258 @@
+# utils/search_cache.py
+"""
+搜索结果缓存和名称自动补全
+
+1. 结果缓存（SearchResultCache）
+   进程内 LRU，键为 (接口, 规范化后的检索词, 过滤条件, 可见范围)，另带 TTL。
+   项目、子项目、阶段、任务、文件、文件内容或用户发生变化并提交后，全局代次（generation）加一，
+   旧代次的缓存全部失效；其他 worker 进程中的变化无法通知到本进程，由 TTL 限制过期时间。
+
+2. 名称自动补全（NameIndex）
+   项目、子项目、阶段、任务和文件名的有序索引（bisect），按前缀查询。除完整名称外，
+   名称中以空白、下划线、横线等分隔的每一段也可作为前缀匹配。
+   ORM 提交后按变化的记录增量更新；超过 SEARCH_SUGGEST_REFRESH 秒重新整体加载一次，
+   以包含其他进程或批量 SQL 的修改。
+
+两者都依赖 ORM 的 mapper 事件；绕过 ORM 的批量 UPDATE/DELETE 需要调用 invalidate_search_caches()。
+"""
+import bisect
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from models import db, Project, Subproject, ProjectStage, StageTask, ProjectFile, FileContent, User
+
+_generation = 0
+_generation_lock = threading.Lock()
+
+
+def search_generation():
+    return _generation
+
+
+def invalidate_search_caches():
+    """使所有搜索结果缓存失效，并在下次查询时重新加载名称索引"""
+    global _generation
+    with _generation_lock:
+        _generation += 1
+    name_index.mark_stale()
+
+
+def normalize_query(query):
+    """去掉首尾空白、合并连续空白并转为小写（检索本身不区分大小写）"""
+    return ' '.join((query or '').split()).lower()
+
+
+class SearchResultCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get_or_compute(self, key, compute):
+        """
+        返回缓存的结果，未命中或已过期时调用 compute() 计算并缓存
+        compute 的结果会被多个请求共享，调用方不应修改它
+        """
+        ttl = current_app.config.get('SEARCH_CACHE_TTL', 60)
+        max_entries = current_app.config.get('SEARCH_CACHE_MAX_ENTRIES', 512)
+        generation = _generation
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, entry_generation, created_at = entry
+                if entry_generation == generation and now - created_at < ttl:
+                    self._entries.move_to_end(key)
+                    return value
+                del self._entries[key]
+
+        value = compute()
+
+        with self._lock:
+            # 计算期间数据已变化时不写入，避免缓存旧结果
+            if generation == _generation:
+                self._entries[key] = (value, generation, now)
+                self._entries.move_to_end(key)
+                while len(self._entries) > max_entries:
+                    self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+search_result_cache = SearchResultCache()
+
+# ---------------------------------------------------------------
+# 名称自动补全
+# ---------------------------------------------------------------
+
+_TOKEN_SPLIT = re.compile(r'[\s_\-—./\\()（）\[\]【】,，、]+')
+
+# 类型 -> (模型, 名称属性)
+SUGGEST_SOURCES = {
+    'project': (Project, 'name'),
+    'subproject': (Subproject, 'name'),
+    'stage': (ProjectStage, 'name'),
+    'task': (StageTask, 'name'),
+    'file': (ProjectFile, 'original_name'),
+}
+_MODEL_KINDS = {model: kind for kind, (model, _) in SUGGEST_SOURCES.items()}
+
+
+def _index_keys(name):
+    """名称本身及其中每个分隔段（小写）作为可前缀匹配的键"""
+    lowered = name.lower()
+    keys = {lowered}
+    for token in _TOKEN_SPLIT.split(lowered):
+        if token:
+            keys.add(token)
+    return keys
+
+
+class NameIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = []  # 有序的 (键, 类型, ID)
+        self._entries = {}  # (类型, ID) -> {'name', 'is_public', 'upload_user_id'}
+        self._loaded_at = None
+
+    def mark_stale(self):
+        self._loaded_at = None
+
+    def _ensure_loaded(self):
+        refresh = current_app.config.get('SEARCH_SUGGEST_REFRESH', 300)
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < refresh:
+            return
+
+        entries = {}
+        for kind, (model, attribute) in SUGGEST_SOURCES.items():
+            columns = [model.id, getattr(model, attribute)]
+            if kind == 'file':
+                columns += [ProjectFile.is_public, ProjectFile.upload_user_id]
+            for row in db.session.query(*columns).all():
+                if row[1]:
+                    entries[(kind, row[0])] = self._make_entry(kind, row[1], *row[2:])
+
+        keys = sorted((key, kind, item_id) for (kind, item_id), entry in entries.items()
+                      for key in _index_keys(entry['name']))
+        with self._lock:
+            self._entries = entries
+            self._keys = keys
+            self._loaded_at = time.monotonic()
+
+    @staticmethod
+    def _make_entry(kind, name, is_public=None, upload_user_id=None):
+        return {'name': name, 'is_public': bool(is_public), 'upload_user_id': upload_user_id}
+
+    def apply_changes(self, changes):
+        """增量更新：changes 为 {(类型, ID): 条目或 None(已删除)}"""
+        if self._loaded_at is None:
+            return
+        with self._lock:
+            for (kind, item_id), entry in changes.items():
+                old = self._entries.pop((kind, item_id), None)
+                if old is not None:
+                    for key in _index_keys(old['name']):
+                        position = bisect.bisect_left(self._keys, (key, kind, item_id))
+                        if position < len(self._keys) and self._keys[position] == (key, kind, item_id):
+                            del self._keys[position]
+                if entry is not None and entry['name']:
+                    self._entries[(kind, item_id)] = entry
+                    for key in _index_keys(entry['name']):
+                        bisect.insort(self._keys, (key, kind, item_id))
+
+    def suggest(self, prefix, user_id=None, is_admin=False, kinds=None, limit=10):
+        """
+        按前缀返回名称建议，完整名称以前缀开头的排在前面，其次按名称长度
+        非管理员只能看到公开的或自己上传的文件名
+        """
+        self._ensure_loaded()
+        prefix = normalize_query(prefix)
+        if not prefix:
+            return []
+
+        with self._lock:
+            start = bisect.bisect_left(self._keys, (prefix,))
+            seen = {}
+            for key, kind, item_id in self._keys[start:start + limit * 20]:
+                if not key.startswith(prefix):
+                    break
+                if (kinds and kind not in kinds) or (kind, item_id) in seen:
+                    continue
+                entry = self._entries.get((kind, item_id))
+                if entry is None:
+                    continue
+                if kind == 'file' and not is_admin and not entry['is_public'] and entry['upload_user_id'] != user_id:
+                    continue
+                seen[(kind, item_id)] = entry['name']
+
+        suggestions = [{'type': kind, 'id': item_id, 'name': name} for (kind, item_id), name in seen.items()]
+        suggestions.sort(key=lambda item: (not item['name'].lower().startswith(prefix), len(item['name'])))
+        return suggestions[:limit]
+
+
+name_index = NameIndex()
+
+# ---------------------------------------------------------------
+# 变化跟踪：flush 时记录，commit 后生效，rollback 时丢弃
+# ---------------------------------------------------------------
+
+_WATCHED_MODELS = tuple(_MODEL_KINDS) + (FileContent, User)
+
+
+def _record_change(mapper, connection, target, deleted=False):
+    session = object_session(target)
+    if session is None:
+        return
+    session.info['search_dirty'] = True
+    kind = _MODEL_KINDS.get(type(target))
+    if kind is None:
+        return
+    changes = session.info.setdefault('search_name_changes', {})
+    if deleted:
+        changes[(kind, target.id)] = None
+    else:
+        attribute = SUGGEST_SOURCES[kind][1]
+        changes[(kind, target.id)] = NameIndex._make_entry(
+            kind, getattr(target, attribute),
+            getattr(target, 'is_public', None), getattr(target, 'upload_user_id', None))
+
+
+def _record_upsert(mapper, connection, target):
+    _record_change(mapper, connection, target)
+
+
+def _record_delete(mapper, connection, target):
+    _record_change(mapper, connection, target, deleted=True)
+
+
+for _model in _WATCHED_MODELS:
+    event.listen(_model, 'after_insert', _record_upsert)
+    event.listen(_model, 'after_update', _record_upsert)
+    event.listen(_model, 'after_delete', _record_delete)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_committed_changes(session):
+    if not session.info.pop('search_dirty', False):
+        return
+    global _generation
+    with _generation_lock:
+        _generation += 1
+    changes = session.info.pop('search_name_changes', None)
+    if changes:
+        name_index.apply_changes(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changes(session):
+    session.info.pop('search_dirty', None)
+    session.info.pop('search_name_changes', None)
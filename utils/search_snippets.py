@@ -0,0 +1,224 @@
+# utils/search_snippets.py
+"""
+搜索结果的内容预览（片段）和关键词高亮
+
+每个命中文件的开销是固定的，与文档长度无关：
+1. file_contents_fts 可用时，由 FTS5 的 snippet() 在 SQLite 中直接生成片段
+2. 其余文件在一条批量查询中只取回正文开头 SCAN_LIMIT 个字符，只在这部分中查找匹配，
+   不再把整篇文本读入 Python 后整体 lower()；超出这部分的匹配不生成片段
+3. 在取回的文本上用预编译的正则（不区分大小写）扫描匹配，按窗口内命中的不同关键词数和命中次数
+   选出最多 max_fragments 个片段，按在文中的顺序返回
+
+高亮标记与前端约定一致：{{highlight}} 和 {{/highlight}}。
+"""
+import re
+from functools import lru_cache
+
+from sqlalchemy import text
+
+from models import db
+
+HIGHLIGHT_START = '{{highlight}}'
+HIGHLIGHT_END = '{{/highlight}}'
+SCAN_LIMIT = 20000  # 每个文件最多扫描的字符数
+MAX_MATCHES = 200  # 每个文件最多统计的匹配次数
+BOUNDARY_SLACK = 12  # 片段边界向空白处调整的最大距离
+FTS_TABLE = 'file_contents_fts'
+FTS_SNIPPET_TOKENS = 32
+
+
+def query_terms(query):
+    """检索词：完整的检索串，以及按空白拆分出的各个词（去重，长的在前，保证最长匹配优先）"""
+    query = (query or '').strip()
+    if not query:
+        return ()
+    terms = {query.lower(): query}
+    for term in query.split():
+        terms.setdefault(term.lower(), term)
+    return tuple(sorted(terms.values(), key=len, reverse=True))
+
+
+@lru_cache(maxsize=256)
+def compile_query(query):
+    """把检索词编译为一个不区分大小写的正则，结果按检索串缓存"""
+    terms = query_terms(query)
+    if not terms:
+        return None
+    return re.compile('|'.join(re.escape(term) for term in terms), re.IGNORECASE)
+
+
+def _mark(match):
+    return f"{HIGHLIGHT_START}{match.group(0)}{HIGHLIGHT_END}"
+
+
+def highlight_text(text, query):
+    """
+    在文本中为搜索关键词添加高亮标记
+    使用特殊标记 {{highlight}} 和 {{/highlight}} 包裹匹配文本
+    """
+    if not text or not query:
+        return text
+    pattern = compile_query(query)
+    if pattern is None:
+        return text
+    return pattern.sub(_mark, text)
+
+
+def _adjust_start(text, start, limit):
+    """片段起点向前找最近的空白（最多 BOUNDARY_SLACK 个字符），避免截断英文单词"""
+    floor = max(limit, start - BOUNDARY_SLACK)
+    for position in range(start, floor, -1):
+        if text[position - 1].isspace():
+            return position
+    return start
+
+
+def _adjust_end(text, end, limit):
+    ceiling = min(limit, end + BOUNDARY_SLACK)
+    for position in range(end, ceiling):
+        if text[position].isspace():
+            return position
+    return end
+
+
+def find_fragments(text, query, max_fragments=3, fragment_chars=150, offset=0, total_length=None):
+    """
+    在 text（最多扫描 SCAN_LIMIT 个字符）中找出最相关的若干片段
+    :param offset: text 在原文中的起始位置（用于判断是否需要前导省略号）
+    :param total_length: 原文长度（用于判断是否需要结尾省略号），默认为 offset + len(text)
+    :return: 已加高亮标记的片段列表，按在原文中的顺序排列
+    """
+    pattern = compile_query(query)
+    if not text or pattern is None:
+        return []
+    limit = min(len(text), SCAN_LIMIT)
+    total_length = total_length if total_length is not None else offset + len(text)
+
+    matches = []
+    for match in pattern.finditer(text, 0, limit):
+        matches.append((match.start(), match.end(), match.group(0).lower()))
+        if len(matches) >= MAX_MATCHES:
+            break
+    if not matches:
+        return []
+
+    # 以每个匹配为起点划出窗口，统计窗口内的不同关键词数和命中次数
+    windows = []
+    end_index = 0
+    for index, (start, _, _) in enumerate(matches):
+        window_end = start + fragment_chars
+        end_index = max(end_index, index)
+        while end_index + 1 < len(matches) and matches[end_index + 1][1] <= window_end:
+            end_index += 1
+        inside = matches[index:end_index + 1]
+        windows.append((len({term for _, _, term in inside}), len(inside), -start, index))
+    windows.sort(reverse=True)
+
+    chosen = []
+    for _, _, negative_start, index in windows:
+        match_start, match_end = matches[index][0], matches[index][1]
+        # 匹配居中放置
+        start = max(0, match_start - max(0, fragment_chars - (match_end - match_start)) // 2)
+        end = min(len(text), start + fragment_chars)
+        start = max(0, end - fragment_chars)
+        if any(start < chosen_end and end > chosen_start for chosen_start, chosen_end in chosen):
+            continue
+        chosen.append((start, end))
+        if len(chosen) >= max_fragments:
+            break
+
+    fragments = []
+    for start, end in sorted(chosen):
+        start = _adjust_start(text, start, 0) if start > 0 else 0
+        end = _adjust_end(text, end, len(text)) if end < len(text) else end
+        fragment = highlight_text(text[start:end].strip(), query)
+        if offset + start > 0:
+            fragment = f"...{fragment}"
+        if offset + end < total_length:
+            fragment = f"{fragment}..."
+        fragments.append(fragment)
+    return fragments
+
+
+def get_content_preview(content, query, context_length=150, max_fragments=3):
+    """获取匹配内容的上下文预览（已加高亮标记），没有匹配时返回 None"""
+    fragments = find_fragments(content, query, max_fragments=max_fragments, fragment_chars=context_length,
+                               total_length=len(content) if content else 0)
+    return ' '.join(fragments) if fragments else None
+
+
+@lru_cache(maxsize=1)
+def _fts5_available():
+    try:
+        sql = db.session.execute(
+            text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': FTS_TABLE}
+        ).scalar()
+    except Exception:
+        db.session.rollback()
+        return False
+    return bool(sql) and 'fts5' in sql.lower()
+
+
+def sync_file_contents_fts():
+    """
+    启动时调用：FileContent 的同步事件注册之前写入的内容不在全文索引中，行数不一致时整体重建一次
+    :return: 重建的行数，无需重建时为 0
+    """
+    indexed = db.session.execute(text(f"SELECT count(*) FROM {FTS_TABLE}")).scalar()
+    stored = db.session.execute(text("SELECT count(*) FROM file_contents")).scalar()
+    if indexed == stored:
+        return 0
+    db.session.execute(text(f"DELETE FROM {FTS_TABLE}"))
+    db.session.execute(text(f"INSERT INTO {FTS_TABLE} (rowid, content) SELECT id, content FROM file_contents"))
+    db.session.commit()
+    _fts5_available.cache_clear()
+    return stored
+
+
+def fts_match_expression(query):
+    return ' '.join('"' + term.replace('"', '""') + '"' for term in query.split())
+
+
+def _fts_snippets(file_ids, query):
+    if not _fts5_available():
+        return {}
+    try:
+        rows = db.session.execute(text(f"""
+            SELECT fc.file_id, snippet({FTS_TABLE}, 0, :hl_start, :hl_end, '...', {FTS_SNIPPET_TOKENS})
+            FROM {FTS_TABLE}
+            JOIN file_contents fc ON fc.id = {FTS_TABLE}.rowid
+            WHERE {FTS_TABLE} MATCH :match AND fc.file_id IN ({','.join(str(int(i)) for i in file_ids)})
+        """), {'match': fts_match_expression(query), 'hl_start': HIGHLIGHT_START, 'hl_end': HIGHLIGHT_END}).all()
+    except Exception as e:
+        db.session.rollback()
+        print(f"全文索引片段生成失败: {str(e)}")
+        return {}
+    return {file_id: [snippet] for file_id, snippet in rows if snippet}
+
+
+def build_content_previews(file_ids, query, context_length=150, max_fragments=3):
+    """
+    为一批命中的 ProjectFile 生成内容预览
+    :return: {file_id: 片段列表}；有提取内容的文件都在结果中，没有匹配时为空列表
+    """
+    file_ids = list(dict.fromkeys(file_ids))
+    if not file_ids or not (query or '').strip():
+        return {}
+
+    previews = _fts_snippets(file_ids, query)
+    remaining = [file_id for file_id in file_ids if file_id not in previews]
+    if not remaining:
+        return previews
+
+    # 只取正文开头的 SCAN_LIMIT 个字符（多取一个字符用于判断是否需要结尾省略号），不计算整篇长度
+    rows = db.session.execute(text(f"""
+        SELECT file_id, substr(content, 1, :scan_limit + 1) AS head
+        FROM file_contents
+        WHERE file_id IN ({','.join(str(int(i)) for i in remaining)})
+    """), {'scan_limit': SCAN_LIMIT}).all()
+
+    for file_id, head in rows:
+        head = head or ''
+        previews[file_id] = find_fragments(head[:SCAN_LIMIT], query, max_fragments, context_length,
+                                           total_length=len(head))
+    return previews
@@ -0,0 +1,160 @@
+# utils/session_store.py
+"""
+用户会话的查询、活动时间更新和超时清理
+
+会话 ID 随登录时间递增，管理后台按 ID 倒序做游标（keyset）分页：
+- 登录时间范围先通过 login_time 索引换算成 ID 范围（各一次索引查找），之后只按主键扫描
+- 按用户、是否活跃过滤时使用对应的索引（SQLite 的索引隐含 rowid，可直接按 ID 排序）
+- 用户名在同一条查询中关联得到，不再逐行懒加载 User
+
+超时（SESSION_IDLE_TIMEOUT 秒无活动）：
+- 每个请求只执行一条 UPDATE（touch_active_session），未超时的活跃会话刷新活动时间，
+  没有更新到行即视为会话已过期
+- 后台任务 reap_idle_sessions 定期用一条 UPDATE 结束所有超时会话，并把数量写入 system_metrics，
+  告警接口直接读取
+"""
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import Integer, cast, func, text, update
+
+from config import register_maintenance_job
+from models import db, User, UserSession
+from utils.system_metrics import set_metrics
+
+METRIC_REAPED_LAST = 'sessions_reaped_last'  # 最近一次清理结束的会话数
+METRIC_REAPED_TOTAL = 'sessions_reaped_total'  # 累计结束的会话数
+METRIC_ACTIVE = 'sessions_active'  # 清理后仍活跃的会话数
+
+SESSION_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS ix_user_sessions_user_id ON user_sessions (user_id)",
+    "CREATE INDEX IF NOT EXISTS ix_user_sessions_is_active ON user_sessions (is_active)",
+    "CREATE INDEX IF NOT EXISTS ix_user_sessions_login_time ON user_sessions (login_time)",
+    # 超时清理：活跃会话按最后活动时间范围扫描
+    "CREATE INDEX IF NOT EXISTS ix_user_sessions_active_last_activity ON user_sessions (is_active, last_activity_time)",
+)
+
+
+def ensure_session_indexes():
+    """启动时调用"""
+    for statement in SESSION_INDEXES:
+        db.session.execute(text(statement))
+    db.session.commit()
+
+
+def _login_time_id_bounds(start, end):
+    """把登录时间范围 [start, end) 换算成 ID 范围，范围内没有会话时返回 None"""
+    low = high = None
+    if start is not None:
+        low = db.session.query(UserSession.id).filter(UserSession.login_time >= start) \
+            .order_by(UserSession.login_time, UserSession.id).limit(1).scalar()
+        if low is None:
+            return None
+    if end is not None:
+        high = db.session.query(UserSession.id).filter(UserSession.login_time < end) \
+            .order_by(UserSession.login_time.desc(), UserSession.id.desc()).limit(1).scalar()
+        if high is None:
+            return None
+    return low, high
+
+
+def query_sessions(per_page=20, user_id=None, is_active=None, start=None, end=None, cursor=None,
+                   with_total=False):
+    """
+    按 ID 倒序分页查询会话
+    :param start: 登录时间起点（含），None 表示不限
+    :param end: 登录时间终点（不含），None 表示不限
+    :param cursor: 上一页最后一条会话的 ID，None 表示第一页
+    :param with_total: 是否返回总数；没有用户/状态过滤时按 ID 范围估算，不做 COUNT
+    :return: ([(UserSession, 用户名)], 下一页游标, 总数或 None)
+    """
+    bounds = _login_time_id_bounds(start, end)
+    if bounds is None:
+        return [], None, 0 if with_total else None
+    low, high = bounds
+
+    query = db.session.query(UserSession, User.username).outerjoin(User, User.id == UserSession.user_id)
+    if user_id:
+        query = query.filter(UserSession.user_id == user_id)
+    if is_active is not None:
+        query = query.filter(UserSession.is_active == is_active)
+    if low is not None:
+        query = query.filter(UserSession.id >= low)
+    if high is not None:
+        query = query.filter(UserSession.id <= high)
+
+    total = None
+    if with_total:
+        if user_id or is_active is not None:
+            total = query.with_entities(func.count(UserSession.id)).scalar()
+        else:
+            first, last = db.session.query(func.min(UserSession.id), func.max(UserSession.id)).one()
+            first = low if low is not None else first
+            last = high if high is not None else last
+            total = max(last - first + 1, 0) if first is not None and last is not None else 0
+
+    if cursor is not None:
+        query = query.filter(UserSession.id < cursor)
+    rows = query.order_by(UserSession.id.desc()).limit(per_page + 1).all()
+
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = rows[-1][0].id
+    return rows, next_cursor, total
+
+
+def idle_cutoff(now=None):
+    timeout = current_app.config.get('SESSION_IDLE_TIMEOUT', 3600)
+    return (now or datetime.now()) - timedelta(seconds=timeout)
+
+
+def touch_active_session(user_id):
+    """
+    刷新用户活跃会话的最后活动时间（一条 UPDATE 并提交）
+    :return: 是否存在未超时的活跃会话；为 False 时调用方应要求重新登录
+    """
+    now = datetime.now()
+    result = db.session.execute(
+        update(UserSession)
+        .where(UserSession.user_id == user_id,
+               UserSession.is_active.is_(True),
+               UserSession.last_activity_time >= idle_cutoff(now))
+        .values(last_activity_time=now)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return result.rowcount > 0
+
+
+def has_active_session(user_id):
+    """是否存在未超时的活跃会话（只读，不刷新活动时间）"""
+    return db.session.query(UserSession.id).filter(
+        UserSession.user_id == user_id,
+        UserSession.is_active.is_(True),
+        UserSession.last_activity_time >= idle_cutoff()
+    ).first() is not None
+
+
+def reap_idle_sessions():
+    """
+    结束所有超时的活跃会话（一条 UPDATE），并记录数量
+    :return: 本次结束的会话数
+    """
+    now = datetime.now()
+    cutoff = idle_cutoff(now)
+    reaped = db.session.execute(
+        update(UserSession)
+        .where(UserSession.is_active.is_(True), UserSession.last_activity_time < cutoff)
+        .values(is_active=False, logout_time=now,
+                session_duration=cast((func.julianday(now) - func.julianday(UserSession.login_time)) * 86400,
+                                      Integer))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    active = db.session.query(func.count(UserSession.id)).filter(UserSession.is_active.is_(True)).scalar()
+    set_metrics({METRIC_REAPED_LAST: reaped, METRIC_ACTIVE: active}, increments={METRIC_REAPED_TOTAL: reaped})
+    db.session.commit()
+    return reaped
+
+
+register_maintenance_job('session_reaper', reap_idle_sessions, minutes=5)
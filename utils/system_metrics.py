@@ -0,0 +1,36 @@
+# utils/system_metrics.py
+"""
+系统指标（system_metrics 表）的读写
+
+后台任务计算出的数值写入这里，管理接口只读取，调用方负责 commit。
+"""
+from datetime import datetime
+
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import db, SystemMetric
+
+
+def set_metrics(values, increments=None):
+    """
+    写入一组指标
+    :param values: {名称: 值}，覆盖原值
+    :param increments: {名称: 增量}，在原值上累加
+    """
+    now = datetime.now()
+    table = SystemMetric.__table__
+    for name, value in values.items():
+        statement = sqlite_insert(table).values(name=name, value=value, updated_at=now)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=['name'], set_={'value': value, 'updated_at': now}))
+    for name, increment in (increments or {}).items():
+        statement = sqlite_insert(table).values(name=name, value=increment, updated_at=now)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=['name'], set_={'value': table.c.value + increment, 'updated_at': now}))
+
+
+def get_metrics(*names):
+    """:return: {名称: (值, 更新时间)}，不存在的指标不在结果中"""
+    rows = db.session.query(SystemMetric.name, SystemMetric.value, SystemMetric.updated_at) \
+        .filter(SystemMetric.name.in_(names)).all()
+    return {name: (value, updated_at) for name, value, updated_at in rows}
@@ -0,0 +1,231 @@
+# utils/user_deletion.py
+"""
+后台删除用户
+
+删除接口只做两件事并立即返回：停用用户（is_disabled，同时结束其所有会话）、创建 UserDeletionJob。
+后台线程按 DELETION_STEPS 依次处理关联数据，每一步按 rowid 分块（USER_DELETION_CHUNK_SIZE 行），
+每块一个短事务，块之间短暂让出数据库，其他请求不会被长时间锁住。每块提交时同时更新任务进度。
+
+所有步骤都是幂等的：任务中断（进程重启等）后由维护任务重新提交，从头执行也不会出错。
+批量 SQL 绕过了 ORM 事件，完成后调用 invalidate_search_caches()。
+用户作为培训师的培训（连同其评论、回复）一并删除，培训材料文件在删除用户提交之后删除。
+用户仍是进行中项目/子项目的负责人时任务失败，不解除负责人；管理员重新分配后再次调用删除接口。
+"""
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import inspect, text
+
+from config import register_maintenance_job
+from models import db, Project, Subproject, UserDeletionJob, UserSession
+from utils.activity_log_store import delete_user_partition_logs
+from utils.search_cache import invalidate_search_caches
+
+STATUS_PENDING = 'pending'
+STATUS_RUNNING = 'running'
+STATUS_COMPLETED = 'completed'
+STATUS_FAILED = 'failed'
+
+_AI_CONVERSATIONS = "SELECT id FROM ai_conversations WHERE user_id = :user_id"
+_TRAININGS = "SELECT id FROM trainings WHERE trainer_id = :user_id"
+
+# (步骤名称, 表, 操作)：操作为 ('null', 列) 表示将该列置空，('delete', 条件) 表示删除满足条件的行
+DELETION_STEPS = (
+    ('解除项目负责人', 'projects', ('null', 'employee_id')),
+    ('解除子项目负责人', 'subprojects', ('null', 'employee_id')),
+    ('解除组员的组长关联', 'users', ('null', 'team_leader_id')),
+    ('解除上传文件的用户', 'project_files', ('null', 'upload_user_id')),
+    ('解除任务进度记录人', 'task_progress_updates', ('null', 'recorder_id')),
+    ('解除公告发布人', 'announcements', ('null', 'created_by')),
+    ('解除知识库创建人', 'knowledge_bases', ('null', 'created_by_id')),
+    ('解除知识库文件上传人', 'knowledge_base_files', ('null', 'upload_user_id')),
+    ('删除会话', 'user_sessions', ('delete', "user_id = :user_id")),
+    ('删除活动日志', 'user_activity_logs', ('delete', "user_id = :user_id")),
+    ('删除活动汇总', 'user_activity_rollups', ('delete', "user_id = :user_id")),
+    ('删除补卡明细', 'report_clockin_details',
+     ('delete', "report_id IN (SELECT id FROM report_clockins WHERE employee_id = :user_id)")),
+    ('删除补卡记录', 'report_clockins', ('delete', "employee_id = :user_id")),
+    ('删除培训评论下的回复', 'replies',
+     ('delete', f"comment_id IN (SELECT id FROM comments WHERE training_id IN ({_TRAININGS}))")),
+    ('删除培训下的评论', 'comments', ('delete', f"training_id IN ({_TRAININGS})")),
+    ('删除培训', 'trainings', ('delete', "trainer_id = :user_id")),
+    ('删除评论下的回复', 'replies', ('delete', "comment_id IN (SELECT id FROM comments WHERE user_id = :user_id)")),
+    ('删除回复', 'replies', ('delete', "user_id = :user_id")),
+    ('删除评论', 'comments', ('delete', "user_id = :user_id")),
+    ('删除AI消息反馈', 'ai_message_feedback',
+     ('delete', f"message_id IN (SELECT id FROM ai_messages WHERE conversation_id IN ({_AI_CONVERSATIONS}))")),
+    ('删除AI消息', 'ai_messages', ('delete', f"conversation_id IN ({_AI_CONVERSATIONS})")),
+    ('删除AI会话标签', 'ai_conversation_tags', ('delete', f"conversation_id IN ({_AI_CONVERSATIONS})")),
+    ('删除AI会话', 'ai_conversations', ('delete', "user_id = :user_id")),
+    ('删除AI接口配置', 'ai_api', ('delete', "user_id = :user_id")),
+    ('删除公告阅读状态', 'announcement_read_status', ('delete', "user_id = :user_id")),
+    ('删除公告已读水位', 'announcement_read_watermarks', ('delete', "user_id = :user_id")),
+    ('删除编辑时间跟踪', 'edit_time_tracking', ('delete', "user_id = :user_id")),
+)
+# 除上面的步骤外：删除分区中的活动日志、删除用户本身
+TOTAL_STEPS = len(DELETION_STEPS) + 2
+
+# 每个进程一个后台线程，删除任务依次执行
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='user-deletion')
+
+
+def ensure_user_deletion_columns():
+    """为已有数据库补充 users.is_disabled 列（启动时调用）"""
+    columns = {column['name'] for column in inspect(db.engine).get_columns('users')}
+    if 'is_disabled' not in columns:
+        db.session.execute(text("ALTER TABLE users ADD COLUMN is_disabled BOOLEAN NOT NULL DEFAULT 0"))
+        db.session.commit()
+
+
+def find_ongoing_assignment(user_id):
+    """
+    正在进行中的项目/子项目不能解除负责人
+    :return: 说明原因的错误信息，没有时为 None
+    """
+    project = Project.query.filter_by(employee_id=user_id, status='ongoing').first()
+    if project:
+        return f'用户有正在进行中的项目: {project.name}, 无法删除'
+    subproject = Subproject.query.filter_by(employee_id=user_id, status='ongoing').first()
+    if subproject:
+        return f'用户有正在进行中的子项目: {subproject.name}, 无法删除'
+    return None
+
+
+def _remove_training_materials(paths):
+    """删除培训材料文件（培训记录已提交删除之后调用）"""
+    root = os.path.join(current_app.root_path, 'uploads')
+    for path in paths:
+        try:
+            os.remove(os.path.join(root, path))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            current_app.logger.error(f"删除培训材料失败 {path}: {str(e)}")
+
+
+def start_user_deletion(user, requested_by):
+    """
+    停用用户、结束其会话并提交后台删除任务；该用户已有未完成的任务时重新提交该任务
+    :return: UserDeletionJob
+    """
+    job = UserDeletionJob.query.filter(
+        UserDeletionJob.user_id == user.id,
+        UserDeletionJob.status != STATUS_COMPLETED
+    ).order_by(UserDeletionJob.id.desc()).first()
+    if job is None:
+        job = UserDeletionJob(user_id=user.id, username=user.username, requested_by=requested_by,
+                              total_steps=TOTAL_STEPS)
+        db.session.add(job)
+    else:
+        job.status, job.error = STATUS_PENDING, None
+
+    user.is_disabled = True
+    UserSession.query.filter_by(user_id=user.id, is_active=True) \
+        .update({'is_active': False, 'logout_time': datetime.now()}, synchronize_session=False)
+    db.session.commit()
+    submit_deletion_job(job.id)
+    return job
+
+
+def submit_deletion_job(job_id):
+    app = current_app._get_current_object()
+    _executor.submit(_run_with_app_context, app, job_id)
+
+
+def _run_with_app_context(app, job_id):
+    with app.app_context():
+        try:
+            run_deletion_job(job_id)
+        except Exception as e:
+            app.logger.error(f"用户删除任务 {job_id} 执行出错: {str(e)}")
+        finally:
+            db.session.remove()
+
+
+def _chunk_sql(table, operation):
+    kind, argument = operation
+    if kind == 'null':
+        return (f"UPDATE {table} SET {argument} = NULL WHERE rowid IN "
+                f"(SELECT rowid FROM {table} WHERE {argument} = :user_id LIMIT :chunk)")
+    return f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} WHERE {argument} LIMIT :chunk)"
+
+
+def _update_job(job_id, **fields):
+    fields['updated_at'] = datetime.now()
+    db.session.query(UserDeletionJob).filter(UserDeletionJob.id == job_id) \
+        .update(fields, synchronize_session=False)
+
+
+def run_deletion_job(job_id):
+    """按步骤分块执行删除任务（在后台线程中调用）"""
+    job = db.session.get(UserDeletionJob, job_id)
+    if job is None or job.status == STATUS_COMPLETED:
+        return
+    user_id = job.user_id
+    chunk = current_app.config.get('USER_DELETION_CHUNK_SIZE', 1000)
+    pause = current_app.config.get('USER_DELETION_CHUNK_PAUSE', 0.05)
+    _update_job(job_id, status=STATUS_RUNNING, step_index=0, processed_rows=0, error=None)
+    db.session.commit()
+
+    processed = 0
+    try:
+        # 提交任务后用户已停用，但负责人仍可能被重新分配：解除负责人之前再检查一次
+        error = find_ongoing_assignment(user_id)
+        if error:
+            raise ValueError(error)
+        materials = db.session.execute(text(
+            "SELECT material_path FROM trainings WHERE trainer_id = :user_id AND material_path IS NOT NULL"
+        ), {'user_id': user_id}).scalars().all()
+
+        for index, (name, table, operation) in enumerate(DELETION_STEPS):
+            sql = text(_chunk_sql(table, operation))
+            while True:
+                affected = db.session.execute(sql, {'user_id': user_id, 'chunk': chunk}).rowcount
+                processed += affected
+                _update_job(job_id, current_step=name, step_index=index, processed_rows=processed)
+                db.session.commit()
+                if affected < chunk:
+                    break
+                time.sleep(pause)
+
+        _update_job(job_id, current_step='删除分区中的活动日志', step_index=len(DELETION_STEPS))
+        db.session.commit()
+        processed += delete_user_partition_logs(user_id)
+
+        db.session.execute(text("DELETE FROM users WHERE id = :user_id"), {'user_id': user_id})
+        _update_job(job_id, status=STATUS_COMPLETED, current_step='已完成', step_index=TOTAL_STEPS,
+                    processed_rows=processed, finished_at=datetime.now())
+        db.session.commit()
+        invalidate_search_caches()
+        _remove_training_materials(materials)
+    except Exception as e:
+        db.session.rollback()
+        _update_job(job_id, status=STATUS_FAILED, error=str(e))
+        db.session.commit()
+        raise
+
+
+def resume_stalled_deletion_jobs():
+    """
+    维护任务：重新提交长时间没有进展的未完成任务（进程重启或线程异常退出）
+    失败的任务不自动重试，由管理员再次调用删除接口
+    """
+    cutoff = datetime.now() - timedelta(minutes=5)
+    stalled = db.session.query(UserDeletionJob.id).filter(
+        UserDeletionJob.status.in_([STATUS_PENDING, STATUS_RUNNING]),
+        UserDeletionJob.updated_at < cutoff
+    ).all()
+    for (job_id,) in stalled:
+        # 先更新时间，其他进程的维护任务不会重复提交
+        claimed = db.session.query(UserDeletionJob).filter(
+            UserDeletionJob.id == job_id, UserDeletionJob.updated_at < cutoff
+        ).update({'updated_at': datetime.now()}, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            submit_deletion_job(job_id)
+
+
+register_maintenance_job('user_deletion_resume', resume_stalled_deletion_jobs, minutes=5)